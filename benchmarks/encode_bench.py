@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+""" Measures how quickly each encoder writes typical get_joined output, a page
+of posts with their authors and comments, compared to flask's jsonify.
+
+    python benchmarks/encode_bench.py [objects] [rounds]
+"""
+import datetime
+import sys
+import timeit
+
+from flask import Flask, jsonify
+from sqlalchemy import (Column, create_engine, DateTime, ForeignKey, Integer,
+                        Unicode)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+
+from lever import get_joined
+from lever import encoders
+
+base = declarative_base()
+
+
+class Author(base):
+    __tablename__ = 'author'
+    id = Column(Integer, primary_key=True)
+    username = Column(Unicode)
+
+    standard_join = ['username', 'id']
+
+
+class Comment(base):
+    __tablename__ = 'comment'
+    id = Column(Integer, primary_key=True)
+    body = Column(Unicode)
+    created_at = Column(DateTime)
+    post_id = Column(Integer, ForeignKey('post.id'))
+    author_id = Column(Integer, ForeignKey('author.id'))
+    author = relationship(Author)
+
+    standard_join = ['__dont_mongo', 'id', 'body', 'created_at',
+                     {'obj': 'author'}]
+
+
+class Post(base):
+    __tablename__ = 'post'
+    id = Column(Integer, primary_key=True)
+    title = Column(Unicode)
+    body = Column(Unicode)
+    created_at = Column(DateTime)
+    author_id = Column(Integer, ForeignKey('author.id'))
+    author = relationship(Author)
+    comments = relationship(Comment, order_by=Comment.id)
+
+    standard_join = [{'obj': 'author'}, {'obj': 'comments'}]
+
+
+def build(count):
+    engine = create_engine('sqlite://')
+    base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    authors = [Author(username=u'author%d' % i) for i in range(10)]
+    now = datetime.datetime.utcnow()
+    for i in range(count):
+        post = Post(title=u'Post %d' % i, body=u'body text ☃ ' * 20,
+                    created_at=now, author=authors[i % 10])
+        post.comments = [Comment(body=u'comment %d' % j, created_at=now,
+                                 author=authors[j % 10]) for j in range(5)]
+        session.add(post)
+    session.commit()
+    return dict(success=True, objects=get_joined(session.query(Post).all()))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    app = Flask(__name__)
+    with app.test_request_context():
+        retval = build(count)
+        candidates = [('jsonify', lambda: jsonify(**retval).get_data())]
+        for name in sorted(encoders.encoders):
+            try:
+                encoder = encoders.get_encoder(name)
+            except ImportError:
+                print("{0:>10}: not installed".format(name))
+                continue
+            candidates.append((name, lambda e=encoder: e.dumps(retval)))
+
+        print("{0} objects, {1} rounds".format(count, rounds))
+        for name, func in candidates:
+            size = len(func())
+            seconds = min(timeit.repeat(func, number=rounds, repeat=3))
+            print("{0:>10}: {1:8.1f} MB/s {2:8.0f} responses/s {3:8d} bytes"
+                  .format(name, size * rounds / seconds / 1e6,
+                          rounds / seconds, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+""" Measures the throughput of an NDJSON export of posts with their authors and
+comments from a SQLite file, sequentially and split between worker processes
+with __export_workers.
+
+    python benchmarks/export_bench.py [objects] [max workers]
+"""
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import Flask
+from sqlalchemy import (Column, create_engine, DateTime, ForeignKey, Integer,
+                        Unicode)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+
+from lever import API
+
+base = declarative_base()
+
+
+class Author(base):
+    __tablename__ = 'author'
+    id = Column(Integer, primary_key=True)
+    username = Column(Unicode)
+
+    standard_join = ['username', 'id']
+
+
+class Comment(base):
+    __tablename__ = 'comment'
+    id = Column(Integer, primary_key=True)
+    body = Column(Unicode)
+    created_at = Column(DateTime)
+    post_id = Column(Integer, ForeignKey('post.id'))
+    author_id = Column(Integer, ForeignKey('author.id'))
+    author = relationship(Author)
+
+    standard_join = ['__dont_mongo', 'id', 'body', 'created_at',
+                     {'obj': 'author'}]
+
+
+class Post(base):
+    __tablename__ = 'post'
+    id = Column(Integer, primary_key=True)
+    title = Column(Unicode)
+    body = Column(Unicode)
+    created_at = Column(DateTime)
+    author_id = Column(Integer, ForeignKey('author.id'))
+    author = relationship(Author)
+    comments = relationship(Comment, order_by=Comment.id)
+
+    standard_join = [{'obj': 'author'}, {'obj': 'comments'}]
+
+
+def build(engine, count):
+    base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    authors = [Author(username=u'author%d' % i) for i in range(10)]
+    session.add_all(authors)
+    session.flush()
+    now = datetime.datetime.utcnow()
+    for i in range(count):
+        session.add(Post(title=u'Post %d' % i, body=u'body text ☃ ' * 20,
+                         created_at=now, author_id=authors[i % 10].id))
+    session.flush()
+    session.bulk_insert_mappings(Comment, [
+        dict(body=u'comment %d' % j, created_at=now, post_id=i + 1,
+             author_id=authors[j % 10].id)
+        for i in range(count) for j in range(5)])
+    session.commit()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine = create_engine('sqlite:///' + os.path.join(tmpdir, 'db'))
+        build(engine, count)
+
+        class PostAPI(API):
+            model = Post
+            session = scoped_session(sessionmaker(bind=engine))
+            allow_export = True
+            export_workers = max_workers
+            stream_chunk_size = 500
+
+        app = Flask(__name__)
+        PostAPI.register(app, '/post')
+        client = app.test_client()
+        print("{0} objects".format(count))
+        workers = [None] + [n for n in (1, 2, 4, 8, 16) if n <= max_workers]
+        for n in workers:
+            params = {'__export': 'ndjson'}
+            if n is not None:
+                params['__export_workers'] = n
+            start = time.time()
+            response = client.get('/post', query_string=params)
+            data = response.get_data()
+            seconds = time.time() - start
+            PostAPI.session.remove()
+            print("{0:>10}: {1:8.0f} rows/s {2:8.1f} MB/s".format(
+                'sequential' if n is None else '{0} workers'.format(n),
+                count / seconds, len(data) / seconds / 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ __version__ = '0.2'
 
 # make the following names available as part of the public API
 from .base import (API, LeverException, get_joined, LeverSyntaxError, jsonize,
-                   preprocess, postprocess, ModelBasedACL, ImpersonateMixin,
+                   compile_join, restrict_join, preprocess, postprocess,
+                   ModelBasedACL, ImpersonateMixin, register_converter,
                    LeverServerError, LeverNotFound, LeverAccessDenied)
 from .acl import build_acl
+from .batch import BatchAPI
@@ -24,8 +24,14 @@ This would all be compiled into a structure like this:
                'edit_pages', 'edit_contents']
 }
 This object is ready to be used in defining object ACL rules with lever """
+import hashlib
+import json
+import os
 import six
-import itertools
+import tempfile
+
+# bumped whenever the compiled output changes, invalidating old snapshots
+_SNAPSHOT_VERSION = 1
 
 
 def inherit_dict(*args):
@@ -36,126 +42,273 @@ def inherit_dict(*args):
     return ret
 
 
-def build_acl(structure):
-    acl = {}
+class BitACL(dict):
+    """ The roles of a single type compiled to integer bitmasks. Each role maps
+    to the OR of the bits of the keys it allows, and bits maps every key to its
+    bit. The bits are shared between all the types compiled together, and the
+    masks of role lists are memoized so a check is a single AND. """
+    def __init__(self, roles, bits):
+        dict.__init__(self, roles)
+        self.bits = bits
+        self._masks = {}
+
+    def mask(self, roles):
+        """ Returns the combined mask of a list of roles """
+        key = tuple(roles)
+        try:
+            return self._masks[key]
+        except KeyError:
+            mask = 0
+            for role in roles:
+                mask |= self.get(role, 0)
+            self._masks[key] = mask
+            return mask
+
+    def allows(self, mask, key):
+        """ Whether the key is allowed by a mask """
+        bit = self.bits.get(key)
+        return bit is not None and bool(mask & bit)
+
+    def keys_for(self, mask):
+        """ Decodes a mask back into the set of keys that it allows """
+        return set(key for key, bit in six.iteritems(self.bits) if mask & bit)
+
+
+def bitmask_acl(acl):
+    """ Converts the output of build_acl into a dictionary of BitACL objects,
+    interning every key across all the types into a single bit """
+    keys = set()
+    for roles in six.itervalues(acl):
+        for allowed in six.itervalues(roles):
+            keys |= allowed
+    bits = dict((key, 1 << i) for i, key in enumerate(sorted(keys)))
+
+    compiled = {}
+    for typ, roles in six.iteritems(acl):
+        masks = {}
+        for role, allowed in six.iteritems(roles):
+            mask = 0
+            for key in allowed:
+                mask |= bits[key]
+            masks[role] = mask
+        compiled[typ] = BitACL(masks, bits)
+    return compiled
+
+
+def _as_list(val):
+    """ Inheritence may be given as a single entry or a list """
+    if isinstance(val, list):
+        return val
+    return [val]
+
+
+def _components(nodes, edges):
+    """ Tarjan's algorithm for strongly connected components, written without
+    recursion. Every component comes after all of the components it has edges
+    into, so following edges from a node to the nodes it inherits from gives
+    an order where dependencies are compiled first. Runs in time linear in the
+    number of nodes and edges. """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges.get(root, ())))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(edges.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                # all the children are done, so close out the node
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def compile_acl(structure):
+    """ Does the work of build_acl. Types are compiled in a topological order
+    of type inheritence, and the roles of each type in a topological order of
+    role inheritence, so every set is built once from already finished
+    dependencies. Roles that inherit from each other in a loop all end up with
+    the same keys. The structure passed in isn't modified. """
     # do a run to compile all dictionaries into lists and merge the lists to
-    # createa a role list of keys
+    # createa a role list of keys, and collect the inheritence rules
+    own_keys = {}
+    role_inherits = {}
+    type_inherits = {}
     for typ, roles in sorted(six.iteritems(structure)):
-        acl.setdefault(typ, {})  # set the key to a dict
+        own_keys[typ] = {}
+        role_inherits[typ] = {}
+        type_inherits[typ] = []
         for role, keys in sorted(six.iteritems(roles)):
-            if role in ['inherit', 'virtual']:  # skip inherit commands
+            if role == 'inherit':
+                type_inherits[typ] = _as_list(keys)
                 continue
-            acl[typ].setdefault(role, set())
+            if role == 'virtual':
+                continue
+            allowed = own_keys[typ].setdefault(role, set())
+            role_inherits[typ].setdefault(role, [])
             if isinstance(keys, list):
-                acl[typ][role] |= set(keys)
+                allowed |= set(keys)
             elif isinstance(keys, dict):
                 for key, val in sorted(six.iteritems(keys)):
-                    # skip inheritence clauses, handled later
                     if key == "inherit":
-                        continue
-                    if isinstance(val, list):  # if its a list, prepend
-                        acl[typ][role] |= set([key + "_" + v for v in val])
+                        role_inherits[typ][role].extend(_as_list(val))
+                    elif isinstance(val, list):  # if its a list, prepend
+                        allowed |= set([key + "_" + v for v in val])
                     elif isinstance(val, six.string_types):
-                        acl[typ][role].add(key + "_" + val)
+                        allowed.add(key + "_" + val)
                     else:
                         raise Exception(
                             "Type {0} not supported".format(type(val)))
+            else:
+                raise Exception(
+                    "Contents of role must be dictionary, instead got {0}"
+                    " of value {1} for role {2} in type {3}"
+                    .format(type(keys), keys, role, typ))
 
-    def compile_type(acl, typ, stack, compiled):
-        """ Compiles a specific type, but calls itself recursively to compile
-        it's own dependencies. Detects inheritence loops by checking the stack.
-        """
-        if typ in compiled:
-            return
-
-        # we want to compile all its dependencies first, so find them and
-        # run compile on them if they're not in the list of compiled assets
-        for role, keys in sorted(six.iteritems(structure[typ])):
-            if role == 'inherit':  # only look at inherit entries
-                if not isinstance(keys, list):  # allow single entry, or list
-                    keys = [keys]
-
-                # for each type that this type is inheriting from
-                for inh_type in keys:
-                    # run inheritence from another type
-                    if inh_type not in structure:  # type doesn't exist
-                        raise KeyError(
-                            "Unable to inherit from type {0} for type {1}, "
-                            "doesn't exist".format(inh_type, typ))
-                    if inh_type in stack:  # cyclic call stack
-                        raise Exception(
-                            "Looping inheritence detected! Type {0} tried to "
-                            "inherit from type {1} which was called to compile"
-                            "{0}!".format(typ, inh_type))
-                    if inh_type not in compiled:  # compile if not compiled
-                        compile_type(acl, inh_type, stack + [inh_type], compiled)
-
-                    # pull in inherited role information
-                    # for each role in the type that is being inherited
-                    for inh_role in acl[inh_type]:
-                        # join the keys on the roles of the inherited role
-                        acl[typ].setdefault(inh_role, set())
-                        acl[typ][inh_role] |= acl[inh_type][inh_role]
-
-                        # now set the inheritence rules in the inheriting types
-                        # role list for lookup later when role inheritence
-                        # occurs
-                        if 'inherit' in structure[inh_type][inh_role]:
-                            structure[typ][inh_role] = {
-                                'inherit':
-                                structure[inh_type][inh_role]['inherit']}
-                        else:
-                            structure[typ][inh_role] = {'inherit': []}
-
-        # now run the actual compilation of all the roles
-        for role, keys in sorted(six.iteritems(structure[typ])):
-            if isinstance(keys, dict):
-                for key, val in sorted(six.iteritems(keys)):
-                    if key == "inherit":
-                        #print("inheriting role " + val + " for role " + role)
-                        # allow single entry or list
-                        if not isinstance(val, list):
-                            val = [val]
-                        # keep a list of keys we've inherited from
-                        inherited = []
-                        for inh in val:
-                            # prevent infinite loops by keeping a traveled list
-                            if inh not in inherited:
-                                inherited.append(inh)
-                                try:
-                                    acl[typ][role] |= acl[typ][inh]
-                                except KeyError:
-                                    raise KeyError(
-                                        "Unable to inherit from role {0} "
-                                        "for role {1} on type {2}".
-                                        format(inh, role, typ))
-
-                                # check if what we're inheriting from inherits
-                                other_inh = structure[typ][inh]
-                                if 'inherit' in other_inh:
-                                    if not isinstance(other_inh['inherit'], list):
-                                        # add a scalar list of inherits
-                                        val.append(other_inh['inherit'])
-                                    else:
-                                        # extend a list of inherits
-                                        val.extend(other_inh['inherit'])
-
-            elif not isinstance(keys, list):
-                if role not in ('virtual', 'inherit'):
-                    raise Exception(
-                        "Contents of role must be dictionary, instead got {0}"
-                        " of value {1} for role {2} in type {3}"
-                        .format(type(keys), keys, role, typ))
-        compiled.append(typ)
-
-    compiled = []
-    for typ in structure:
-        compile_type(acl, typ, [typ], compiled)
-
-    # inheritence pass. Allows a type to inherit from another type
-    for typ, roles in sorted(six.iteritems(structure)):
-        for role, keys in sorted(six.iteritems(roles)):
-            if role == 'virtual':  # remove virtual types
-                del acl[typ]
+    for typ, parents in sorted(six.iteritems(type_inherits)):
+        for inh_type in parents:
+            if inh_type not in structure:  # type doesn't exist
+                raise KeyError(
+                    "Unable to inherit from type {0} for type {1}, "
+                    "doesn't exist".format(inh_type, typ))
+
+    acl = {}
+    for component in _components(sorted(structure), type_inherits):
+        typ = component[0]
+        if len(component) > 1 or typ in type_inherits[typ]:
+            raise Exception(
+                "Looping inheritence detected! Type {0} tried to inherit from "
+                "type {1} which was called to compile {0}!"
+                .format(typ, component[-1]))
+
+        # pull in the roles, keys and role inheritence of inherited types.
+        # their acl entries are already finished so it's a single union
+        keys = dict((role, set(allowed))
+                    for role, allowed in six.iteritems(own_keys[typ]))
+        inherits = dict((role, list(inh))
+                        for role, inh in six.iteritems(role_inherits[typ]))
+        for inh_type in type_inherits[typ]:
+            for role, allowed in six.iteritems(acl[inh_type]):
+                keys.setdefault(role, set()).update(allowed)
+            for role, inh in six.iteritems(role_inherits[inh_type]):
+                inherits.setdefault(role, []).extend(inh)
+        role_inherits[typ] = inherits
+
+        for role, inh in sorted(six.iteritems(inherits)):
+            for inh_role in inh:
+                if inh_role not in keys:
+                    raise KeyError(
+                        "Unable to inherit from role {0} for role {1} on type "
+                        "{2}".format(inh_role, role, typ))
+
+        compiled = {}
+        for roles in _components(sorted(keys), inherits):
+            allowed = set()
+            for role in roles:
+                allowed |= keys[role]
+                for inh_role in inherits.get(role, ()):
+                    # members of this component aren't finished yet, but
+                    # their own keys are added by this loop anyway
+                    if inh_role in compiled:
+                        allowed |= compiled[inh_role]
+            for role in roles:
+                compiled[role] = allowed
+        acl[typ] = compiled
+
+    # remove virtual types. They're only used for inheritence
+    for typ, roles in six.iteritems(structure):
+        if 'virtual' in roles:
+            del acl[typ]
+
+    # roles that looped share a set, give them their own
+    return dict((typ, dict((role, set(allowed))
+                           for role, allowed in six.iteritems(roles)))
+                for typ, roles in six.iteritems(acl))
+
+
+def acl_hash(structure):
+    """ A hash of an ACL structure, used to check if a snapshot matches """
+    data = json.dumps([_SNAPSHOT_VERSION, structure], sort_keys=True,
+                      default=repr)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+def load_snapshot(path, structure_hash):
+    """ Loads compiled ACL output saved by save_snapshot. Returns None if the
+    file is missing, unreadable or was made from a different structure """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('hash') != structure_hash:
+        return None
+    return dict((typ, dict((role, set(keys))
+                           for role, keys in six.iteritems(roles)))
+                for typ, roles in six.iteritems(data['acl']))
+
+
+def save_snapshot(path, structure_hash, acl):
+    """ Saves compiled ACL output to path. The file is written next to its
+    destination and renamed into place, so concurrently booting workers never
+    read a partial file. Failing to write is not an error since the snapshot
+    is only an optimization. """
+    data = {'hash': structure_hash,
+            'acl': dict((typ, dict((role, sorted(keys))
+                                   for role, keys in six.iteritems(roles)))
+                        for typ, roles in six.iteritems(acl))}
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def build_acl(structure, bitmask=False, snapshot=None):
+    """ Compiles an ACL structure into a dictionary of types, each mapping
+    role names to the set of keys they allow. With bitmask true each type is
+    a BitACL instead.
+
+    If snapshot is a file path the compiled output is saved there along with
+    a hash of the structure, and later calls with the same structure load it
+    instead of compiling again. """
+    acl = None
+    if snapshot is not None:
+        structure_hash = acl_hash(structure)
+        acl = load_snapshot(snapshot, structure_hash)
+    if acl is None:
+        acl = compile_acl(structure)
+        if snapshot is not None:
+            save_snapshot(snapshot, structure_hash, acl)
 
+    if bitmask:
+        return bitmask_acl(acl)
     return acl
@@ -0,0 +1,410 @@
+""" An API running its queries on an asyncio SQLAlchemy session. This module
+requires Python 3 and SQLAlchemy 1.4 or newer, so it isn't imported by the
+lever package. """
+import asyncio
+import inspect
+import sys
+import threading
+import weakref
+
+import sqlalchemy
+from flask import request
+from flask.globals import _app_ctx_stack, _request_ctx_stack
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.future import select
+
+from .base import (API, LeverNotFound, LeverSyntaxError, compile_join,
+                   get_joined)
+from .cache import invalidate_tables
+
+
+async def _maybe_await(value):
+    """ Hooks and actions can be either functions or coroutine functions """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+_local = threading.local()
+
+
+def run(coro):
+    """ Runs a coroutine to completion on the calling thread's event loop,
+    which is kept open so connections pooled by async engines stay usable.
+    Each thread has its own loop, so a pooled engine must not be shared
+    between threads, see LoopEngines """
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+class LoopEngines(object):
+    """ Creates an AsyncEngine, with a connection pool of its own, for each
+    event loop. Drivers like asyncpg bind connections to the loop that opened
+    them, while run keeps a loop per thread, so unless the engine uses
+    NullPool sessions should be bound to the engine of the current loop:
+
+    engines = LoopEngines('postgresql+asyncpg://localhost/db')
+    session = async_scoped_session(
+        lambda: AsyncSession(bind=engines.current()),
+        scopefunc=asyncio.current_task)
+    """
+
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self.kwargs = kwargs
+        self._engines = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def current(self):
+        """ The engine of the running event loop, created when first used """
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            engine = self._engines.get(loop)
+            if engine is None:
+                engine = self._engines[loop] = create_async_engine(
+                    self.url, **self.kwargs)
+        return engine
+
+
+class AsyncAPI(API):
+    """ A counterpart to API whose request methods are coroutines executing
+    statements on an AsyncSession, which should be set as the session,
+    normally an async_scoped_session scoped to the current task. Pre and post
+    hooks may be coroutine functions.
+
+    Work that may lazy load, such as ACL checks, model actions and join
+    profiles, is run with AsyncSession.run_sync. Search and pagination don't
+    touch the database and build select statements with the methods of API.
+    Streaming, conditional gets, aggregates, bulk creates and batches aren't
+    supported.
+
+    dispatch is the coroutine handling a request, with the error semantics of
+    API.dispatch_request. dispatch_request runs it to completion with run,
+    for WSGI applications. """
+
+    def dispatch_request(self, *args, **kwargs):
+        return run(self.dispatch(*args, **kwargs))
+
+    async def dispatch(self, *args, **kwargs):
+        method = self.batch_method or request.method
+        meth = getattr(self, method.lower(), None)
+        # if the request method is HEAD and we don't have a handler for it
+        # retry with GET
+        if meth is None and method == 'HEAD':
+            meth = getattr(self, 'get', None)
+        assert meth is not None, 'Unimplemented method %r' % method
+
+        try:
+            return await meth(*args, **kwargs)
+        except Exception:
+            info = sys.exc_info()
+        raise self.translate_exception(info).with_traceback(info[2])
+
+    async def hooks(self, hooks, *args):
+        """ Runs pre hooks, or post hooks with the value they're passed """
+        for method in hooks:
+            await _maybe_await(method(self, *args))
+
+    def run_sync(self, func):
+        """ Calls func with the synchronous session behind the AsyncSession,
+        in a greenlet where it can lazy load attributes. Context locals are
+        kept per greenlet, so the current Flask contexts are put on the stacks
+        of the new greenlet as well. They're pushed onto the stacks directly,
+        since popping the contexts themselves would tear the request down """
+        app_ctx = _app_ctx_stack.top
+        req_ctx = _request_ctx_stack.top
+
+        def call(session):
+            _app_ctx_stack.push(app_ctx)
+            _request_ctx_stack.push(req_ctx)
+            try:
+                return func(session)
+            finally:
+                _request_ctx_stack.pop()
+                _app_ctx_stack.pop()
+        return self.session.run_sync(call)
+
+    def base_query(self, join_prof=None):
+        """ Builds the select statement that reads start from, eagerly loading
+        what the join profile serializes """
+        query = select(self.model)
+        if join_prof is not None and self.eager_load:
+            columns = () if self.view_filtered else self.acl_columns()
+            query = query.options(*compile_join(
+                self.model, join_prof).loader_options(columns))
+        return query
+
+    async def get_obj(self, query=None):
+        pkey = self.params.pop(self.pkey_val, None)
+        if pkey:  # if a int primary key is passed
+            if query is None:
+                query = select(self.model)
+            result = await self.session.execute(query.filter(self.pkey == pkey))
+            return result.scalar_one()
+        return False
+
+    async def get_objs(self, keys, query=None):
+        """ Loads the objects with a list of primary keys using a single IN
+        query. Returns them in the order the keys were given and the list of
+        keys that weren't found """
+        if query is None:
+            query = select(self.model)
+        result = await self.session.execute(query.filter(self.pkey.in_(keys)))
+        # keys may arrive as strings or numbers, compare them as text
+        found = dict((str(getattr(obj, self.pkey_val)), obj)
+                     for obj in result.scalars())
+        objs = []
+        missing = []
+        for key in keys:
+            obj = found.get(str(key))
+            if obj is None:
+                missing.append(key)
+            else:
+                objs.append(obj)
+        return objs, missing
+
+    async def count(self, query, search_key, exact=True):
+        """ Returns the total number of rows matching a search statement as a
+        dictionary to merge into the response, see API.count """
+        count = self.cached_count(search_key)
+        if count is None:
+            estimate = self.estimate_count(query)
+            if estimate is not None:
+                count = dict(count=estimate, count_estimated=True)
+            elif not exact:
+                return None
+            else:
+                stmt = select(sqlalchemy.func.count()).select_from(
+                    query.order_by(None).subquery())
+                count = dict(count=(await self.session.execute(stmt)).scalar())
+            self.cache_count(search_key, count)
+        return count
+
+    async def commit(self):
+        """ Commits the session, then invalidates cached results read from the
+        tables of the model and cache_tables """
+        await self.session.commit()
+        tables = set(t.name for t in
+                     sqlalchemy.orm.class_mapper(self.model).tables)
+        invalidate_tables(tables | set(self.cache_tables))
+
+    async def get(self):
+        """ Retrieve an object from the database """
+        self.params = self.request_params(args=True)
+        await self.hooks(self._pre_method.get('get', []))
+        join = self.params.pop('join_prof', 'standard_join')
+        cache_key = self.result_key(join)
+        if cache_key is not None:
+            response = self.cached_response(cache_key)
+            if response is not None:
+                return response
+        response = await self.read(join)
+        if (cache_key is not None and response.status_code == 200 and
+                not self.head_only):
+            self.cache_response(cache_key, response)
+        return response
+
+    async def read(self, join):
+        """ Loads and serializes the objects requested by a get, after the pre
+        hooks have run """
+        if '__aggregate' in self.params or '__group_by' in self.params:
+            raise LeverSyntaxError("Aggregates aren't supported")
+        self.restrict_fields(join)
+        view_filter = self.view_filter(join)
+        self.view_filtered = view_filter is not None
+        query = self.base_query(self.serialized_join(join))
+        if view_filter is not None:
+            query = query.filter(view_filter)
+        keys = self.pkey_list()
+        if keys is not None:
+            objs, missing = await self.get_objs(keys, query=query)
+            retval = dict(success=True, missing=missing)
+            await self.run_sync(
+                lambda session: self.render_many(objs, join, retval))
+        else:
+            obj = await self.get_obj(query=query)
+            retval = dict(success=True)
+            if obj:
+                objs = [obj]
+            else:
+                with_count = self.params.pop('__with_count', None)
+                if with_count:
+                    # the key has to be taken before search consumes the
+                    # params
+                    search_key = self.search_key()
+                query = self.search(query=query)
+                if self.params.pop('__one', None):
+                    result = await self.session.execute(query)
+                    objs = [result.scalar_one()]
+                else:
+                    page = self.paginate(query=query)
+                    if with_count:
+                        retval.update(await self.count(query, search_key))
+                    result = await self.session.execute(page)
+                    objs = result.scalars().all()
+            await self.run_sync(lambda session: self.render(objs, join, retval))
+
+        await self.hooks(self._post_method.get('get', []), retval)
+        return self.respond(retval)
+
+    def render(self, objs, join, retval):
+        """ Checks and serializes the objects of a get into retval """
+        self.check_view(objs, join)
+        retval['objects'] = get_joined(objs, self.serialized_join(join))
+        if self.cursor_ordering is not None:
+            retval['next_cursor'] = self.next_cursor(
+                objs[-1] if objs else None, len(objs))
+
+    def render_many(self, objs, join, retval):
+        """ Serializes the objects of a get by a list of primary keys into
+        retval, reporting those that can't be viewed as missing """
+        if not self.view_filtered:
+            self.preload_acl(objs)
+            for obj in [o for o in objs if not self.can(o, 'view_' + join)]:
+                objs.remove(obj)
+                retval['missing'].append(getattr(obj, self.pkey_val))
+        retval['objects'] = get_joined(objs, self.serialized_join(join))
+
+    async def post(self):
+        """ Perform an action on an object or class """
+        self.params = self.request_params() or {}
+        if isinstance(self.params, list) or '__bulk' in self.params:
+            raise LeverSyntaxError("Bulk creates aren't supported")
+        self.action = self.params.pop('__action', None)
+        cls = self.params.pop('__cls', None)
+        if not self.action:
+            cls = True
+            self.action = self.create_method
+        await self.hooks(self._pre_method.get('post', []))
+        await self.hooks(self._pre_method.get(self.action, []))
+
+        if not cls:
+            obj = await self.get_obj()
+            if not obj:
+                raise LeverNotFound(
+                    "Could not find any object to perform an action on")
+            allowed = await self.run_sync(
+                lambda session: self.can(obj, 'action_' + self.action))
+            assert allowed, "Cant perform action " + self.action
+        else:
+            allowed = await self.run_sync(
+                lambda session: self.can_cls('action_' + self.action))
+            assert allowed, "Can't perform cls action " + self.action
+            obj = self.model
+
+        try:
+            if self.action == '__init__':
+                ret = obj(**self.params)
+                self.session.add(ret)
+                await self.session.flush()
+            else:
+                ret = await _maybe_await(await self.run_sync(
+                    lambda session: getattr(obj, self.action)(**self.params)))
+        except TypeError as e:
+            if 'argument' in str(e):
+                msg = ("Wrong number of arguments supplied for action {0}."
+                       .format(self.action))
+                raise LeverSyntaxError(msg).with_traceback(sys.exc_info()[2])
+            raise
+
+        for method in self._post_action.get(self.action, []):
+            ret = await _maybe_await(method(self, ret))
+        for method in self._post_method.get('post', []):
+            ret = await _maybe_await(method(self, ret))
+
+        retval = {}
+        if ret is None or ret is True:
+            retval['success'] = True
+        elif ret is False:
+            retval['success'] = False
+        elif hasattr(ret, '__table__'):
+            await self.session.flush()
+            retval['objects'] = [
+                await self.run_sync(lambda session: get_joined(ret))]
+            retval['success'] = True
+        elif isinstance(ret, dict):
+            retval.update(ret)
+        else:
+            retval['success'] = False
+
+        await self.commit()
+        return self.respond(retval)
+
+    async def put(self):
+        """ Updates an objects values """
+        self.params = self.request_params()
+        await self.hooks(self._pre_method.get('put', []))
+        if not self.params:
+            raise LeverSyntaxError("To update, values must be specified")
+        if self.writes_many():
+            retval = {'success': True, 'count': await self.write_many()}
+        else:
+            obj = await self.get_obj()
+            if not obj:
+                raise LeverNotFound("Could not find any object to update")
+            actions = ['edit_' + key for key in self.params]
+            await self.run_sync(
+                lambda session: self.write_objs([obj], self.params, actions,
+                                                False, session))
+            await self.commit()
+            retval = {'success': True}
+        await self.hooks(self._post_method.get('put', []), retval)
+        return self.respond(retval)
+
+    async def delete(self):
+        self.params = self.request_params()
+        await self.hooks(self._pre_method.get('delete', []))
+        if not self.params:
+            raise LeverSyntaxError("To delete, values must be specified")
+
+        if self.writes_many():
+            retval = {'success': True,
+                      'count': await self.write_many(delete=True)}
+        else:
+            obj = await self.get_obj()
+            if not obj:
+                raise LeverNotFound("Could not find any object to delete")
+            allowed = await self.run_sync(
+                lambda session: self.can(obj, 'delete'))
+            assert allowed, "Can't delete that object"
+            await self.session.delete(obj)
+            await self.commit()
+            retval = {'success': True}
+        await self.hooks(self._post_method.get('delete', []), retval)
+        return self.respond(retval)
+
+    async def write_many(self, delete=False):
+        """ Updates or deletes the objects matched by a search, see
+        API.write_many """
+        query, pkey, values, actions = self.write_search(
+            select(self.model), delete)
+
+        if self.bulk_writes:
+            self.check_bulk_write(values, actions)
+            await self.session.flush()
+            if delete:
+                stmt = sqlalchemy.delete(self.model)
+            else:
+                stmt = sqlalchemy.update(self.model).values(values)
+            if query.whereclause is not None:
+                stmt = stmt.where(query.whereclause)
+            result = await self.session.execute(
+                stmt.execution_options(synchronize_session=False))
+            count = result.rowcount
+            self.session.expire_all()
+        else:
+            if self.max_bulk_size is not None:
+                query = query.limit(self.max_bulk_size + 1)
+            objs = (await self.session.execute(query)).scalars().all()
+            await self.run_sync(
+                lambda session: self.write_objs(objs, values, actions, delete,
+                                                session))
+            count = len(objs)
+
+        if pkey is not None and not count:
+            raise LeverNotFound("Could not find any object to {0}"
+                                .format('delete' if delete else 'update'))
+        await self.commit()
+        return count
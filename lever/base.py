@@ -1,13 +1,25 @@
 from flask.views import MethodView, MethodViewType
-from flask import jsonify, current_app, request
+from flask import current_app, request, stream_with_context
 
+import base64
+import hashlib
 import json
 import six
 import sqlalchemy
 import sys
-import calendar
+import time
+import collections
+import csv
 import datetime
+import decimal
+import itertools
+import operator
+import threading
 import traceback
+import uuid
+
+from .cache import invalidate_tables
+from .encoders import get_encoder
 
 
 class LeverException(Exception):
@@ -101,6 +113,18 @@ OPERATORS = {
 }
 
 
+# aggregate functions for __aggregate, taking the column to aggregate or
+# None for count, which then counts the rows
+AGGREGATES = {
+    'count': lambda f: sqlalchemy.func.count(f) if f is not None
+    else sqlalchemy.func.count(),
+    'sum': lambda f: sqlalchemy.func.sum(f),
+    'avg': lambda f: sqlalchemy.func.avg(f),
+    'min': lambda f: sqlalchemy.func.min(f),
+    'max': lambda f: sqlalchemy.func.max(f),
+}
+
+
 class preprocess(object):
     """ Simple decorator that sets special attributes on decorated methods.
     These attributes get picked up by our __new__ method and assign
@@ -161,9 +185,36 @@ class ModelBasedACL(object):
     def can(self, obj, action):
         return obj.can(action)
 
+    def acl_columns(self):
+        # roles can read any column of the model unless it lists them
+        return getattr(self.model, 'acl_columns', None)
+
+    def view_filter(self, join):
+        acl_filter = getattr(self.model, 'acl_filter', None)
+        if acl_filter is None:
+            return None
+        return acl_filter('view_' + join)
+
+    def acl_fingerprint(self):
+        from flask.ext.login import current_user
+        get_id = getattr(current_user, 'get_id', None)
+        return [get_id() if get_id else None,
+                sorted(current_user.global_roles())]
+
     def can_cls(self, action):
         return self.model.can_cls(action, **self.params)
 
+    def preload_acl(self, objs):
+        # models can implement can without the role helpers of BaseMapper
+        preload_roles = getattr(self.model, 'preload_roles', None)
+        if preload_roles is not None:
+            preload_roles(objs)
+
+    def release_acl(self, objs):
+        forget_acl = getattr(self.model, 'forget_acl', None)
+        if forget_acl is not None:
+            forget_acl(objs)
+
 
 class APIMeta(MethodViewType):
     def __init__(mcs, name, bases, dct):
@@ -218,10 +269,78 @@ class API(six.with_metaclass(APIMeta, MethodView)):
     # defines the primary key for your model. this value will be expected on
     # get and updates
     create_method = '__init__'
+    max_bulk_size = 1000
+    # the most objects a single bulk create can make, or a put or delete by
+    # search can check with can
+    bulk_writes = False
+    # declares that can_cls is enough to allow puts and deletes, letting them
+    # run as one UPDATE or DELETE statement without loading the objects
+    eager_load = True
+    # eagerly load the relationships that the requested join profile will
+    # serialize, instead of lazy loading them for every object
+    stream = False
+    # stream list responses one object at a time instead of building the
+    # whole response in memory. Clients can also request it with __stream
+    stream_chunk_size = 100
+    # number of rows fetched from the database at a time when streaming
+    allow_export = False
+    # allow every object matching a search to be streamed in one response
+    # with __export
+    export_max_rows = None
+    # the most rows an export can contain
+    export_workers = None
+    # the most worker processes an export can be split between with
+    # __export_workers. Parallel exports are disabled when None
+    export_partition_size = 10000
+    # number of rows each worker of a parallel export serializes at a time
+    max_groups = 1000
+    # the most groups a __group_by can return. Larger results are truncated
+    cursor_pagination = False
+    # page with cursors even when the client doesn't pass __after
+    search_cache_size = 128
+    # number of search shapes whose expressions are cached
+    count_ttl = None
+    # seconds to cache the totals returned for __with_count, keyed on the
+    # search parameters. Useful for tables too large to count every request
     params = {}
+    sparse_join = None
+    # the join profile built from __fields for the current get, which objects
+    # are loaded and serialized with in place of the requested one
+    ordering = ()
+    # list of (key, descending) pairs set by search from __order_by
+    cursor_ordering = None
+    # the ordering used by keyset pagination for the current request
+    view_filtered = False
+    # whether the current request's query was limited by view_filter
+    etag_attr = None
+    # attribute ETags are built from, see version_attr
+    wants_etag = False
+    etag = None
+    head_only = False
+    # conditional request state for the current request
+    result_cache = None
+    # a ResultCache from lever.cache storing the encoded responses of gets.
+    # Get post hooks should only add data the cache key covers
+    cache_tables = ()
+    # names of tables, besides those the join profile reads, that responses
+    # depend on or writes through this API change
+    batch = None
+    batch_params = None
+    batch_method = None
+    # the BatchAPI running this request as part of a batch, and the params and
+    # method it passed
+    encoder = None
+    # the name of an encoder from lever.encoders, or an Encoder, that
+    # responses are encoded with. Defaults to the LEVER_ENCODER config value
     session = None
     # The database session from SQLAlchemy
 
+    def __init__(self, batch=None, batch_params=None, batch_method=None):
+        # as_view passes these through when a batch runs the view
+        self.batch = batch
+        self.batch_params = batch_params
+        self.batch_method = batch_method
+
     @property
     def pkey(self):
         try:
@@ -232,12 +351,13 @@ class API(six.with_metaclass(APIMeta, MethodView)):
                 .format(self.model.__class__.__name__))
 
     def dispatch_request(self, *args, **kwargs):
-        meth = getattr(self, request.method.lower(), None)
+        method = self.batch_method or request.method
+        meth = getattr(self, method.lower(), None)
         # if the request method is HEAD and we don't have a handler for it
         # retry with GET
-        if meth is None and request.method == 'HEAD':
+        if meth is None and method == 'HEAD':
             meth = getattr(self, 'get', None)
-        assert meth is not None, 'Unimplemented method %r' % request.method
+        assert meth is not None, 'Unimplemented method %r' % method
 
         try:
             return meth(*args, **kwargs)
@@ -245,6 +365,13 @@ class API(six.with_metaclass(APIMeta, MethodView)):
             # capture the info
             info = sys.exc_info()
 
+        exc = self.translate_exception(info)
+        six.reraise(LeverException, exc, tb=info[2])
+
+    def translate_exception(self, info):
+        """ Converts the exc_info of an exception raised while handling a
+        request into a LeverException with the status code and end user
+        information to respond with. Unrecognized exceptions are reraised """
         extra = {'original_exc': str(info[1]),
                  'original_exc_type': str(info[0]),
                  'tb': "".join(traceback.format_tb(info[2])),
@@ -273,7 +400,7 @@ class API(six.with_metaclass(APIMeta, MethodView)):
             extra.update(e.extra)
             e.extra = extra
             e.end_user = end_user
-            six.reraise(LeverException, e, tb=sys.exc_info()[2])
+            return e
 
         # SQLAlchemy exceptions
         except sqlalchemy.orm.exc.NoResultFound:
@@ -298,15 +425,105 @@ class API(six.with_metaclass(APIMeta, MethodView)):
             raise
 
         # get our exception info and try to extract extra information out of it
-        exc = LeverException(msg, code=code, extra=extra, end_user=end_user)
-        six.reraise(LeverException, exc, tb=info[2])
+        return LeverException(msg, code=code, extra=extra, end_user=end_user)
+
+    def respond(self, retval):
+        """ Builds a response with a dictionary encoded as its body """
+        encoder = get_encoder(self.encoder)
+        return current_app.response_class(encoder.dumps(retval),
+                                          mimetype=encoder.mimetype)
+
+    def request_params(self, args=False):
+        """ Returns the params of the request, the query string arguments if
+        args is true and the JSON body otherwise. Requests run by a batch use
+        the params the batch gives instead """
+        if self.batch_params is not None:
+            return self.batch_params
+        if args:
+            return dict((one, two) for one, two in six.iteritems(request.args))
+        return request.get_json(silent=True)
+
+    def base_query(self, join_prof=None):
+        """ Builds the query that reads start from. If a join profile is given
+        and eager loading is enabled, the relationships that the profile will
+        serialize are loaded up front """
+        query = self.session.query(self.model)
+        if join_prof is not None and self.eager_load:
+            # the columns can reads aren't needed when view_filter replaces
+            # the per object checks
+            columns = () if self.view_filtered else self.acl_columns()
+            query = query.options(*compile_join(
+                self.model, join_prof).loader_options(columns))
+            # ETags are computed from the loaded objects
+            version = self.version_attr()
+            if version is not None:
+                query = query.options(
+                    sqlalchemy.orm.undefer(getattr(self.model, version)))
+        return query
 
-    def get_obj(self):
+    def get_obj(self, query=None):
         pkey = self.params.pop(self.pkey_val, None)
         if pkey:  # if a int primary key is passed
-            return self.session.query(self.model).filter(self.pkey == pkey).one()
+            if query is None:
+                query = self.session.query(self.model)
+            return query.filter(self.pkey == pkey).one()
         return False
 
+    def pkey_list(self):
+        """ Pops a JSON list of primary keys passed in place of a single
+        primary key. Returns None if the parameter isn't a list """
+        keys = self.params.get(self.pkey_val)
+        if isinstance(keys, six.string_types) and keys.startswith('['):
+            keys = safe_json(keys)
+        if not isinstance(keys, list):
+            return None
+        self.params.pop(self.pkey_val)
+        if self.max_pg_size is not None and len(keys) > self.max_pg_size:
+            raise LeverSyntaxError(
+                "Can't request more than {0} objects at once"
+                .format(self.max_pg_size))
+        return keys
+
+    def get_objs(self, keys, query=None):
+        """ Loads the objects with a list of primary keys using a single IN
+        query. Objects already in the session's identity map are used
+        directly unless the query is limited by view_filter. Returns the
+        objects in the order the keys were given and a list of the keys that
+        weren't found """
+        if query is None:
+            query = self.session.query(self.model)
+        mapper = sqlalchemy.orm.class_mapper(self.model)
+        # the identity map can only be used when pkey_val is the primary key
+        use_identity = (not self.view_filtered and
+                        _mapped_keys(mapper, mapper.primary_key) ==
+                        [self.pkey_val])
+
+        # keys may arrive as strings or numbers, compare them as text
+        found = {}
+        remaining = []
+        for key in keys:
+            obj = None
+            if use_identity:
+                obj = self.session.identity_map.get(
+                    mapper.identity_key_from_primary_key([key]))
+            if obj is not None:
+                found[six.text_type(key)] = obj
+            elif key not in remaining:
+                remaining.append(key)
+        if remaining:
+            for obj in query.filter(self.pkey.in_(remaining)):
+                found[six.text_type(getattr(obj, self.pkey_val))] = obj
+
+        objs = []
+        missing = []
+        for key in keys:
+            obj = found.get(six.text_type(key))
+            if obj is None:
+                missing.append(key)
+            else:
+                objs.append(obj)
+        return objs, missing
+
     def can(self, obj, action):
         """ This function should parse the current parameters to gain parent
         information for properly running can_cls on the model this API wraps
@@ -319,35 +536,711 @@ class API(six.with_metaclass(APIMeta, MethodView)):
         """
         return True
 
+    def preload_acl(self, objs):
+        """ Called with every page of objects before they're checked with can,
+        allowing the information needed for the checks to be loaded in bulk
+        """
+        pass
+
+    def release_acl(self, objs):
+        """ Called with objects that won't be checked again, like the chunks
+        of an export once they're written, so anything preload_acl or can
+        stored about them can be dropped """
+        pass
+
+    def view_filter(self, join):
+        """ Can return a SQLAlchemy filter clause matching only the objects the
+        current user can view with join. Gets apply it to the query, making
+        pages dense and skipping the per object checks with can. The default
+        of None checks each object instead """
+        return None
+
+    def acl_columns(self):
+        """ The names of the columns can reads on the objects it checks, which
+        are loaded along with the ones the join profile serializes. None
+        loads every column. The default can reads none """
+        return ()
+
+    def acl_fingerprint(self):
+        """ A JSON serializable value identifying everything about the current
+        user that the ACL depends on. Used to key cached values that differ
+        between users """
+        return None
+
+    def check_view(self, objs, join):
+        """ Asserts the current user can view each of objs with the join
+        profile. Nothing is checked when the query was limited by
+        view_filter """
+        if self.view_filtered:
+            return
+        self.preload_acl(objs)
+        for obj in objs:
+            assert self.can(obj, 'view_' + join), "Can't view that object with join " + join
+
     def get(self):
         """ Retrieve an object from the database """
         # convert args to a real dictionary that can be popped
-        self.params = dict((one, two) for one, two in six.iteritems(request.args))
+        self.params = self.request_params(args=True)
         for method in self._pre_method.get('get', []):
             method(self)
         join = self.params.pop('join_prof', 'standard_join')
-        obj = self.get_obj()
+        cache_key = self.result_key(join)
+        if cache_key is not None:
+            response = self.cached_response(cache_key)
+            if response is not None:
+                return response
+        response = self.read(join)
+        # streamed bodies aren't available to store, and HEAD responses may
+        # have been answered without one
+        if (cache_key is not None and response.status_code == 200 and
+                not response.is_streamed and not self.head_only):
+            self.cache_response(cache_key, response)
+        return response
+
+    def read(self, join):
+        """ Loads and serializes the objects requested by a get, after the pre
+        hooks have run """
+        if '__aggregate' in self.params or '__group_by' in self.params:
+            return self.aggregate(join)
+        self.restrict_fields(join)
+        prof = self.serialized_join(join)
+        view_filter = self.view_filter(join)
+        self.view_filtered = view_filter is not None
+        query = self.base_query(prof)
+        if view_filter is not None:
+            query = query.filter(view_filter)
+        export = self.params.pop('__export', None)
+        if export:
+            return self.export(query, join, export)
+        keys = self.pkey_list()
+        if keys is not None:
+            objs, missing = self.get_objs(keys, query=query)
+            if not self.view_filtered:
+                # objects that can't be viewed are reported as missing, like
+                # the access denied errors
+                self.preload_acl(objs)
+                for obj in [o for o in objs
+                            if not self.can(o, 'view_' + join)]:
+                    objs.remove(obj)
+                    missing.append(getattr(obj, self.pkey_val))
+            retval = dict(success=True, objects=get_joined(objs, prof),
+                          missing=missing)
+            for method in self._post_method.get('get', []):
+                method(self, retval)
+            return self.respond(retval)
+
+        pkey = self.params.get(self.pkey_val)
+        if pkey:
+            response = self.conditional(query.filter(self.pkey == pkey), join,
+                                        single=True)
+            if response is not None:
+                return response
+        obj = self.get_obj(query=query)
         if obj:  # if a int primary key is passed
-            assert self.can(obj, 'view_' + join), "Can't view that object with join " + join
-            retval = dict(success=True, objects=[get_joined(obj, join)])
+            self.check_view([obj], join)
+            objs = [obj]
+            response = self.loaded_conditional(objs, join)
+            if response is not None:
+                return response
+            retval = dict(success=True, objects=[get_joined(obj, prof)])
         else:
-            query = self.search()
+            with_count = self.params.pop('__with_count', None)
+            if with_count:
+                # the key has to be taken before search consumes the params
+                search_key = self.search_key()
+            query = self.search(query=query)
             one = self.params.pop('__one', None)
+            stream = self.params.pop('__stream', None) or self.stream
+            retval = dict(success=True)
             if one:
-                query = [query.one()]
+                objs = [query.one()]
+            elif stream:
+                page = self.paginate(query=query)
+                if with_count:
+                    retval.update(self.count(query, search_key))
+                return self.stream_objects(page, join, retval=retval)
+            elif with_count:
+                objs, count = self.paginate_with_count(query, search_key)
+                retval.update(count)
             else:
-                query = self.paginate(query=query)
-            for obj in query:
-                assert self.can(obj, 'view_' + join), "Can't view that object with join " + join
-            retval = dict(success=True, objects=get_joined(query, join))
+                page = self.paginate(query=query)
+                response = self.conditional(page, join)
+                if response is not None:
+                    return response
+                objs = page.all()
+            self.check_view(objs, join)
+            response = self.loaded_conditional(objs, join)
+            if response is not None:
+                return response
+            retval['objects'] = get_joined(objs, prof)
+            if self.cursor_ordering is not None:
+                retval['next_cursor'] = self.next_cursor(
+                    objs[-1] if objs else None, len(objs))
 
         for method in self._post_method.get('get', []):
             method(self, retval)
-        return jsonify(**retval)
+        response = self.respond(retval)
+        if self.etag is not None:
+            response.set_etag(self.etag)
+        return response
+
+    def aggregate(self, join):
+        """ Answers a get with __aggregate or __group_by by computing
+        aggregates of the rows matching __filter and __filter_by in the
+        database. __aggregate is a list of dictionaries with an op, one of
+        count, sum, avg, min and max, and the name of a column, which count
+        can leave out to count rows. Each result is keyed by op_name, or op
+        when there's no name, unless a key is given. It defaults to counting.
+
+        Without __group_by the aggregates are returned under aggregates.
+        __group_by can be a list of columns, returning groups, a list with
+        the values of the columns and the aggregates for each combination.
+        A list of lists of columns computes each grouping separately,
+        returning facets, a list of dictionaries with the group_by and its
+        groups. Groups are ordered by their columns unless __order_by lists
+        grouped columns or aggregate keys. Groupings with more than max_groups
+        groups are truncated and flagged as such.
+
+        The class permission aggregate is needed, and view_filter applies,
+        but rows aren't checked with can. Post get hooks aren't run. """
+        assert self.can_cls('aggregate'), "Can't aggregate"
+        aggregates = self.params.pop('__aggregate', None)
+        group_by = self.params.pop('__group_by', None)
+        order_by = self.params.pop('__order_by', None)
+        if isinstance(aggregates, six.string_types):
+            aggregates = safe_json(aggregates)
+        if isinstance(group_by, six.string_types):
+            group_by = safe_json(group_by)
+        if isinstance(order_by, six.string_types):
+            order_by = safe_json(order_by)
+        if aggregates is None:
+            aggregates = [{'op': 'count'}]
+        if not isinstance(aggregates, list) or not aggregates:
+            raise LeverSyntaxError("__aggregate must be a list of aggregates")
+
+        columns = []
+        for agg in aggregates:
+            try:
+                op = agg['op']
+                name = agg.get('name')
+            except (KeyError, TypeError, AttributeError):
+                raise LeverSyntaxError(
+                    'Aggregate "{0}" was missing required arguments'
+                    .format(agg))
+            func = AGGREGATES.get(op)
+            if func is None or (name is None and op != 'count'):
+                raise LeverSyntaxError('Invalid aggregate "{0}"'.format(agg))
+            col = None if name is None else self.aggregate_column(name)
+            key = agg.get('key') or (op if name is None else op + '_' + name)
+            columns.append(func(col).label(key))
+
+        if group_by is not None and not isinstance(group_by, list):
+            raise LeverSyntaxError("__group_by must be a list of columns")
+        faceted = bool(group_by) and \
+            all(isinstance(g, list) for g in group_by)
+        groupings = group_by if faceted else [group_by] if group_by else []
+
+        known = set(c.key for c in columns)
+        for grouping in groupings:
+            for name in grouping:
+                self.aggregate_column(name)
+                known.add(name)
+        for key in order_by or ():
+            if not isinstance(key, six.string_types) or \
+                    key.lstrip('-') not in known:
+                raise LeverSyntaxError(
+                    'Order_by operator "{0}" accessed invalid field'
+                    .format(key))
+
+        query = self.session.query(*columns).select_from(self.model)
+        view_filter = self.view_filter(join)
+        if view_filter is not None:
+            query = query.filter(view_filter)
+            self.view_filtered = True
+        query = self.search(query=query)
+
+        retval = dict(success=True)
+        if not groupings:
+            retval['aggregates'] = self.aggregate_row(query.one())
+        else:
+            facets = []
+            for grouping in groupings:
+                groups, truncated = self.aggregate_groups(
+                    query, grouping, columns, order_by)
+                facets.append(dict(group_by=grouping, groups=groups,
+                                   truncated=truncated))
+            if faceted:
+                retval['facets'] = facets
+            else:
+                retval['groups'] = facets[0]['groups']
+                retval['truncated'] = facets[0]['truncated']
+        return self.respond(retval)
+
+    def aggregate_column(self, name):
+        """ Returns the column of the model named by an aggregate or group_by,
+        which must be a mapped column """
+        prop = sqlalchemy.orm.class_mapper(self.model).column_attrs.get(name) \
+            if isinstance(name, six.string_types) else None
+        if prop is None:
+            raise LeverSyntaxError(
+                'Aggregate accessed invalid field "{0}"'.format(name))
+        return getattr(self.model, name)
+
+    def aggregate_groups(self, query, grouping, columns, order_by):
+        """ Runs the aggregate query grouped by the columns named in grouping,
+        returning the groups and whether there were more than max_groups """
+        keys = [c.key for c in columns]
+        group_cols = []
+        for name in grouping:
+            if name in keys:
+                raise LeverSyntaxError(
+                    'Group by "{0}" conflicts with an aggregate key'
+                    .format(name))
+            group_cols.append(self.aggregate_column(name).label(name))
+        labels = dict((c.key, c) for c in group_cols + columns)
+
+        # the columns of the grouping break ties, and facets skip keys
+        # belonging to other groupings
+        ordering = []
+        for key in list(order_by or ()) + list(grouping):
+            desc = key.startswith('-')
+            col = labels.get(key[1:] if desc else key)
+            if col is not None:
+                # ordering by the label reuses the expression in the select
+                # list
+                ordering.append(sqlalchemy.desc(col.key) if desc else
+                                sqlalchemy.asc(col.key))
+
+        query = query.with_entities(*(group_cols + columns)).\
+            group_by(*[c.element for c in group_cols]).order_by(*ordering)
+        if self.max_groups is not None:
+            query = query.limit(self.max_groups + 1)
+        rows = query.all()
+        truncated = self.max_groups is not None and \
+            len(rows) > self.max_groups
+        if truncated:
+            rows = rows[:self.max_groups]
+        return [self.aggregate_row(row) for row in rows], truncated
+
+    def aggregate_row(self, row):
+        """ Converts a row of aggregate results into a dictionary, converting
+        values like serialized columns except for decimals, which databases
+        return for sums and averages of many types and are kept numbers """
+        return dict((key, _aggregate_value(val))
+                    for key, val in six.iteritems(row._asdict()))
+
+    def restrict_fields(self, join):
+        """ Builds sparse_join from __fields, a list of the fields out of the
+        join profile to serialize, given as JSON or separated by commas.
+        Fields of nested objects are named by their path, for instance
+        comments.author.username. Columns and relationships left out aren't
+        loaded """
+        fields = self.params.pop('__fields', None)
+        if fields is None:
+            return
+        if isinstance(fields, six.string_types):
+            fields = safe_json(fields) if fields.startswith('[') else \
+                fields.split(',')
+        if not isinstance(fields, list) or not fields or not all(
+                isinstance(f, six.string_types) and f.strip() for f in fields):
+            raise LeverSyntaxError("__fields must be a list of field names")
+        self.sparse_join = restrict_join(
+            self.model, join, [f.strip().split('.') for f in fields])
+
+    def serialized_join(self, join):
+        """ The join profile objects are loaded and serialized with """
+        return join if self.sparse_join is None else self.sparse_join
+
+    def result_key(self, join):
+        """ The key the response to the current get is stored under in
+        result_cache, or None when results aren't cached. It covers the search,
+        pagination and other parameters, the join profile, cache_fingerprint
+        and the generations of every table the response is read from.
+
+        APIs that override can, can_cls or view_filter without a fingerprint
+        telling users apart would serve one user's response to all of them,
+        so their results aren't cached unless cache_fingerprint is overriden
+        as well """
+        if self.result_cache is None:
+            return None
+        fingerprint = self.cache_fingerprint()
+        if fingerprint is None and not _overrides(self, 'cache_fingerprint') \
+                and any(_overrides(self, name)
+                        for name in ('can', 'can_cls', 'view_filter')):
+            return None
+        params = dict((k, v) for k, v in six.iteritems(self.params)
+                      if k not in ('__filter', '__filter_by', '__order_by'))
+        parts = [self.__class__.__module__, self.__class__.__name__, join,
+                 self.search_key(), params, fingerprint]
+        tables = compile_join(self.model, join).tables() | \
+            set(self.cache_tables)
+        return self.result_cache.make_key(parts, tables)
+
+    def cache_fingerprint(self):
+        """ Identifies everything about the current user that responses
+        depend on. Defaults to acl_fingerprint, but can be overriden to share
+        cached responses more widely, such as between users with the same
+        roles when the ACL doesn't depend on ownership """
+        return self.acl_fingerprint()
+
+    def cached_response(self, cache_key):
+        """ Builds a response from the result_cache entry for cache_key, or
+        returns None if there isn't one """
+        entry = self.result_cache.get(cache_key)
+        if entry is None:
+            return None
+        etag, body = entry.split(b'\n', 1)
+        etag = etag.decode('ascii')
+        if etag and request.if_none_match.contains(etag):
+            response = current_app.response_class(
+                status=304, mimetype='application/json')
+        else:
+            response = current_app.response_class(
+                body, mimetype='application/json')
+        if etag:
+            response.set_etag(etag)
+        return response
+
+    def cache_response(self, cache_key, response):
+        """ Stores the body and ETag of a get response in result_cache """
+        etag = response.get_etag()[0] or ''
+        self.result_cache.set(cache_key,
+                              etag.encode('ascii') + b'\n' + response.get_data())
+
+    def commit(self):
+        """ Commits the session, then invalidates cached results read from the
+        tables of the model and cache_tables. When run by an atomic batch the
+        session is only flushed, leaving the batch to commit """
+        tables = set(t.name for t in
+                     sqlalchemy.orm.class_mapper(self.model).tables)
+        tables |= set(self.cache_tables)
+        if self.batch is not None and self.batch.atomic:
+            self.session.flush()
+            self.batch.written |= tables
+            return
+        self.session.commit()
+        invalidate_tables(tables)
+
+    def head(self):
+        """ Answers HEAD requests by running get. See conditional for when
+        that can be done without loading the objects """
+        self.head_only = True
+        return self.get()
+
+    def version_attr(self):
+        """ The name of the attribute that changes whenever an object does,
+        which ETags are built from. It's etag_attr if set, then the mapper's
+        version_id_col, then an updated_at column. None disables ETags """
+        if self.etag_attr is not None:
+            return self.etag_attr
+        mapper = sqlalchemy.orm.class_mapper(self.model)
+        if mapper.version_id_col is not None:
+            return mapper.get_property_by_column(mapper.version_id_col).key
+        if 'updated_at' in mapper.column_attrs:
+            return 'updated_at'
+        return None
+
+    def make_etag(self, rows, join):
+        """ Builds an ETag from (primary key, version) pairs for the objects
+        in a response, along with everything else the body depends on """
+        data = json.dumps([[list(row) for row in rows], join,
+                           self.sparse_join, self.acl_fingerprint(),
+                           self.cursor_ordering],
+                          default=str, separators=(',', ':'))
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+    def conditional(self, query, join, single=False):
+        """ Handles conditional requests for a get that's about to load the
+        objects a query returns. When the query is limited by view_filter the
+        ETag is computed by a query for just the primary keys and versions of
+        the rows, without loading, checking or serializing any objects. If
+        it's in If-None-Match a 304 response is returned to send in place of
+        the full one, and HEAD requests are answered the same way.
+
+        Otherwise the objects have to be loaded for the per object ACL
+        checks before anything about them is revealed, so None is returned
+        and loaded_conditional compares the ETag once they've passed. None is
+        also returned when ETags are disabled or the single object requested
+        doesn't exist, so the normal error is raised. """
+        version = self.version_attr()
+        if version is None:
+            return None
+        self.wants_etag = True
+        if not self.view_filtered:
+            return None
+        if not request.if_none_match and not self.head_only:
+            return None
+
+        rows = query.with_entities(
+            self.pkey, getattr(self.model, version)).all()
+        if single and not rows:
+            return None
+        return self.not_modified(self.make_etag(rows, join),
+                                 head=self.head_only)
+
+    def loaded_conditional(self, objs, join):
+        """ Sets the ETag of a get from the objects it loaded, which must
+        have been checked with check_view, returning a 304 response if it's
+        in If-None-Match. Does nothing unless conditional enabled ETags or
+        when it already computed the ETag """
+        if not self.wants_etag or self.etag is not None:
+            return None
+        version = self.version_attr()
+        return self.not_modified(self.make_etag(
+            [(getattr(o, self.pkey_val), getattr(o, version)) for o in objs],
+            join))
+
+    def not_modified(self, etag, head=False):
+        """ Stores the ETag of the response and returns a bodiless response if
+        it's in If-None-Match. HEAD requests always get one, and otherwise
+        None is returned so the full response is built """
+        self.etag = etag
+        if request.if_none_match.contains(etag):
+            status = 304
+        elif head:
+            status = 200
+        else:
+            return None
+        response = current_app.response_class(status=status,
+                                              mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    def stream_objects(self, query, join, retval=None):
+        """ Builds a streaming response for a list get. Rows are fetched in
+        chunks of stream_chunk_size and each object is serialized and written
+        out on its own, so memory use doesn't grow with the size of the page.
+
+        Since the status code is sent before the objects, a failure part way
+        through can't become an error response. The success key is written
+        last instead, so a stream that fails ends with success false and a
+        message like any other error. """
+        if retval is None:
+            retval = dict(success=True)
+        for method in self._post_method.get('get', []):
+            method(self, retval)
+
+        prof = self.serialized_join(join)
+        chunks = _chunked(query.yield_per(self.stream_chunk_size),
+                          self.stream_chunk_size)
+        # fetch and check the first chunk before the response starts so
+        # errors in the query itself are reported normally
+        first = next(chunks, [])
+        self.check_view(first, join)
+        chunks = itertools.chain([first], chunks)
+        encoder = get_encoder(self.encoder)
+
+        def generate():
+            trailer = retval
+            # the last object and count are all the cursor needs
+            last, count = None, 0
+            yield b'{"objects":['
+            try:
+                for i, chunk in enumerate(chunks):
+                    if i:
+                        self.check_view(chunk, join)
+                    for obj in chunk:
+                        if count:
+                            yield b','
+                        yield encoder.dumps(get_joined(obj, prof))
+                        count += 1
+                    if chunk:
+                        last = chunk[-1]
+                if self.cursor_ordering is not None:
+                    trailer['next_cursor'] = self.next_cursor(last, count)
+            except AssertionError:
+                trailer = dict(success=False,
+                               message="You don't have permission to do that")
+            except Exception:
+                current_app.logger.error("Error while streaming response",
+                                         exc_info=True)
+                trailer = dict(success=False,
+                               message="An error occurred while streaming the "
+                               "response")
+            # splice the remaining keys in after the object list
+            yield b'],' + encoder.dumps(trailer)[1:]
+
+        return current_app.response_class(stream_with_context(generate()),
+                                          mimetype=encoder.mimetype)
+
+    def export(self, query, join, fmt):
+        """ Streams every object matching the search params as newline
+        delimited JSON, when fmt is ndjson, or CSV. Rows are read with a
+        server side cursor where the database supports one, in chunks of
+        stream_chunk_size, and each chunk is removed from the session once
+        it's written, so memory use stays constant however many rows match.
+
+        Objects in CSV exports are written with a column for each key of the
+        first, encoding nested objects as JSON. An NDJSON export that fails
+        part way ends with a line holding the error, while a CSV export is
+        aborted so it can't be mistaken for a complete file.
+
+        Passing __export_workers splits the export between that many worker
+        processes, see parallel_export. """
+        assert self.allow_export, "Exporting isn't allowed"
+        if fmt not in ('ndjson', 'csv'):
+            raise LeverSyntaxError("Unknown export format " + fmt)
+        workers = self.params.pop('__export_workers', None)
+        query = self.search(query=query)
+        if workers is not None:
+            return self.parallel_export(query, join, fmt, workers)
+        if self.export_max_rows is not None:
+            query = query.limit(self.export_max_rows)
+        query = query.execution_options(stream_results=True).\
+            yield_per(self.stream_chunk_size)
+
+        prof = self.serialized_join(join)
+        # objects the session already held, which aren't removed
+        keep = set(self.session.identity_map.keys())
+        chunks = _chunked(query, self.stream_chunk_size)
+        # fetch and check the first chunk before the response starts so
+        # errors in the query itself are reported normally
+        first = next(chunks, [])
+        self.check_view(first, join)
+        chunks = itertools.chain([first], chunks)
+        encoder = get_encoder(self.encoder)
+
+        def rows():
+            for i, chunk in enumerate(chunks):
+                if i:
+                    self.check_view(chunk, join)
+                for obj in chunk:
+                    yield get_joined(obj, prof)
+                # written objects are dropped, along with anything the ACL
+                # checks stored about them
+                self.release_acl(chunk)
+                for key in list(self.session.identity_map.keys()):
+                    if key not in keep:
+                        self.session.expunge(self.session.identity_map[key])
+
+        def ndjson():
+            try:
+                for row in rows():
+                    yield encoder.dumps(row) + b'\n'
+            except Exception as e:
+                current_app.logger.error("Error while exporting",
+                                         exc_info=True)
+                message = ("You don't have permission to do that"
+                           if isinstance(e, AssertionError) else
+                           "An error occurred while exporting")
+                yield encoder.dumps(dict(success=False,
+                                         message=message)) + b'\n'
+
+        def csv_rows():
+            header = None
+            out = six.StringIO()
+            writer = csv.writer(out)
+            try:
+                for row in rows():
+                    if header is None:
+                        header = sorted(row)
+                        writer.writerow(header)
+                    writer.writerow([_csv_value(row.get(key), encoder)
+                                     for key in header])
+                    yield out.getvalue()
+                    out.seek(0)
+                    out.truncate()
+            except Exception:
+                # the response has already started, so the error is raised
+                # again to abort it rather than end it like a whole file
+                current_app.logger.error("Error while exporting",
+                                         exc_info=True)
+                raise
+
+        if fmt == 'csv':
+            body, mimetype = csv_rows(), 'text/csv'
+        else:
+            body, mimetype = ndjson(), 'application/x-ndjson'
+        response = current_app.response_class(stream_with_context(body),
+                                              mimetype=mimetype)
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={0}.{1}'.format(
+                sqlalchemy.orm.class_mapper(self.model).local_table.name, fmt)
+        return response
+
+    def parallel_export(self, query, join, fmt, workers):
+        """ Exports the objects matched by a search query with a pool of
+        worker processes. The primary keys the query matches are split into
+        ranges of export_partition_size rows, which workers load and
+        serialize with an engine and session of their own. Partitions are
+        written in key order, so the export is ordered by primary key and
+        can't be given an __order_by. Only a couple of partitions per worker
+        are in flight at once, so memory use doesn't grow with the export.
+
+        Workers are forked, which requires a platform supporting fork and a
+        database other processes can connect to, so not an in memory SQLite
+        database. Objects aren't checked with can, so the class permission
+        export is needed, and view_filter still applies. Failures are
+        reported like those of a sequential export. """
+        from .export import (PartitionJob, partition_bounds,
+                             export_partitions, merge_partitions)
+        if not self.export_workers:
+            raise LeverSyntaxError("Parallel exports aren't enabled")
+        try:
+            workers = int(workers)
+        except (TypeError, ValueError):
+            raise LeverSyntaxError("__export_workers must be an integer")
+        workers = max(1, min(workers, self.export_workers))
+        assert self.can_cls('export'), "Can't export in parallel"
+        if self.ordering:
+            raise LeverSyntaxError(
+                "Parallel exports are ordered by primary key")
+        pkey_cols = sqlalchemy.orm.class_mapper(self.model).primary_key
+        if len(pkey_cols) != 1 or \
+                not isinstance(pkey_cols[0].type, sqlalchemy.Integer):
+            raise LeverSyntaxError(
+                "Parallel exports need a single integer primary key")
+
+        # the keys are scanned, without loading any rows, to split them into
+        # partitions of export_partition_size rows
+        keys = query.order_by(None).enable_eagerloads(False).\
+            with_entities(self.pkey).order_by(self.pkey)
+        if self.export_max_rows is not None:
+            keys = keys.limit(max(0, self.export_max_rows))
+        bounds = partition_bounds(
+            (key for key, in keys.yield_per(self.export_partition_size)),
+            self.export_partition_size)
+
+        job = PartitionJob(current_app._get_current_object(),
+                           query.order_by(None), self.pkey,
+                           self.serialized_join(join), fmt,
+                           self.encoder, self.stream_chunk_size)
+        # the pool is started before the response so failing to fork is
+        # reported normally
+        results = export_partitions(job, bounds, workers) if bounds else []
+        encoder = get_encoder(self.encoder)
+
+        def body():
+            try:
+                for data in merge_partitions(results, fmt):
+                    yield data
+            except Exception:
+                current_app.logger.error("Error while exporting",
+                                         exc_info=True)
+                # CSV can't hold the error, so the response is aborted
+                if fmt == 'csv':
+                    raise
+                yield encoder.dumps(dict(
+                    success=False,
+                    message="An error occurred while exporting")) + b'\n'
+
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        response = current_app.response_class(stream_with_context(body()),
+                                              mimetype=mimetype)
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={0}.{1}'.format(
+                sqlalchemy.orm.class_mapper(self.model).local_table.name, fmt)
+        return response
 
     def post(self):
         """ Perform an action on an object or class """
-        self.params = request.get_json(silent=True) or {}
+        self.params = self.request_params() or {}
+        # a list of param dictionaries creates many objects at once
+        if isinstance(self.params, list):
+            self.params = {'__bulk': self.params}
+        items = self.params.pop('__bulk', None)
+        if items is not None:
+            return self.bulk_create(items)
         self.action = self.params.pop('__action', None)
         cls = self.params.pop('__cls', None)
         if not self.action:
@@ -372,7 +1265,7 @@ class API(six.with_metaclass(APIMeta, MethodView)):
         try:
             if self.action == '__init__':
                 ret = obj(**self.params)
-                self.session.add(obj)
+                self.session.add(ret)
                 self.session.flush()
             else:
                 ret = getattr(obj, self.action)(**self.params)
@@ -403,10 +1296,10 @@ class API(six.with_metaclass(APIMeta, MethodView)):
         else:
             retval['success'] = False
 
-        self.session.commit()
+        self.commit()
 
         try:
-            return jsonify(**retval)
+            return self.respond(retval)
         except (LeverException, KeyError, AttributeError):
             raise
         except Exception as e:
@@ -417,59 +1310,269 @@ class API(six.with_metaclass(APIMeta, MethodView)):
                     extra={'retval': str(retval)},
                     end_user={'method': self.action})
 
+    def bulk_create(self, items):
+        """ Creates an object from each of a list of param dictionaries in a
+        single transaction. Other params, besides __return_pks, are shared by
+        every item. The post pre hooks run for every item against its params
+        merged with the shared ones, as they would for a single create, and
+        can_cls is checked for every item, relying on the ACL to memoize
+        repeated checks.
+
+        When there are no post hooks, the model uses the default constructor
+        and its mapper has no validators or insert events, items whose params
+        are all columns are inserted with bulk_insert_mappings, skipping the
+        creation of objects entirely. Other items, like those given a related
+        object by a pre hook, are created and hooked in turn, and all of them
+        are flushed together.
+
+        Items that fail are skipped and reported in the results list in the
+        same format as errors. Database errors fail the whole batch. """
+        if not isinstance(items, list) or \
+                not all(isinstance(item, dict) for item in items):
+            raise LeverSyntaxError("Bulk creates take a list of dictionaries")
+        if self.max_bulk_size is not None and len(items) > self.max_bulk_size:
+            raise LeverSyntaxError(
+                "Can't create more than {0} objects at once"
+                .format(self.max_bulk_size))
+        return_pks = self.params.pop('__return_pks', False)
+        self.action = self.create_method
+        shared = self.params
+
+        mapper = sqlalchemy.orm.class_mapper(self.model)
+        # the default constructor renames itself __init__, but its code
+        # keeps the original name
+        init = sqlalchemy.orm.instrumentation.manager_of_class(
+            self.model).original_init
+        bulk_insert = (
+            self.action == '__init__' and
+            not self._post_method.get('post') and
+            not self._post_action.get(self.action) and
+            getattr(getattr(init, '__code__', None), 'co_name', None) ==
+            '_declarative_constructor' and
+            # bulk inserts bypass validators and these events
+            not mapper.validators and
+            not mapper.dispatch.before_insert and
+            not mapper.dispatch.after_insert)
+        column_keys = set(p.key for p in mapper.column_attrs)
+
+        results = []
+        created = []
+        for item in items:
+            self.params = dict(shared, **item)
+            try:
+                for method in self._pre_method.get('post', []):
+                    method(self)
+                for method in self._pre_method.get(self.action, []):
+                    method(self)
+                assert self.can_cls('action_' + self.action), "Can't perform cls action " + self.action
+                if bulk_insert and all(key in column_keys
+                                       for key in self.params):
+                    ret = self.params
+                else:
+                    ret = self.create(self.params)
+            except Exception:
+                exc = self.translate_exception(sys.exc_info())
+                results.append(dict(exc.end_user, code=exc.code))
+                continue
+            created.append((len(results), ret))
+            results.append({'success': True})
+        self.params = shared
+
+        mappings = [ret for i, ret in created if isinstance(ret, dict)]
+        if mappings:
+            self.session.bulk_insert_mappings(
+                mapper, mappings, return_defaults=return_pks)
+        self.session.flush()
+        if return_pks:
+            for i, ret in created:
+                if isinstance(ret, dict):
+                    results[i][self.pkey_val] = ret.get(self.pkey_val)
+                else:
+                    results[i][self.pkey_val] = getattr(ret, self.pkey_val,
+                                                        None)
+        self.commit()
+
+        return self.respond(dict(success=all(r['success'] for r in results),
+                                 created=len(created), results=results))
+
+    def create(self, params):
+        """ Creates and adds a single object for bulk_create, running the
+        post hooks on it """
+        try:
+            if self.action == '__init__':
+                ret = self.model(**params)
+            else:
+                ret = getattr(self.model, self.action)(**params)
+        except TypeError as e:
+            if 'argument' in str(e):
+                raise LeverSyntaxError(str(e))
+            raise
+        for method in self._post_action.get(self.action, []):
+            ret = method(self, ret)
+        for method in self._post_method.get('post', []):
+            ret = method(self, ret)
+        if hasattr(ret, '__table__'):
+            self.session.add(ret)
+        return ret
+
     def create_hook(self):
         """ Does logic required for checking permissions on a create action """
         pass
 
     def put(self):
         """ Updates an objects values """
-        self.params = request.get_json(silent=True)
+        self.params = self.request_params()
         for method in self._pre_method.get('put', []):
             method(self)
         if not self.params:
             raise LeverSyntaxError("To update, values must be specified")
-        obj = self.get_obj()
-        if not obj:
-            raise LeverNotFound("Could not find any object to update")
-
-        # updates all fields if data is provided, checks acl
-        for key, val in six.iteritems(self.params):
-            current_app.logger.debug(
-                "Updating value for '{0}' to '{1}'".format(key, val))
-            assert self.can(obj, 'edit_' + key), "Can't edit key {0} on type {1}"\
-                .format(key, self.model.__name__)
-            setattr(obj, key, val)
-
-        self.session.commit()
-        retval = {'success': True}
+        if self.writes_many():
+            retval = {'success': True, 'count': self.write_many()}
+        else:
+            obj = self.get_obj()
+            if not obj:
+                raise LeverNotFound("Could not find any object to update")
+
+            # updates all fields if data is provided, checks acl
+            for key, val in six.iteritems(self.params):
+                current_app.logger.debug(
+                    "Updating value for '{0}' to '{1}'".format(key, val))
+                assert self.can(obj, 'edit_' + key), "Can't edit key {0} on type {1}"\
+                    .format(key, self.model.__name__)
+                setattr(obj, key, val)
+
+            self.commit()
+            retval = {'success': True}
         for method in self._post_method.get('put', []):
             method(self, retval)
 
-        return jsonify(**retval)
+        return self.respond(retval)
 
     def delete(self):
-        self.params = request.get_json(silent=True)
+        self.params = self.request_params()
         for method in self._pre_method.get('delete', []):
             method(self)
         if not self.params:
             raise LeverSyntaxError("To delete, values must be specified")
 
-        obj = self.get_obj()
-        if not obj:
-            raise LeverNotFound("Could not find any object to delete")
-        assert self.can(obj, 'delete'), "Can't delete that object"
-        self.session.delete(obj)
-        self.session.commit()
+        if self.writes_many():
+            retval = {'success': True, 'count': self.write_many(delete=True)}
+        else:
+            obj = self.get_obj()
+            if not obj:
+                raise LeverNotFound("Could not find any object to delete")
+            assert self.can(obj, 'delete'), "Can't delete that object"
+            self.session.delete(obj)
+            self.commit()
+            retval = {'success': True}
 
-        retval = {'success': True}
         for method in self._post_method.get('delete', []):
             method(self, retval)
-        return jsonify(**retval)
+        return self.respond(retval)
+
+    def writes_many(self):
+        """ Whether a put or delete should go through write_many, which it
+        does when a search is given or bulk_writes is on """
+        return (self.bulk_writes or '__filter' in self.params or
+                '__filter_by' in self.params)
+
+    def write_many(self, delete=False):
+        """ Updates or deletes every object matched by the __filter and
+        __filter_by params, or the object with the primary key given. The
+        params left over are the values to update.
+
+        With bulk_writes on only can_cls is checked, for 'delete' or each
+        'edit_' key, and the rows are changed with a single UPDATE or DELETE
+        statement without loading them. Otherwise up to max_bulk_size objects
+        are loaded and checked with can, like single writes. Returns the
+        number of rows changed. """
+        query, pkey, values, actions = self.write_search(
+            self.session.query(self.model), delete)
+
+        if self.bulk_writes:
+            self.check_bulk_write(values, actions)
+            # the statement skips the session, so write out pending changes
+            # first and reload anything loaded afterwards
+            self.session.flush()
+            query = query.order_by(None)
+            if delete:
+                count = query.delete(synchronize_session=False)
+            else:
+                count = query.update(values, synchronize_session=False)
+            self.session.expire_all()
+        else:
+            if self.max_bulk_size is not None:
+                query = query.limit(self.max_bulk_size + 1)
+            objs = query.all()
+            self.write_objs(objs, values, actions, delete, self.session)
+            count = len(objs)
+
+        if pkey is not None and not count:
+            raise LeverNotFound("Could not find any object to {0}"
+                                .format('delete' if delete else 'update'))
+        self.commit()
+        return count
+
+    def write_search(self, query, delete):
+        """ Limits a query to the objects a write_many changes, returning it
+        with the primary key given, the values to update and the actions to
+        check """
+        pkey = self.params.pop(self.pkey_val, None)
+        for name in ('__filter', '__filter_by'):
+            if isinstance(self.params.get(name), six.string_types):
+                self.params[name] = safe_json(self.params[name])
+        if pkey is not None:
+            query = query.filter(self.pkey == pkey)
+        # an empty search would match, and change, every row
+        elif not self.params.get('__filter') and \
+                not self.params.get('__filter_by'):
+            raise LeverSyntaxError(
+                "A primary key, __filter or __filter_by must be specified")
+        query = self.search(query=query)
+        values = self.params
+        if delete:
+            actions = ['delete']
+        elif not values:
+            raise LeverSyntaxError("To update, values must be specified")
+        else:
+            actions = ['edit_' + key for key in sorted(values)]
+        return query, pkey, values, actions
+
+    def check_bulk_write(self, values, actions):
+        """ Checks a set based write with can_cls and makes sure every value
+        is for a column """
+        for action in actions:
+            assert self.can_cls(action), "Can't perform cls action " + action
+        column_keys = set(p.key for p in
+                          sqlalchemy.orm.class_mapper(self.model).column_attrs)
+        for key in values if actions != ['delete'] else ():
+            if key not in column_keys:
+                raise LeverSyntaxError(
+                    "{0} is not a column of {1}"
+                    .format(key, self.model.__name__))
+
+    def write_objs(self, objs, values, actions, delete, session):
+        """ Checks the objects loaded by a write_many with can, then updates or
+        deletes them with session """
+        if self.max_bulk_size is not None and len(objs) > self.max_bulk_size:
+            raise LeverSyntaxError(
+                "Can't change more than {0} objects at once"
+                .format(self.max_bulk_size))
+        self.preload_acl(objs)
+        for obj in objs:
+            for action in actions:
+                assert self.can(obj, action), "Can't perform action " + action
+        for obj in objs:
+            if delete:
+                session.delete(obj)
+            else:
+                for key, val in six.iteritems(values):
+                    setattr(obj, key, val)
 
     def paginate(self, query=None):
         """ Sets limit and offset values on a query object based on arguments,
         and limited by class settings """
-        if not query:
+        if query is None:
             query = self.session.query(self.model)
         pg_size = self.params.get('pg_size')
         # don't do any pagination if we don't have a max page size and no
@@ -484,81 +1587,195 @@ class API(six.with_metaclass(APIMeta, MethodView)):
         except ValueError:
             pg_size = self.max_pg_size
 
+        if '__after' in self.params or self.cursor_pagination:
+            return self.keyset_paginate(query, pg_size)
+
         page = int(self.params.get('pg', 1))
         return query.offset((page - 1) * pg_size).limit(pg_size)
 
+    def keyset_paginate(self, query, pg_size):
+        """ Pages by filtering on the values of the last row of the previous
+        page instead of using an offset, so any page costs the same as the
+        first and rows inserted concurrently don't shift the pages. The
+        position is passed in the __after parameter as the opaque
+        next_cursor token returned with the previous page. The primary key
+        is added to the ordering to make it total. Rows with NULL values in
+        the ordering columns can't be paged over, and the columns must hold
+        values a cursor can store: numbers, strings, UUIDs, dates and
+        times. """
+        ordering = list(self.ordering)
+        if self.pkey_val not in [key for key, desc in ordering]:
+            ordering.append((self.pkey_val, False))
+            query = query.order_by(self.pkey)
+        for key, desc in ordering:
+            try:
+                python_type = getattr(self.model, key).type.python_type
+            except (AttributeError, NotImplementedError):
+                python_type = None
+            if python_type is None or \
+                    not issubclass(python_type, _cursor_types):
+                raise LeverSyntaxError(
+                    "Can't page with a cursor ordered by {0}".format(key))
+
+        after = self.params.get('__after')
+        if after:
+            values = decode_cursor(after)
+            if len(values) != len(ordering):
+                raise LeverSyntaxError("Cursor doesn't match the ordering")
+            # (a > x) or (a == x and b > y) or ...
+            clauses = []
+            for i, (key, desc) in enumerate(ordering):
+                col = getattr(self.model, key)
+                terms = [getattr(self.model, k) == v
+                         for (k, d), v in zip(ordering[:i], values[:i])]
+                terms.append(col < values[i] if desc else col > values[i])
+                clauses.append(sqlalchemy.and_(*terms))
+            query = query.filter(sqlalchemy.or_(*clauses))
+
+        self.cursor_ordering = ordering
+        self.page_size = pg_size
+        return query.limit(pg_size)
+
+    def next_cursor(self, last, count):
+        """ Returns the cursor for the page following the one ending with the
+        object last when keyset pagination is in use. A page that isn't full
+        is the final one and gets None """
+        if last is None or (self.page_size and count < self.page_size):
+            return None
+        return encode_cursor([getattr(last, key)
+                              for key, desc in self.cursor_ordering])
+
+    def search_key(self):
+        """ A normalized form of the search parameters of the current request,
+        used to key values cached across requests """
+        key = {}
+        for name in ('__filter', '__filter_by', '__order_by'):
+            val = self.params.get(name)
+            if isinstance(val, six.string_types):
+                val = safe_json(val)
+            key[name] = val
+        # filtered results depend on who's asking
+        if self.view_filtered:
+            key['acl'] = self.acl_fingerprint()
+        return json.dumps(key, sort_keys=True)
+
+    def estimate_count(self, query):
+        """ Can be overriden to return an estimate of the number of rows the
+        query matches, such as the planner's row estimate, when an exact count
+        is too expensive. Returning None counts the rows exactly """
+        return None
+
+    def count(self, query, search_key, exact=True):
+        """ Returns the total number of rows matching a search query, which
+        shouldn't be paginated yet, as a dictionary to merge into the response.
+        Totals come from the count cache or estimate_count when possible and
+        are otherwise counted without the ordering, which can't change them.
+        With exact false None is returned instead of running the count """
+        count = self.cached_count(search_key)
+        if count is None:
+            estimate = self.estimate_count(query)
+            if estimate is not None:
+                count = dict(count=estimate, count_estimated=True)
+            elif not exact:
+                return None
+            else:
+                count = dict(count=query.order_by(None).count())
+            self.cache_count(search_key, count)
+        return count
+
+    def paginate_with_count(self, query, search_key):
+        """ Paginates a search query and loads the page along with the total
+        number of matching rows. When the database supports window functions
+        the total comes back with the page as a COUNT(*) OVER () column,
+        saving the round trip of a separate count query """
+        page = self.paginate(query=query)
+        count = self.count(query, search_key, exact=False)
+        if count is not None:
+            return page.all(), count
+
+        dialect = self.session.get_bind(
+            sqlalchemy.orm.class_mapper(self.model)).dialect
+        if self.cursor_ordering is None and _supports_window(dialect):
+            rows = page.add_columns(sqlalchemy.func.count().over()).all()
+            # an empty page past the end can't tell us the total
+            if rows:
+                count = dict(count=rows[0][1])
+                self.cache_count(search_key, count)
+                return [row[0] for row in rows], count
+            return [], self.count(query, search_key)
+        return page.all(), self.count(query, search_key)
+
+    def cached_count(self, search_key):
+        """ Looks up a count stored by cache_count that hasn't expired """
+        if not self.count_ttl:
+            return None
+        entry = _count_cache.get((self.__class__, search_key))
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def cache_count(self, search_key, count):
+        """ Stores a count for count_ttl seconds if count caching is on """
+        if not self.count_ttl:
+            return
+        now = time.time()
+        # drop expired entries so distinct searches can't grow it forever
+        if len(_count_cache) >= 1024:
+            for key, entry in list(six.iteritems(_count_cache)):
+                if entry[0] <= now:
+                    _count_cache.pop(key, None)
+        _count_cache[(self.__class__, search_key)] = (now + self.count_ttl,
+                                                     count)
+
     def search(self, query=None):
         """ Handles arguments __filter_by, __filter, and __order_by by
-        modifying the query parameters before execution """
+        modifying the query parameters before execution. The expressions are
+        built once per shape of search, the operators and fields used, and
+        cached with bind parameters in place of the values """
         if query is None:
             query = self.session.query(self.model)
 
         filters = self.params.pop('__filter', None)
-        try:
-            if filters:
-                # it's a json encoded parameter to get
-                if isinstance(filters, six.string_types):
-                    filters = safe_json(filters)
-                for op in filters:
-                    args = []
-                    args.append(getattr(self.model, op['name']))
-                    if 'val' in op:
-                        args.append(op['val'])
-                    if 'field' in op:
-                        args.append(getattr(self.model, op['field']))
-                    operator = OPERATORS.get(op['op'])
-                    if operator is None:
-                        raise LeverSyntaxError("Invalid operator specified in filter arguments")
-                    func = operator(*args)
-                    query = query.filter(func)
-        except AttributeError:
-            current_app.logger.debug("Attribute filter error", exc_info=True)
-            raise LeverSyntaxError(
-                'Filter operator "{0}" accessed invalid field'
-                .format(op))
-        except KeyError:
-            current_app.logger.debug("Key filter error", exc_info=True)
-            raise LeverSyntaxError(
-                'Filter operator "{0}" was missing required arguments'
-                .format(op))
-        except TypeError:
-            current_app.logger.debug("Argument count error", exc_info=True)
-            raise LeverSyntaxError(
-                'Incorrect argument count for requested filter operation'
-                .format(op))
-
         order_by = self.params.pop('__order_by', None)
-        try:
-            if order_by:
-                # it's a json encoded parameter to get
-                if isinstance(order_by, six.string_types):
-                    order_by = safe_json(order_by)
-                for key in order_by:
-                    if key.startswith('-'):
-                        base = getattr(self.model, key[1:]).desc()
-                    else:
-                        base = getattr(self.model, key)
-                    query = query.order_by(base)
-        except AttributeError:
-            raise LeverSyntaxError(
-                'Order_by operator "{0}" accessed invalid field'
-                .format(key))
-
         filter_by = self.params.pop('__filter_by', None)
-        if filter_by:
-            # it's a json encoded parameter to get
-            if isinstance(filter_by, six.string_types):
-                filter_by = safe_json(filter_by)
-            for key, value in six.iteritems(filter_by):
-                try:
-                    query = query.filter_by(**{key: value})
-                except sqlalchemy.exc.InvalidRequestError:
-                    raise LeverSyntaxError(
-                        'Filter_by key "{0}" accessed invalid field'
-                        .format(key))
-
+        # they're json encoded parameters to get
+        if isinstance(filters, six.string_types):
+            filters = safe_json(filters)
+        if isinstance(order_by, six.string_types):
+            order_by = safe_json(order_by)
+        if isinstance(filter_by, six.string_types):
+            filter_by = safe_json(filter_by)
+
+        shape, values = search_shape(filters, order_by, filter_by)
+        plan = self.search_plan(shape)
+        if plan.clauses:
+            query = query.filter(*plan.clauses)
+        if plan.order_by:
+            query = query.order_by(*plan.order_by)
+        if values:
+            query = query.params(**values)
+        self.ordering = list(plan.ordering)
         return query
 
+    def search_plan(self, shape):
+        """ Returns the SearchPlan for a search shape from this API's cache,
+        building it if it isn't there. The cache holds the search_cache_size
+        most recently used shapes """
+        with _search_lock:
+            plans = _search_plans.setdefault(self.__class__,
+                                             collections.OrderedDict())
+            plan = plans.pop(shape, None)
+            if plan is not None:
+                plans[shape] = plan
+                return plan
+
+        plan = SearchPlan(self.model, shape)
+        with _search_lock:
+            plans[shape] = plan
+            while len(plans) > self.search_cache_size:
+                plans.popitem(last=False)
+        return plan
+
     @classmethod
     def register(cls, mod, url):
         """ Registers the API to a blueprint or application """
@@ -568,71 +1785,535 @@ class API(six.with_metaclass(APIMeta, MethodView)):
                          methods=['GET', 'POST', 'PUT', 'DELETE'])
 
 
+def _freeze(val):
+    """ Turns a join profile, which may contain lists and dictionaries, into
+    something hashable so it can be used as a cache key """
+    if isinstance(val, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in six.iteritems(val)))
+    if isinstance(val, (list, tuple)):
+        return tuple(_freeze(v) for v in val)
+    return val
+
+
+class JoinPlan(object):
+    """ A join profile resolved against a single model class. All the parsing
+    of the profile and inspection of the mapper happens once when the plan is
+    built, so serializing an object is only attribute access and value
+    conversion. Plans are cached by :func:`compile_join` and should be
+    treated as immutable. """
+
+    def __init__(self, cls, join_prof="standard_join"):
+        # a string names a join profile attribute on the model
+        if isinstance(join_prof, six.string_types):
+            join = getattr(cls, join_prof)
+        else:
+            join = join_prof
+
+        # split the join list into it's compoenents, obj to be removed, sub
+        # object join data, and current object join values
+        remove = []
+        sub_obj = []
+        join_keys = []
+        for key in join:
+            if isinstance(key, six.string_types):
+                if key.startswith('-'):
+                    remove.append(key[1:])
+                else:
+                    join_keys.append(key)
+            else:
+                sub_obj.append(key)
+
+        include_base = False
+        try:
+            join_keys.remove('__dont_mongo')
+        except ValueError:
+            include_base = True
+
+        self.model = cls
+        self.cls_name = cls.__name__
+        self.join_prof = join_prof
+        self.include_base = include_base
+        self.remove = remove
+        self.keys = join_keys
+        # values of columns are converted by the converter for the column's
+        # type, skipping the dispatch on the type of each value
+        column_attrs = sqlalchemy.orm.class_mapper(cls).column_attrs
+        self.getters = [
+            (key, operator.attrgetter(key),
+             _column_converter(column_attrs[key])
+             if key in column_attrs else None)
+            for key in join_keys]
+        # the names of all the columns on the model, less the removed ones
+        if include_base:
+            self.columns = [
+                c.key for c in sqlalchemy.orm.class_mapper(cls).columns
+                if c.key not in remove]
+        else:
+            self.columns = []
+        # allow the conf dictionary to specify a join profile. The plans of
+        # relationships are compiled up front, while other attributes could
+        # hold objects of any class and are compiled when serialized
+        relationships = sqlalchemy.orm.class_mapper(cls).relationships
+        self.subs = []
+        for conf in sub_obj:
+            key = conf.get('obj')
+            prof = conf.get('join_prof', "standard_join")
+            prop = relationships.get(key)
+            plan = None
+            if prop is not None:
+                plan = compile_join(prop.mapper.class_, prof)
+            self.subs.append((key, prof, plan))
+        # built lazily since it requires compiling the plans of related models
+        self._options = None
+        self._column_options = {}
+        self._tables = None
+
+    def loader_options(self, extra_columns=()):
+        """ Loader options that eagerly load every relationship this plan, and
+        the plans nested under it, will serialize. Collections are loaded with
+        an extra IN query and scalar relationships with a join, so the number
+        of queries needed is fixed regardless of how many rows are loaded.
+        Columns the plans never emit are left unloaded as well, except for
+        those named in extra_columns. Every column of the model is loaded when
+        extra_columns is None. """
+        if self._options is None:
+            mapper = sqlalchemy.orm.class_mapper(self.model)
+            options = []
+            for key, prof, plan in self.subs:
+                prop = mapper.relationships.get(key)
+                # attributes that aren't relationships can't be eager loaded,
+                # and neither can relationships that are never loaded as a
+                # whole
+                if prop is None or prop.lazy in _unloadable:
+                    continue
+                attr = getattr(self.model, key)
+                if prop.uselist:
+                    opt = sqlalchemy.orm.selectinload(attr)
+                else:
+                    opt = sqlalchemy.orm.joinedload(attr)
+                # the related rows must keep the columns the relationship
+                # is matched on, even if they aren't serialized
+                sub_options = plan.loader_options(
+                    _mapped_keys(prop.mapper, prop.remote_side))
+                if sub_options:
+                    opt = opt.options(*sub_options)
+                options.append(opt)
+            self._options = options
+        return self._options + self.column_options(extra_columns)
+
+    def column_options(self, extra_columns=()):
+        """ Returns load_only or defer options limiting the columns loaded to
+        the ones this plan serializes. Profiles that include the base columns
+        defer the ones removed with a '-' prefix. Profiles using __dont_mongo
+        load only the columns they name, but only when every key is a column,
+        since a property or method could read any attribute. Nothing is
+        limited when extra_columns is None. """
+        if extra_columns is None:
+            return []
+        extra_columns = tuple(extra_columns)
+        try:
+            return self._column_options[extra_columns]
+        except KeyError:
+            pass
+
+        mapper = sqlalchemy.orm.class_mapper(self.model)
+        column_keys = set(p.key for p in mapper.column_attrs)
+        pkeys = _mapped_keys(mapper, mapper.primary_key)
+        if self.include_base:
+            keys = [k for k in self.remove if k in column_keys and
+                    k not in pkeys and k not in extra_columns]
+            options = [sqlalchemy.orm.defer(getattr(self.model, k))
+                       for k in keys]
+        elif all(k in column_keys for k in self.keys):
+            keys = set(self.keys) | set(extra_columns)
+            # keep the columns scalar relationships are joined on
+            for key, prof, plan in self.subs:
+                prop = mapper.relationships.get(key)
+                if prop is not None:
+                    keys |= set(_mapped_keys(mapper, prop.local_columns))
+            options = [sqlalchemy.orm.load_only(
+                *[getattr(self.model, k) for k in sorted(keys)])]
+        else:
+            options = []
+        self._column_options[extra_columns] = options
+        return options
+
+    def tables(self):
+        """ The names of the tables read by serializing with this plan and the
+        plans nested under it """
+        if self._tables is None:
+            mapper = sqlalchemy.orm.class_mapper(self.model)
+            tables = set(t.name for t in mapper.tables)
+            for key, prof, plan in self.subs:
+                if plan is None:
+                    continue
+                prop = mapper.relationships[key]
+                if prop.secondary is not None:
+                    tables.add(prop.secondary.name)
+                tables |= plan.tables()
+            self._tables = frozenset(tables)
+        return self._tables
+
+    def __call__(self, obj):
+        """ Serializes a single instance of the model into a dictionary """
+        dct = dict((c, getattr(obj, c)) for c in self.columns)
+        # run the primary object join
+        for key, getter, conv in self.getters:
+            try:
+                attr = getter(obj)
+            except Exception:
+                raise LeverServerError(
+                    "Invalid join property {0} defined by join profile"
+                    .format(key))
+            if conv is not None:
+                dct[key] = attr if attr is None else conv(attr)
+                continue
+            attr = _jsonize_value(obj, attr)
+            if attr is not _skip:
+                dct[key] = attr
+        dct['_cls'] = self.cls_name
+
+        # run all the subobject joins
+        for key, prof, plan in self.subs:
+            subobj = getattr(obj, key)
+            if plan is not None and subobj.__class__ is plan.model:
+                dct[key] = plan(subobj)
+            elif plan is not None and isinstance(subobj, list):
+                # items of subclasses need plans of their own
+                dct[key] = [plan(item) if item.__class__ is plan.model
+                            else get_joined(item, join_prof=prof)
+                            for item in subobj]
+            elif subobj is not None:
+                dct[key] = get_joined(subobj, join_prof=prof)
+            else:
+                current_app.logger.info(
+                    "Attempting to access attribute {} from {} resulted in {} "
+                    "type".format(key, type(obj), subobj))
+                dct[key] = subobj
+        return dct
+
+
+# lazy settings of relationships that loader options can't be applied to
+_unloadable = ('dynamic', 'noload', 'raise', 'raise_on_sql')
+
+
+def _mapped_keys(mapper, columns):
+    """ Translates columns into the attribute keys they're mapped to on the
+    mapper, ignoring any that belong to other tables """
+    keys = []
+    for col in columns:
+        try:
+            keys.append(mapper.get_property_by_column(col).key)
+        except sqlalchemy.orm.exc.UnmappedColumnError:
+            pass
+    return keys
+
+
+# compiled join plans keyed by (model class, frozen join profile)
+_join_plans = {}
+_max_join_plans = 4096
+_building = threading.local()
+
+
+def compile_join(cls, join_prof="standard_join"):
+    """ Returns the :class:`JoinPlan` for a model class and join profile,
+    compiling it the first time the pair is seen """
+    key = (cls, _freeze(join_prof))
+    try:
+        return _join_plans[key]
+    except KeyError:
+        pass
+    # plans being built, including the ones they nest, are kept aside until
+    # they're all complete, so profiles that nest each other get the same
+    # plan back instead of compiling forever, and other threads never see a
+    # plan half built
+    building = getattr(_building, 'plans', None)
+    if building is not None and key in building:
+        return building[key]
+    outermost = building is None
+    if outermost:
+        building = _building.plans = {}
+    try:
+        plan = building[key] = JoinPlan.__new__(JoinPlan)
+        plan.__init__(cls, join_prof)
+        if outermost:
+            # profiles built from __fields are chosen by clients, so the
+            # cache is emptied rather than left to grow without bound
+            if len(_join_plans) + len(building) > _max_join_plans:
+                _join_plans.clear()
+            _join_plans.update(building)
+    finally:
+        if outermost:
+            _building.plans = None
+    return plan
+
+
+def restrict_join(cls, join_prof, fields, prefix=()):
+    """ Builds a join profile serializing only fields out of what join_prof
+    allows for a model class. Each field is a list of names, a path that
+    can reach into the objects the profile nests, such as ['comments',
+    'author', 'username']. A path ending at a nested object keeps its whole
+    profile. Raises LeverSyntaxError for fields the profile doesn't allow """
+    plan = compile_join(cls, join_prof)
+    subs = dict((key, prof) for key, prof, sub in plan.subs)
+    mapper = sqlalchemy.orm.class_mapper(cls)
+    paths = {}
+    for path in fields:
+        paths.setdefault(path[0], []).append(path[1:])
+
+    keys = []
+    nested = []
+    for key, rests in sorted(six.iteritems(paths)):
+        path = list(prefix) + [key]
+        if key in subs and not all(rests):
+            # asking for the whole object overrides narrower paths into it
+            nested.append({'obj': key, 'join_prof': subs[key]})
+        elif key in subs and key in mapper.relationships:
+            nested.append({'obj': key, 'join_prof': restrict_join(
+                mapper.relationships[key].mapper.class_, subs[key], rests,
+                prefix=path)})
+        elif (key in plan.columns or key in plan.keys) and not any(rests):
+            keys.append(key)
+        else:
+            rest = next((r for r in rests if r), [])
+            raise LeverSyntaxError(
+                'Field "{0}" isn\'t available in the join profile'
+                .format('.'.join(path + rest)))
+    return ['__dont_mongo'] + keys + nested
+
+
+def search_shape(filters, order_by, filter_by):
+    """ Splits the decoded __filter, __order_by and __filter_by parameters of
+    a search into a hashable shape and a dictionary of the values to bind,
+    keyed by the bind parameter names the SearchPlan for the shape uses.
+    Comparisons to None stay in the shape so they can become IS NULL """
+    # the shape is hashed, so everything in it has to be checked first
+    if not isinstance(filters or [], list):
+        raise LeverSyntaxError("__filter must be a list of operators")
+    if not isinstance(order_by or [], list) or not all(
+            isinstance(key, six.string_types) for key in order_by or ()):
+        raise LeverSyntaxError("__order_by must be a list of field names")
+    if not isinstance(filter_by or {}, dict):
+        raise LeverSyntaxError("__filter_by must be a dictionary")
+
+    values = {}
+    filter_shape = []
+    for op in filters or ():
+        try:
+            val = op.get('val')
+            bound = 'val' in op and val is not None
+            if bound:
+                values['lever_f%d' % len(filter_shape)] = val
+            filter_shape.append((op['name'], op['op'], 'val' in op, bound,
+                                 op.get('field')))
+        except (KeyError, AttributeError):
+            raise LeverSyntaxError(
+                'Filter operator "{0}" was missing required arguments'
+                .format(op))
+        if not all(isinstance(arg, six.string_types)
+                   for arg in filter_shape[-1][:2]) or \
+                not isinstance(filter_shape[-1][4],
+                               six.string_types + (type(None), )):
+            raise LeverSyntaxError(
+                'Filter operator "{0}" has invalid arguments'.format(op))
+
+    filter_by_shape = []
+    for key, value in sorted(six.iteritems(filter_by or {})):
+        if value is not None:
+            values['lever_b%d' % len(filter_by_shape)] = value
+        filter_by_shape.append((key, value is not None))
+
+    shape = (tuple(filter_shape), tuple(order_by or ()),
+             tuple(filter_by_shape))
+    return shape, values
+
+
+class SearchPlan(object):
+    """ The filter and ordering expressions for one search shape, built with
+    bind parameters in place of the values from the request. Since the
+    expressions are identical for every request with the shape, SQLAlchemy's
+    compiled statement cache is hit as well. """
+
+    def __init__(self, model, shape):
+        filter_shape, order_shape, filter_by_shape = shape
+        self.clauses = []
+        self.order_by = []
+        self.ordering = []
+
+        for i, (name, op_name, has_val, bound, field) in enumerate(filter_shape):
+            op = {'name': name, 'op': op_name}
+            try:
+                args = []
+                args.append(getattr(model, name))
+                if has_val:
+                    if not bound:
+                        args.append(None)
+                    else:
+                        # in operators take a list, which needs expanding
+                        args.append(sqlalchemy.bindparam(
+                            'lever_f%d' % i,
+                            expanding=op_name in ('in', 'not_in')))
+                if field is not None:
+                    args.append(getattr(model, field))
+                operator = OPERATORS.get(op_name)
+                if operator is None:
+                    raise LeverSyntaxError("Invalid operator specified in filter arguments")
+                self.clauses.append(operator(*args))
+            except AttributeError:
+                current_app.logger.debug("Attribute filter error",
+                                         exc_info=True)
+                raise LeverSyntaxError(
+                    'Filter operator "{0}" accessed invalid field'
+                    .format(op))
+            except TypeError:
+                current_app.logger.debug("Argument count error",
+                                         exc_info=True)
+                raise LeverSyntaxError(
+                    'Incorrect argument count for requested filter operation'
+                    .format(op))
+
+        for key in order_shape:
+            try:
+                if key.startswith('-'):
+                    self.order_by.append(getattr(model, key[1:]).desc())
+                    self.ordering.append((key[1:], True))
+                else:
+                    self.order_by.append(getattr(model, key))
+                    self.ordering.append((key, False))
+            except AttributeError:
+                raise LeverSyntaxError(
+                    'Order_by operator "{0}" accessed invalid field'
+                    .format(key))
+
+        for i, (key, bound) in enumerate(filter_by_shape):
+            try:
+                attr = getattr(model, key)
+            except AttributeError:
+                raise LeverSyntaxError(
+                    'Filter_by key "{0}" accessed invalid field'
+                    .format(key))
+            if bound:
+                self.clauses.append(attr == sqlalchemy.bindparam('lever_b%d' % i))
+            else:
+                self.clauses.append(attr == None)
+
+
+# the SearchPlan caches of each API class, most recently used last
+_search_plans = {}
+_search_lock = threading.Lock()
+
+
 def get_joined(obj, join_prof="standard_join"):
     # If it's a list, join each of the items in the list and return
     # modified list
     if isinstance(obj, (sqlalchemy.orm.Query,
                         sqlalchemy.orm.collections.InstrumentedList,
                         list)):
+        # look plans up once per class instead of once per item
+        plans = {}
         lst = []
         for item in obj:
-            lst.append(get_joined(item, join_prof=join_prof))
+            cls = item.__class__
+            plan = plans.get(cls)
+            if plan is None:
+                plan = plans[cls] = compile_join(cls, join_prof)
+            lst.append(plan(item))
         return lst
 
-    # split the join list into it's compoenents, obj to be removed, sub
-    # object join data, and current object join values
-    if isinstance(join_prof, six.string_types):
-        join = getattr(obj, join_prof)
-    else:
-        join = join_prof
-
-    remove = []
-    sub_obj = []
-    join_keys = []
-    for key in join:
-        if isinstance(key, six.string_types):
-            if key.startswith('-'):
-                remove.append(key[1:])
-            else:
-                join_keys.append(key)
-        else:
-            sub_obj.append(key)
+    return compile_join(obj.__class__, join_prof)(obj)
+
+
+# counts cached for API.count_ttl, keyed by (API class, search key)
+_count_cache = {}
+
+
+def _supports_window(dialect):
+    """ Whether the database behind a dialect supports COUNT(*) OVER () """
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 25)
+    if dialect.name == 'mysql':
+        version = dialect.server_version_info or (0, )
+        if getattr(dialect, 'is_mariadb', False):
+            return version >= (10, 2)
+        return version >= (8, )
+    return dialect.name in ('postgresql', 'oracle', 'mssql')
+
+
+def _chunked(iterable, size):
+    """ Yields lists of up to size items from iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _csv_value(val, encoder):
+    """ Formats a serialized value for a CSV cell """
+    if val is None:
+        return ''
+    if isinstance(val, (dict, list)):
+        return encoder.dumps(val).decode('utf8')
+    return six.text_type(val)
+
+
+# the types of values that can be stored in a cursor, besides JSON's own
+_cursor_types = (bool, float, decimal.Decimal, uuid.UUID, datetime.date,
+                 datetime.time) + six.integer_types + six.string_types
+
+
+def _cursor_default(val):
+    if isinstance(val, datetime.datetime):
+        return {'__dt': val.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+    if isinstance(val, datetime.date):
+        return {'__d': val.strftime('%Y-%m-%d')}
+    if isinstance(val, datetime.time):
+        return {'__t': val.strftime('%H:%M:%S.%f')}
+    if isinstance(val, decimal.Decimal):
+        return {'__dec': str(val)}
+    if isinstance(val, uuid.UUID):
+        return {'__uuid': str(val)}
+    raise TypeError("{0!r} can't be stored in a cursor".format(val))
+
+
+def _cursor_hook(dct):
+    if '__dt' in dct:
+        return datetime.datetime.strptime(dct['__dt'], '%Y-%m-%dT%H:%M:%S.%f')
+    if '__d' in dct:
+        return datetime.datetime.strptime(dct['__d'], '%Y-%m-%d').date()
+    if '__t' in dct:
+        return datetime.datetime.strptime(dct['__t'], '%H:%M:%S.%f').time()
+    if '__dec' in dct:
+        return decimal.Decimal(dct['__dec'])
+    if '__uuid' in dct:
+        return uuid.UUID(dct['__uuid'])
+    return dct
+
 
-    include_base = False
+def encode_cursor(values):
+    """ Packs the ordering values of a row into an opaque cursor token """
+    data = json.dumps(values, default=_cursor_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Unpacks a cursor token created by encode_cursor """
     try:
-        join_keys.remove('__dont_mongo')
-    except ValueError:
-        include_base = True
-    # run the primary object join
-    join_vals = jsonize(obj, join_keys, raw=True)
-    # catch our special config key
-    if include_base:
-        # first we get the names of all the columns on your model
-        columns = [c.key for c in sqlalchemy.orm.class_mapper(obj.__class__).columns]
-        # then we return their values in a dict
-        dct = dict((c, getattr(obj, c)) for c in columns)
-        # Remove keys from the bson that the join prefixes with a -
-        for key in remove:
-            dct.pop(key, None)
-        dct.update(join_vals)
-    else:
-        dct = join_vals
-    dct['_cls'] = obj.__class__.__name__
-
-    # run all the subobject joins
-    for conf in sub_obj:
-        key = conf.get('obj')
-        # allow the conf dictionary to specify a join profiel
-        prof = conf.get('join_prof', "standard_join")
-        subobj = getattr(obj, key)
-        if subobj is not None:
-            dct[key] = get_joined(subobj, join_prof=prof)
-        else:
-            current_app.logger.info(
-                "Attempting to access attribute {} from {} resulted in {} "
-                "type".format(key, type(obj), subobj))
-            dct[key] = subobj
-    return dct
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        values = json.loads(data.decode('utf8'), object_hook=_cursor_hook)
+    except Exception as e:
+        raise LeverSyntaxError(
+            "Invalid cursor. Original exception was {}".format(e))
+    if not isinstance(values, list):
+        raise LeverSyntaxError("Invalid cursor")
+    return values
+
+
+def _overrides(api, name):
+    """ Whether the class of an API overrides one of the methods of API """
+    return six.get_unbound_function(getattr(type(api), name)) is not \
+        six.get_unbound_function(getattr(API, name))
 
 
 def safe_json(json_string):
@@ -644,6 +2325,129 @@ def safe_json(json_string):
             .format(e))
 
 
+# marker returned when a value should be left out of the serialized output
+_skip = object()
+# marker for types whose values are called and the result converted
+_call = object()
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+def _identity(val):
+    return val
+
+
+def _datetime_to_epoch(val):
+    """ Converts a datetime to whole seconds since epoch, treating naive
+    datetimes as UTC like calendar.timegm """
+    if val.tzinfo is not None:
+        offset = val.utcoffset()
+        val = val.replace(tzinfo=None)
+        if offset:
+            val -= offset
+    delta = val - _epoch
+    return delta.days * 86400 + delta.seconds
+
+
+def _set_to_dict(val):
+    # convert set to a dictionary for easy conditionals
+    return dict((x, True) for x in val)
+
+
+# value converters keyed by type, see register_converter
+_converters = {
+    datetime.datetime: _datetime_to_epoch,
+    set: _set_to_dict,
+    bool: _identity,
+    int: _identity,
+    float: _identity,
+    dict: _identity,
+    list: _identity,
+    type(None): _identity,
+    six.text_type: _identity,
+}
+# the converter resolved for every type seen, including subclasses
+_resolved = {}
+
+
+def register_converter(typ, func):
+    """ Registers a function converting values of typ, and its subclasses,
+    into something JSON serializable when they're serialized by a join
+    profile. Types without a converter are stringified. For example:
+
+    register_converter(decimal.Decimal, float)
+    """
+    _converters[typ] = func
+    _resolved.clear()
+    # join plans hold converters resolved from column types
+    _join_plans.clear()
+
+
+def _converter_for(typ):
+    """ Returns the converter for a type, looking through its bases once and
+    caching the result """
+    try:
+        return _resolved[typ]
+    except KeyError:
+        pass
+    mro = getattr(typ, '__mro__', (typ, ))
+    for base in mro:
+        conv = _converters.get(base)
+        if conv is not None:
+            break
+    else:
+        # if it's a callable function call it, if we don't know what it is
+        # stringify it
+        if any('__call__' in vars(base) for base in mro):
+            conv = _call
+        else:
+            conv = str
+    _resolved[typ] = conv
+    return conv
+
+
+def _jsonize_value(obj, attr):
+    """ Converts a single attribute value into something JSON friendly """
+    conv = _converter_for(type(attr))
+    if conv is _call:
+        try:
+            attr = attr()
+        except TypeError:
+            current_app.logger.warn(
+                "{0} callable requires argument on obj {1}"
+                .format(str(attr), obj.__class__.__name__))
+            return _skip
+        conv = _converter_for(type(attr))
+        # results are never called
+        if conv is _call:
+            conv = str
+    return conv(attr)
+
+
+def _column_converter(prop):
+    """ The converter for the values of a column property, resolved from the
+    column's type, or None if it can't be determined ahead of time """
+    if len(prop.columns) != 1:
+        return None
+    try:
+        typ = prop.columns[0].type.python_type
+    except (AttributeError, NotImplementedError):
+        return None
+    conv = _converter_for(typ)
+    if conv is _call or conv is str:
+        return None
+    return conv
+
+
+def _aggregate_value(val):
+    """ Converts a value computed by __aggregate into something JSON friendly """
+    if isinstance(val, decimal.Decimal):
+        if val == val.to_integral_value():
+            return int(val)
+        return float(val)
+    return _jsonize_value(None, val)
+
+
 def jsonize(obj, args, raw=False):
     """ Used to join attributes or functions to an objects json
     representation.  For passing back object state via the api """
@@ -655,33 +2459,9 @@ def jsonize(obj, args, raw=False):
             raise LeverServerError(
                 "Invalid join property {0} defined by join profile"
                 .format(key))
-        # if it's a callable function call it, then do the parsing below
-        if callable(attr):
-            try:
-                attr = attr()
-            except TypeError:
-                current_app.logger.warn(
-                    "{0} callable requires argument on obj {1}"
-                    .format(str(attr), obj.__class__.__name__))
-                continue
-        # convert datetime to seconds since epoch, much more universal
-        if isinstance(attr, datetime.datetime):
-            attr = calendar.timegm(attr.utctimetuple())
-        # don't convert these common types to strings
-        elif (isinstance(attr, bool) or
-              isinstance(attr, int) or
-              isinstance(attr, float) or
-              isinstance(attr, dict) or
-              attr is None or
-              isinstance(attr, list)):
-            pass
-        # convert set to a dictionary for easy conditionals
-        elif isinstance(attr, set):
-            attr = dict((x, True) for x in attr)
-        else:  # if we don't know what it is, stringify it
-            attr = str(attr)
-
-        dct[key] = attr
+        attr = _jsonize_value(obj, attr)
+        if attr is not _skip:
+            dct[key] = attr
 
     if raw:
         return dct
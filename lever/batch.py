@@ -0,0 +1,152 @@
+from flask import current_app, request
+from flask.views import MethodView
+from werkzeug.exceptions import HTTPException
+
+import json
+import six
+import sys
+
+from .base import LeverSyntaxError
+from .cache import invalidate_tables
+
+
+class BatchAPI(MethodView):
+    """ An endpoint running many lever requests in one. Create a class that
+    inherits from this, setting apis to a dictionary naming the API classes
+    that can be called, and register it like an API.
+
+    The body of a post is a list of sub-requests, each a dictionary with keys
+    api, method and params. Params are given as they would be in the query
+    string of a get or the JSON body of other methods. It can also be a
+    dictionary with the list under requests and atomic true, which runs every
+    sub-request in a single transaction that's rolled back if any of them
+    fails.
+
+    The response has a result for each sub-request with the status code it
+    would have returned and its body, which is null for bodiless responses
+    like a 304, and a string for bodies that aren't JSON. Failures use the
+    same format as the LeverExceptions a normal request raises. Streamed
+    responses, from __stream or __export, can't be batched. """
+    apis = {}
+    # the API classes that can be called, keyed by the name used in requests
+    max_batch_size = 50
+    # the most sub-requests a single batch can contain
+    methods_allowed = ('get', 'post', 'put', 'delete')
+    # the API methods sub-requests can call
+    session = None
+    # The database session from SQLAlchemy, needed for atomic batches
+    atomic = False
+    written = ()
+    # state of the current batch. Atomic batches collect the tables written
+    # so cached results can be invalidated once it's committed
+
+    def post(self):
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            requests = body.get('requests')
+            self.atomic = bool(body.get('atomic', False))
+        else:
+            requests = body
+        if not isinstance(requests, list):
+            raise LeverSyntaxError("A batch takes a list of requests",
+                                   end_user={'success': False})
+        if self.max_batch_size is not None and \
+                len(requests) > self.max_batch_size:
+            raise LeverSyntaxError(
+                "Can't make more than {0} requests in one batch"
+                .format(self.max_batch_size), end_user={'success': False})
+        if self.atomic and self.session is None:
+            raise LeverSyntaxError("This batch endpoint can't be atomic",
+                                   end_user={'success': False})
+        self.written = set()
+
+        results = []
+        failed = False
+        for sub in requests:
+            if failed:
+                results.append(self.result(424, {
+                    'success': False,
+                    'message': "An earlier request in the batch failed"}))
+                continue
+            status, body = self.run(sub)
+            results.append(self.result(status, body))
+            failed = self.atomic and status >= 400
+
+        if self.atomic:
+            if failed:
+                self.session.rollback()
+            else:
+                self.session.commit()
+                invalidate_tables(self.written)
+
+        # the bodies are already encoded, so they're spliced in as they are
+        data = '{{"success":{0},"results":[{1}]}}'.format(
+            'false' if failed else 'true', ','.join(results))
+        return current_app.response_class(data, mimetype='application/json')
+
+    def result(self, status, body):
+        """ Encodes the result of a sub-request. The body is either a string
+        of encoded JSON or a dictionary to encode """
+        if not isinstance(body, six.string_types):
+            body = json.dumps(body, default=str)
+        return '{{"status":{0},"body":{1}}}'.format(status, body or 'null')
+
+    def run(self, sub):
+        """ Runs a single sub-request with a new instance of its API, returning
+        the status code and body of the response """
+        if not isinstance(sub, dict):
+            return 400, {'success': False,
+                         'message': "Each request must be a dictionary"}
+        api = self.apis.get(sub.get('api'))
+        if api is None:
+            return 404, {'success': False,
+                         'message': "Unknown api {0}".format(sub.get('api'))}
+        method = str(sub.get('method', 'get')).lower()
+        if method not in self.methods_allowed:
+            return 405, {'success': False,
+                         'message': "Unsupported method {0}".format(method)}
+
+        params = sub.get('params')
+        # ACL decisions are memoized for the request, but an earlier
+        # sub-request may have changed the objects they were made on
+        request.environ.pop('lever.acl_cache', None)
+        # the view is built by as_view so its decorators and dispatch_request
+        # run as they would for a request made directly
+        view = api.as_view(api.__name__, batch=self,
+                           batch_params={} if params is None else params,
+                           batch_method=method.upper())
+        try:
+            response = current_app.make_response(view())
+        except HTTPException as e:
+            return e.code, {'success': False, 'message': e.description}
+        except Exception:
+            info = sys.exc_info()
+            # a failed statement leaves the session unusable until it's rolled
+            # back, which atomic batches do at the end
+            if not self.atomic:
+                api.session.rollback()
+            try:
+                exc = api().translate_exception(info)
+            except Exception:
+                current_app.logger.error("Error in batch request",
+                                         exc_info=True)
+                return 500, {'success': False,
+                             'message': "An unknown error occurred"}
+            return exc.code, dict(exc.end_user, success=False)
+        # streamed responses, like exports, would have to be read entirely
+        # into the batch's response
+        if response.is_streamed:
+            response.close()
+            return 400, {'success': False,
+                         'message': "Streaming requests can't be batched"}
+        body = response.get_data(as_text=True)
+        if body and response.mimetype != 'application/json':
+            # bodies that aren't JSON are embedded as a string
+            body = json.dumps(body)
+        return response.status_code, body
+
+    @classmethod
+    def register(cls, mod, url):
+        """ Registers the batch endpoint to a blueprint or application """
+        symfunc = cls.as_view(cls.__name__)
+        mod.add_url_rule(url, view_func=symfunc, methods=['POST'])
@@ -0,0 +1,191 @@
+""" Backends for caching the encoded results of API gets. An API opts in by
+setting its result_cache attribute to one of these, for instance:
+
+class BookAPI(API):
+    model = Book
+    session = db.session
+    result_cache = MemoryCache(max_bytes=64 * 1024 * 1024)
+
+Entries are keyed by everything the response depends on, including a
+generation number for every table it was read from. Writing to a table through
+an API bumps the table's generation, so entries read from it are never looked
+up again and age out of the cache. Every cache in the process is invalidated,
+so APIs writing to a table don't need a cache of their own. Memory caches
+aren't shared between processes, so with several workers a FileCache should be
+used. """
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import weakref
+
+
+# every cache created in this process, for invalidate_tables
+_caches = weakref.WeakSet()
+
+
+def invalidate_tables(tables):
+    """ Invalidates the entries read from any of tables in every cache """
+    for cache in list(_caches):
+        for table in tables:
+            cache.invalidate(table)
+
+
+class ResultCache(object):
+    """ The interface result caches implement. Values are bytes. """
+
+    def __init__(self):
+        _caches.add(self)
+
+    def get(self, key):
+        """ Returns the value stored for key, or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Stores value under key """
+        raise NotImplementedError
+
+    def generation(self, table):
+        """ Returns a string that changes every time the table is
+        invalidated """
+        raise NotImplementedError
+
+    def invalidate(self, table):
+        """ Makes every entry read from table unreachable """
+        raise NotImplementedError
+
+    def make_key(self, parts, tables):
+        """ Hashes the JSON serializable parts of a key together with the
+        current generations of the tables the result was read from """
+        generations = [(table, self.generation(table))
+                       for table in sorted(tables)]
+        data = json.dumps([parts, generations], sort_keys=True, default=str,
+                          separators=(',', ':'))
+        return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+class MemoryCache(ResultCache):
+    """ An in process least recently used cache limited to max_bytes of
+    stored values """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        ResultCache.__init__(self)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        # values bigger than the whole budget would just evict everything
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def invalidate(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+
+class FileCache(ResultCache):
+    """ A cache stored as files in a directory, which can be shared by all the
+    worker processes on a machine. The operating system's page cache keeps
+    hot entries in memory. Every file is written under a temporary name and
+    renamed into place, so readers never see partial values. Table
+    generations are random tokens stored the same way.
+
+    Once more than max_entries values are stored, the least recently written
+    ones are removed. The directory is checked every prune_interval writes
+    made by this process. """
+
+    def __init__(self, path, max_entries=10000, prune_interval=100):
+        ResultCache.__init__(self)
+        self.path = path
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._writes = 0
+        for sub in ('entries', 'generations'):
+            try:
+                os.makedirs(os.path.join(path, sub))
+            except OSError:
+                if not os.path.isdir(os.path.join(path, sub)):
+                    raise
+
+    def _write(self, path, value):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(tmp, path)
+        except Exception:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, 'entries', key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        self._write(os.path.join(self.path, 'entries', key), value)
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """ Removes the oldest entries beyond max_entries """
+        directory = os.path.join(self.path, 'entries')
+        entries = []
+        for name in os.listdir(directory):
+            try:
+                entries.append(
+                    (os.path.getmtime(os.path.join(directory, name)), name))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, name in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _generation_path(self, table):
+        # table names are hashed so they're always valid file names
+        name = hashlib.sha1(table.encode('utf8')).hexdigest()
+        return os.path.join(self.path, 'generations', name)
+
+    def generation(self, table):
+        try:
+            with open(self._generation_path(table), 'rb') as f:
+                return f.read().decode('ascii')
+        except (IOError, OSError):
+            return ''
+
+    def invalidate(self, table):
+        token = hashlib.sha1(os.urandom(16)).hexdigest().encode('ascii')
+        self._write(self._generation_path(table), token)
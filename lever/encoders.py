@@ -0,0 +1,92 @@
+""" Encoders turn the dictionaries APIs build into response bodies. The encoder
+is chosen by the API's encoder attribute, falling back to the LEVER_ENCODER
+config value of the application and then to 'auto', which uses orjson when it's
+installed and the standard library otherwise. Either can be set to the name of
+a registered encoder or an Encoder instance. """
+from flask import current_app
+from werkzeug.http import http_date
+
+import datetime
+import json
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Encoder(object):
+    """ Encodes JSON serializable values into bytes """
+    mimetype = 'application/json'
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+
+class StdlibEncoder(Encoder):
+    """ Compact JSON using the json module and the application's JSON encoder
+    class, so values are converted the same way as jsonify does """
+
+    def dumps(self, obj):
+        data = json.dumps(obj, cls=current_app.json_encoder,
+                          separators=(',', ':'),
+                          sort_keys=current_app.config.get('JSON_SORT_KEYS',
+                                                           True))
+        return data.encode('utf8')
+
+
+def _orjson_default(obj):
+    # orjson would write datetimes in ISO format, but jsonify sends http dates
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return http_date(obj)
+    return current_app.json_encoder().default(obj)
+
+
+class OrjsonEncoder(Encoder):
+    """ JSON encoded by orjson, which is several times faster than the json
+    module. Keys aren't sorted """
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson must be installed to use OrjsonEncoder")
+        self.option = orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=_orjson_default, option=self.option)
+
+
+# encoders that can be selected by name, created when first used
+encoders = {
+    'json': StdlibEncoder,
+    'orjson': OrjsonEncoder,
+}
+_instances = {}
+
+
+def register_encoder(name, encoder_cls):
+    """ Makes an Encoder class selectable by name """
+    encoders[name] = encoder_cls
+    _instances.pop(name, None)
+
+
+def get_encoder(encoder=None):
+    """ Resolves an encoder name or instance, where None uses the application's
+    LEVER_ENCODER setting """
+    if encoder is None:
+        encoder = current_app.config.get('LEVER_ENCODER', 'auto')
+    if not isinstance(encoder, six.string_types):
+        return encoder
+    if encoder == 'auto':
+        encoder = 'json' if orjson is None else 'orjson'
+    try:
+        return _instances[encoder]
+    except KeyError:
+        pass
+    try:
+        encoder_cls = encoders[encoder]
+    except KeyError:
+        raise LookupError("Unknown encoder {0}".format(encoder))
+    inst = _instances[encoder] = encoder_cls()
+    return inst
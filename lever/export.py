@@ -0,0 +1,155 @@
+""" Exports serialized by a pool of worker processes, see API.export. The pool
+is forked for each export, so workers inherit the application, the models and
+the export's query without pickling them, then load and serialize ranges of
+primary keys with their own engine and session. """
+import collections
+import csv
+import itertools
+import multiprocessing
+import threading
+
+import six
+import sqlalchemy
+import sqlalchemy.orm
+
+from .base import get_joined, _csv_value
+from .encoders import get_encoder
+
+
+class PartitionJob(object):
+    """ Everything the workers of an export need, inherited when they're
+    forked """
+
+    def __init__(self, app, query, pkey, join, fmt, encoder, chunk_size):
+        self.app = app
+        self.query = query
+        self.pkey = pkey
+        self.join = join
+        self.fmt = fmt
+        self.encoder = encoder
+        self.chunk_size = chunk_size
+        self.url = query.session.get_bind(
+            query.column_descriptions[0]['entity']).url
+
+
+# the job being forked, and the worker state of each worker process
+_job = None
+_job_lock = threading.Lock()
+_worker = {}
+
+
+def partition_bounds(keys, size):
+    """ Splits an ascending iterable of integer keys into half open ranges
+    holding size keys each, except for the last """
+    bounds = []
+    start = last = None
+    count = 0
+    for key in keys:
+        if start is None:
+            start = key
+        elif count == size:
+            bounds.append((start, key))
+            start, count = key, 0
+        count += 1
+        last = key
+    if start is not None:
+        bounds.append((start, last + 1))
+    return bounds
+
+
+def _init_worker():
+    job = _worker['job'] = _job
+    ctx = job.app.app_context()
+    ctx.push()
+    _worker['ctx'] = ctx
+    # connections inherited from the parent mustn't be shared, so every worker
+    # connects with an engine of its own
+    _worker['engine'] = sqlalchemy.create_engine(job.url)
+
+
+def _export_partition(bounds):
+    """ Serializes the objects with primary keys in the range bounds. Returns
+    the keys of the first object, which CSV exports use as the header, and the
+    encoded rows """
+    job = _worker['job']
+    session = sqlalchemy.orm.Session(bind=_worker['engine'])
+    try:
+        query = job.query.with_session(session).\
+            filter(job.pkey >= bounds[0], job.pkey < bounds[1]).\
+            order_by(job.pkey).yield_per(job.chunk_size)
+        encoder = get_encoder(job.encoder)
+        header = None
+        out = six.StringIO()
+        writer = csv.writer(out)
+        data = []
+        for obj in query:
+            row = get_joined(obj, job.join)
+            if header is None:
+                header = sorted(row)
+            if job.fmt == 'csv':
+                writer.writerow([_csv_value(row.get(key), encoder)
+                                 for key in header])
+            else:
+                data.append(encoder.dumps(row))
+                data.append(b'\n')
+        if job.fmt == 'csv':
+            return header, out.getvalue().encode('utf8')
+        return header, b''.join(data)
+    finally:
+        session.close()
+
+
+def export_partitions(job, bounds, workers):
+    """ Starts a pool of workers to serialize the partitions of a job,
+    returning an iterator of their results in the order of bounds. Two
+    partitions per worker are queued at a time, so results don't pile up
+    when they're written slower than they're made. The pool is closed once
+    the iterator is exhausted or closed """
+    global _job
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        context = multiprocessing
+    # the job is only read while the workers are forked
+    with _job_lock:
+        _job = job
+        try:
+            pool = context.Pool(workers, initializer=_init_worker)
+        finally:
+            _job = None
+
+    def results():
+        remaining = iter(bounds)
+        pending = collections.deque(
+            pool.apply_async(_export_partition, (b, ))
+            for b in itertools.islice(remaining, workers * 2))
+        try:
+            while pending:
+                result = pending.popleft().get()
+                for b in itertools.islice(remaining, 1):
+                    pending.append(pool.apply_async(_export_partition, (b, )))
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return results()
+
+
+def merge_partitions(results, fmt):
+    """ Joins the results of export_partitions into the body of the export,
+    writing the header of CSV exports first """
+    results = iter(results)
+    if fmt == 'csv':
+        # the header comes from the first partition holding any objects
+        for header, data in results:
+            if header is not None:
+                out = six.StringIO()
+                csv.writer(out).writerow(header)
+                yield out.getvalue().encode('utf8')
+                yield data
+                break
+    for header, data in results:
+        if data:
+            yield data
+
@@ -1,8 +1,39 @@
-from flask import current_app
+from flask import current_app, has_request_context, request
 from flask.ext.login import current_user
 from flask.ext.sqlalchemy import BaseQuery
 
+import json
 import six
+import sqlalchemy
+
+from .acl import BitACL
+
+
+def acl_cache():
+    """ Returns the dictionary ACL decisions are memoized in for the current
+    request, or None outside of a request. It's stored in the WSGI environ so
+    it's thrown away along with the request at teardown """
+    if not has_request_context():
+        return None
+    cache = request.environ.get('lever.acl_cache')
+    if cache is None:
+        cache = request.environ['lever.acl_cache'] = {}
+    return cache
+
+
+def _user_key(user):
+    """ Identifies a user for the length of a request. The current_user proxy
+    is resolved so it shares entries with the object it points to """
+    get_current = getattr(user, '_get_current_object', None)
+    if get_current is not None:
+        user = get_current()
+    return id(user)
+
+
+def _fingerprint(parents):
+    """ A hashable representation of the parent information passed to
+    can_cls. Anything that isn't plain JSON is represented by its repr """
+    return json.dumps(parents, sort_keys=True, default=repr)
 
 
 class BaseMapper(object):
@@ -14,6 +45,11 @@ class BaseMapper(object):
     query_class = BaseQuery
     query = None
 
+    # The names of the columns roles and can read. Join profiles that don't
+    # serialize every column still load these for the ACL checks, and None
+    # loads every column
+    acl_columns = None
+
     # Access Control Methods
     # =========================================================================
     def roles(self, user=current_user):
@@ -22,6 +58,43 @@ class BaseMapper(object):
         p_roles function. """
         return []
 
+    @classmethod
+    def roles_many(cls, objs, user=current_user):
+        """ Can be overriden to determine the roles of many instances at once,
+        for instance with a single query against a membership table. Should
+        return a list holding the roles of each object in objs, in the same
+        order. The default of None falls back to calling roles on each
+        instance. """
+        return None
+
+    @classmethod
+    def preload_roles(cls, objs, user=current_user):
+        """ Resolves the roles of objs through roles_many and stores them in
+        the request's ACL cache, where user_acl picks them up """
+        cache = acl_cache()
+        if cache is None or not objs:
+            return
+        roles = cls.roles_many(objs, user=user)
+        if roles is None:
+            return
+        user_key = _user_key(user)
+        for obj, obj_roles in zip(objs, roles):
+            identity = sqlalchemy.inspect(obj).key
+            if identity is not None:
+                cache[('roles', identity, user_key)] = list(obj_roles)
+
+    @classmethod
+    def forget_acl(cls, objs):
+        """ Removes the decisions memoized about objs from the request's ACL
+        cache, for objects that won't be checked again """
+        cache = acl_cache()
+        if not cache or not objs:
+            return
+        identities = set(sqlalchemy.inspect(obj).key for obj in objs)
+        for key in [k for k in cache if k[0] in ('user_acl', 'roles') and
+                    k[1] in identities]:
+            del cache[key]
+
     @classmethod
     def p_roles(self, **parents):
         """ Determines roles to be gained from parent objects. Usually uses the
@@ -29,30 +102,104 @@ class BaseMapper(object):
         class name """
         return []
 
+    @classmethod
+    def acl_filter(cls, action, user=current_user):
+        """ Can be overriden to return a SQLAlchemy filter clause matching the
+        instances the user is allowed to perform the action on, letting the
+        database do the check for whole queries. It has to agree with can.
+        The default of None means instances are checked one at a time """
+        return None
+
     def can(self, action, user=current_user):
         """ Can the user perform the action needed on this object instance?
         Checks for the desired key in a list of allowed action keys. """
-        keys = self.user_acl(user=user)
-        return action in keys
+        # subclasses overriding user_acl decide what's allowed themselves, so
+        # the compiled form can only be used when it's the default
+        if type(self).user_acl is not BaseMapper.user_acl:
+            return action in self.user_acl(user=user)
+        return self._permits(self._user_allowed(user), action)
 
     @classmethod
     def can_cls(cls, action, user=current_user, **parents):
         """ Similar to can, except does not include instance specific roles.
         Intended to be used to determine if pre-creation events can occur, such
         as create or create_other. Requires the data on parents to be passed in
-        via keyword arguments to determine parent roles"""
-        return action in cls._role_mix(cls.p_roles(**parents) + user.global_roles())
+        via keyword arguments to determine parent roles. The allowed keys are
+        memoized for the request by the parent information given. """
+        cache = acl_cache()
+        if cache is None:
+            return cls._permits(cls._role_allowed(
+                cls.p_roles(**parents) + user.global_roles()), action)
+
+        key = ('can_cls', cls, _user_key(user), _fingerprint(parents))
+        allowed = cache.get(key)
+        if allowed is None:
+            allowed = cache[key] = cls._role_allowed(
+                cls.p_roles(**parents) + cls._global_roles(user))
+        return cls._permits(allowed, action)
 
     def user_acl(self, user=current_user):
         """ A list of access keys the user has with context to the current
         object """
-        roles = self.roles(user=user) + user.global_roles()
-        return self._role_mix(roles)
+        allowed = self._user_allowed(user)
+        if isinstance(self.acl, BitACL):
+            return self.acl.keys_for(allowed)
+        return allowed
+
+    def _user_allowed(self, user):
+        """ The allowed keys of the user on this object in the form returned by
+        _role_allowed. Memoized for the request for persistent objects """
+        cache = acl_cache()
+        identity = sqlalchemy.inspect(self).key
+        if cache is None or identity is None:
+            return self._role_allowed(
+                self.roles(user=user) + user.global_roles())
+
+        user_key = _user_key(user)
+        key = ('user_acl', identity, user_key)
+        allowed = cache.get(key)
+        if allowed is None:
+            # use roles resolved in bulk by preload_roles if there are some
+            roles = cache.get(('roles', identity, user_key))
+            if roles is None:
+                roles = self.roles(user=user)
+            allowed = cache[key] = self._role_allowed(
+                roles + self._global_roles(user))
+        return allowed
+
+    @staticmethod
+    def _global_roles(user):
+        """ The global roles of a user, memoized for the request """
+        cache = acl_cache()
+        if cache is None:
+            return user.global_roles()
+        key = ('global_roles', _user_key(user))
+        roles = cache.get(key)
+        if roles is None:
+            roles = cache[key] = list(user.global_roles())
+        return roles
+
+    @classmethod
+    def _role_allowed(cls, roles):
+        """ The keys allowed by a list of roles, as a mask when the acl was
+        compiled to bitmasks and as a set otherwise """
+        if isinstance(cls.acl, BitACL):
+            return cls.acl.mask(roles)
+        return cls._role_mix(roles)
+
+    @classmethod
+    def _permits(cls, allowed, action):
+        """ Checks for an action in the output of _role_allowed """
+        if isinstance(cls.acl, BitACL):
+            return cls.acl.allows(allowed, action)
+        return action in allowed
 
     @classmethod
     def _role_mix(cls, roles):
         """ A utility that takes a list of roles and returns a set of allowed
         actions that was determined by those roles """
+        if isinstance(cls.acl, BitACL):
+            return cls.acl.keys_for(cls.acl.mask(roles))
         allowed = set()
         for role in roles:
             allowed |= cls.acl.get(role, set())
@@ -6,6 +6,10 @@ file.
 """
 from lever import build_acl
 
+import copy
+import json
+import os
+import tempfile
 import yaml
 import unittest
 
@@ -176,3 +180,105 @@ class TestACLContrstruction(unittest.TestCase):
                 key: also_exists""")
         acl = build_acl(struct)
         assert 'key_super_exists' in acl['testing2']['user']
+
+    def test_bitmask(self):
+        struct = yaml.load("""
+        testing:
+            user:
+                view: pages
+            admin:
+                inherit: user
+                edit:
+                    - pages
+                    - contents
+        testing2:
+            user:
+                view: contents""")
+        acl = build_acl(struct, bitmask=True)
+        admin = acl['testing'].mask(['admin'])
+        assert acl['testing'].allows(admin, 'view_pages')
+        assert acl['testing'].allows(admin, 'edit_contents')
+        assert not acl['testing'].allows(admin, 'view_contents')
+        assert not acl['testing'].allows(admin, 'missing')
+        assert acl['testing'].keys_for(admin) == build_acl(struct)['testing']['admin']
+        # keys are interned across types
+        assert acl['testing'].bits is acl['testing2'].bits
+        mask = acl['testing'].mask(['user', 'unknown'])
+        assert mask is acl['testing'].mask(['user', 'unknown'])
+        assert acl['testing'].keys_for(mask) == set(['view_pages'])
+
+    def test_structure_unmodified(self):
+        struct = yaml.load("""
+        testing:
+            other:
+                key2: exists
+            user:
+                key: exists
+                inherit: other
+        testing2:
+            inherit: testing
+            admin:
+                inherit: user""")
+        original = copy.deepcopy(struct)
+        build_acl(struct)
+        assert struct == original
+
+    def test_looping_role(self):
+        struct = yaml.load("""
+        testing:
+            admin:
+                inherit: user
+                key: admin
+            user:
+                inherit: admin
+                key: user""")
+        acl = build_acl(struct)
+        assert acl['testing']['admin'] == set(['key_admin', 'key_user'])
+        assert acl['testing']['user'] == acl['testing']['admin']
+
+    def test_inherit_type_and_role(self):
+        struct = yaml.load("""
+        testing:
+            admin:
+                inherit: user
+            user:
+                key: exists
+            mod:
+                key: moderates
+        testing2:
+            inherit: testing
+            admin:
+                inherit: mod""")
+        acl = build_acl(struct)
+        assert acl['testing2']['admin'] == set(['key_exists', 'key_moderates'])
+
+    def test_deep_chain(self):
+        struct = {'type0': {'role0': {'key': 'k0'}}}
+        for i in range(1, 100):
+            struct['type%d' % i] = {
+                'inherit': 'type%d' % (i - 1),
+                'role%d' % i: {'key': 'k%d' % i,
+                               'inherit': 'role%d' % (i - 1)}}
+        acl = build_acl(struct)
+        assert len(acl['type99']['role99']) == 100
+
+    def test_snapshot(self):
+        struct = yaml.load("""
+        testing:
+            user:
+                key: exists""")
+        path = os.path.join(tempfile.mkdtemp(), 'acl.json')
+        acl = build_acl(struct, snapshot=path)
+        assert os.path.exists(path)
+        assert build_acl(struct, snapshot=path) == acl
+        # a snapshot is only used for the structure it was made from
+        with open(path) as f:
+            data = json.load(f)
+        data['acl']['testing']['user'] = ['key_snapshot']
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        assert build_acl(struct, snapshot=path)['testing']['user'] == \
+            set(['key_snapshot'])
+        struct['testing']['user']['key'] = 'changed'
+        assert build_acl(struct, snapshot=path)['testing']['user'] == \
+            set(['key_changed'])
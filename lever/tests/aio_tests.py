@@ -0,0 +1,142 @@
+import asyncio
+import unittest
+
+from sqlalchemy.pool import StaticPool
+
+from lever import preprocess, postprocess
+from lever.tests.model_helpers import FlaskTestBase
+
+try:
+    import aiosqlite
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from lever.aio import AsyncAPI, LoopEngines, run
+except (ImportError, SyntaxError):
+    aiosqlite = None
+
+
+@unittest.skipIf(aiosqlite is None, "aiosqlite isn't installed")
+class TestAsyncAPI(FlaskTestBase):
+    """ Runs the common requests through an AsyncAPI on aiosqlite """
+    def setUp(self):
+        super(TestAsyncAPI, self).setUp()
+        self.provision_posts()
+        # the async engine gets its own in memory database, holding a copy of
+        # the data written by provision_posts
+        self.async_engine = create_async_engine(
+            'sqlite+aiosqlite://', poolclass=StaticPool,
+            connect_args={'check_same_thread': False})
+
+        async def copy():
+            async with self.async_engine.begin() as conn:
+                await conn.run_sync(self.base.metadata.create_all)
+                for table in self.base.metadata.sorted_tables:
+                    rows = [dict(r._mapping) for r in
+                            self.engine.execute(table.select())]
+                    if rows:
+                        await conn.execute(table.insert(), rows)
+        run(copy())
+        self.async_session = AsyncSession(self.async_engine,
+                                          expire_on_commit=False)
+        self.hooked = []
+
+        test = self
+
+        class AsyncPostAPI(AsyncAPI):
+            model = self.post_model
+            session = self.async_session
+
+            @preprocess(method='get')
+            async def async_hook(self):
+                test.hooked.append('pre')
+
+            @postprocess(method='get')
+            def sync_hook(self, retval):
+                test.hooked.append('post')
+
+        class AsyncCommentAPI(AsyncAPI):
+            model = self.comment_model
+            session = self.async_session
+        self.app.add_url_rule('/apost',
+                              view_func=AsyncPostAPI.as_view('apost'))
+        self.app.add_url_rule('/acomment',
+                              view_func=AsyncCommentAPI.as_view('acomment'))
+        self.api = AsyncPostAPI
+
+    def tearDown(self):
+        run(self.async_session.close())
+        run(self.async_engine.dispose())
+        super(TestAsyncAPI, self).tearDown()
+
+    def test_get_nested(self):
+        d = self.get('apost', 200)
+        assert d == self.get('post', 200)
+        assert len(d['objects'][0]['comments']) == 2
+        assert self.hooked == ['pre', 'post']
+
+    def test_get_single(self):
+        d = self.get('apost', 200, params={'id': 2})
+        assert d['objects'][0]['title'] == 'Post 1'
+        self.get('apost', 404, params={'id': 100})
+
+    def test_search_page_count(self):
+        d = self.get('apost', 200, params={
+            '__filter': [{'name': 'id', 'op': 'in', 'val': [1, 2, 3]}],
+            '__order_by': ['-id'], '__with_count': True, 'pg_size': 2})
+        assert [o['id'] for o in d['objects']] == [3, 2]
+        assert d['count'] == 3
+        d = self.get('apost', 400, params={'__filter': [{'name': 'nothing',
+                                                         'op': 'eq',
+                                                         'val': 1}]})
+
+    def test_keyset(self):
+        d = self.get('apost', 200, params={'__after': '', 'pg_size': 3})
+        d = self.get('apost', 200, params={'__after': d['next_cursor'],
+                                           'pg_size': 3})
+        assert [o['id'] for o in d['objects']] == [4]
+
+    def test_multi_get(self):
+        d = self.get('apost', 200, params={'id': '[3, 100, 1]'})
+        assert [o['id'] for o in d['objects']] == [3, 1]
+        assert d['missing'] == [100]
+
+    def test_write(self):
+        d = self.post('acomment', 200, params={'body': 'new', 'post_id': 1})
+        comment_id = d['objects'][0]['id']
+        self.put('acomment', 200, params={'id': comment_id, 'body': 'edited'})
+        d = self.get('acomment', 200, params={'id': comment_id})
+        assert d['objects'][0]['body'] == 'edited'
+        d = self.put('acomment', 200, params={'__filter_by': {'post_id': 1},
+                                              'body': 'all'})
+        assert d['count'] == 3
+        self.delete('acomment', 200, params={'id': comment_id})
+        self.delete('acomment', 404, params={'id': comment_id})
+
+    def test_bulk_writes(self):
+        self.api.bulk_writes = True
+        d = self.put('apost', 200, params={
+            '__filter': [{'name': 'id', 'op': '>', 'val': 2}],
+            'title': 'later'})
+        assert d['count'] == 2
+        d = self.get('apost', 200, params={'__filter_by': {'title': 'later'}})
+        assert len(d['objects']) == 2
+        self.put('apost', 400, params={'id': 1, 'nothing': 'new'})
+
+    def test_teardown_once(self):
+        teardowns = []
+        self.app.teardown_request(lambda exc: teardowns.append(exc))
+        self.get('apost', 200)
+        assert len(teardowns) == 1
+
+    def test_loop_engines(self):
+        engines = LoopEngines('sqlite+aiosqlite://')
+
+        async def current():
+            return engines.current()
+        engine = run(current())
+        assert run(current()) is engine
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(current()) is not engine
+        finally:
+            loop.close()
+        run(engine.dispose())
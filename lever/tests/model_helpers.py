@@ -5,10 +5,10 @@ import json
 
 from flask import Flask, jsonify
 from flask.ext.login import LoginManager, current_user, login_user
-from sqlalchemy import (Column, create_engine, DateTime, Date, Float,
+from sqlalchemy import (Column, create_engine, DateTime, Date, Float, event,
                         ForeignKey, Integer, Boolean, Unicode, create_engine)
 from sqlalchemy.orm.scoping import scoped_session
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from pprint import pprint
 
@@ -23,6 +23,7 @@ class FlaskTestBase(unittest.TestCase):
     application itself is accessible at ``self.flaskapp``.
 
     """
+    database_url = 'sqlite://'
 
     def setUp(self):
         """Creates the Flask application and the APIManager."""
@@ -34,7 +35,7 @@ class FlaskTestBase(unittest.TestCase):
         del app.logger.handlers[0]
         # sqlalchemy flask
         self.base = declarative_base()
-        self.engine = create_engine('sqlite://')
+        self.engine = create_engine(self.database_url)
         self.session = scoped_session(sessionmaker(autocommit=False,
                                                    autoflush=False,
                                                    bind=self.engine))
@@ -103,6 +104,17 @@ class FlaskTestBase(unittest.TestCase):
             assert not j['success']
         return j
 
+    def record_queries(self):
+        """ Returns a list that every statement run from now on is added to
+        """
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        return queries
+
     def patch(self, uri, status_code, **kwargs):
         return self.post(uri, status_code, typ='patch', **kwargs)
 
@@ -129,6 +141,8 @@ class FlaskTestBase(unittest.TestCase):
             session = self.session
 
         self.app.add_url_rule('/widget', view_func=WidgetAPI.as_view('widget'))
+        self.widget_api = WidgetAPI
+        self.widget_model = Widget
 
         return Widget, WidgetAPI
 
@@ -142,6 +156,67 @@ class FlaskTestBase(unittest.TestCase):
         self.session.commit()
         return obj
 
+    def relation_api(self):
+        """ Generates an API endpoint for a model with nested relationships,
+        used to test join profiles that reach into other objects """
+        class Author(self.base):
+            __tablename__ = 'author'
+            id = Column(Integer, primary_key=True)
+            username = Column(Unicode)
+
+            standard_join = ['username', 'id']
+
+        class Comment(self.base):
+            __tablename__ = 'comment'
+            id = Column(Integer, primary_key=True)
+            body = Column(Unicode)
+            post_id = Column(Integer, ForeignKey('post.id'))
+            author_id = Column(Integer, ForeignKey('author.id'))
+            author = relationship(Author)
+
+            standard_join = ['__dont_mongo', 'id', 'body', {'obj': 'author'}]
+
+        class Post(self.base):
+            __tablename__ = 'post'
+            id = Column(Integer, primary_key=True)
+            title = Column(Unicode)
+            body = Column(Unicode)
+            author_id = Column(Integer, ForeignKey('author.id'))
+            author = relationship(Author)
+            comments = relationship(Comment, order_by=Comment.id)
+
+            standard_join = ['-body', {'obj': 'author'}, {'obj': 'comments'}]
+            brief_join = ['__dont_mongo', 'id', 'title']
+
+        class PostAPI(API):
+            model = Post
+            session = self.session
+
+        self.app.add_url_rule('/post', view_func=PostAPI.as_view('post'))
+        self.post_model = Post
+        self.comment_model = Comment
+        self.author_model = Author
+        self.post_api = PostAPI
+        return Post, PostAPI
+
+    def provision_posts(self, count=4):
+        """ Creates a set of posts, each with a couple of comments """
+        post, api = self.relation_api()
+        self.base.metadata.create_all(self.engine)
+        authors = [self.author_model(username=u'author%d' % i)
+                   for i in range(2)]
+        posts = []
+        for i in range(count):
+            p = post(title=u'Post %d' % i, body=u'body text ' * 50,
+                     author=authors[i % 2])
+            p.comments = [self.comment_model(body=u'comment %d' % j,
+                                             author=authors[j % 2])
+                          for j in range(2)]
+            posts.append(p)
+        self.session.add_all(posts)
+        self.session.commit()
+        return posts
+
     def provision_many_asset(self):
         widget, api = self.basic_api()
         self.base.metadata.create_all(self.engine)
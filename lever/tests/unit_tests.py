@@ -1,13 +1,34 @@
 import unittest
 import types
+import calendar
+import collections
+import csv
 import datetime
-
-from flask import Flask
+import decimal
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from flask import Flask, request
+from flask.ext.login import current_user
 from pprint import pprint
-from sqlalchemy import (Column, create_engine, DateTime, Date, Float,
-                        ForeignKey, Integer, Boolean, Unicode, create_engine)
-
-from lever import API, preprocess, postprocess, ModelBasedACL, ImpersonateMixin
+from sqlalchemy import (Column, create_engine, DateTime, Date, Float, event,
+                        ForeignKey, Integer, Boolean, Unicode, create_engine,
+                        inspect, Numeric, PickleType, Time)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
+
+from lever import (API, preprocess, postprocess, ModelBasedACL,
+                   ImpersonateMixin, compile_join, get_joined, build_acl,
+                   BatchAPI, jsonize, register_converter, restrict_join)
+from lever.base import (encode_cursor, decode_cursor, _search_plans,
+                        _converters, _resolved, _identity)
+from lever import encoders
+from lever import base as base_module
+from lever.cache import FileCache, MemoryCache
+from lever.mapper import acl_cache
 from lever.tests.model_helpers import FlaskTestBase, TestUserACL
 
 
@@ -197,6 +218,39 @@ class TestGet(FlaskTestBase):
         d = self.get('widget', 200)
         assert len(d['objects']) >= 4
 
+    def test_multi_get(self):
+        objs = self.provision_many_asset()
+        ids = [objs[2].id, 1000, objs[0].id, objs[3].id]
+        d = self.get('widget', 200, params={'id': ids})
+        assert [o['id'] for o in d['objects']] == [objs[2].id, objs[0].id,
+                                                   objs[3].id]
+        assert d['missing'] == [1000]
+
+    def test_multi_get_identity_map(self):
+        objs = self.provision_many_asset()
+        api = self.widget_api()
+        api.params = {}
+        keys = [objs[1].id, str(objs[0].id)]
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        found, missing = api.get_objs(keys)
+        event.remove(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        assert found == [objs[1], objs[0]]
+        assert missing == []
+        # only the string key misses the identity map
+        assert len(queries) == 1
+
+    def test_multi_get_too_many(self):
+        self.provision_many_asset()
+        self.widget_api.max_pg_size = 2
+        d = self.get('widget', 400, params={'id': [1, 2, 3]})
+        assert "more than 2" in d['message']
+
 
 class TestPut(FlaskTestBase):
     """ Test facets of our get method """
@@ -265,6 +319,200 @@ class TestPost(FlaskTestBase):
         assert 'missing key' in ret['message']
 
 
+class TestBulkCreate(FlaskTestBase):
+    """ Tests creating many objects with a single post """
+    def setUp(self):
+        super(TestBulkCreate, self).setUp()
+        self.basic_api()
+        self.base.metadata.create_all(self.engine)
+
+    def test_list(self):
+        queries = self.record_queries()
+        p = self.post('widget', 200,
+                      params=[{'name': u'w%d' % i} for i in range(20)])
+        assert p['created'] == 20
+        assert len([q for q in queries if q.startswith('INSERT')]) == 1
+        assert self.session.query(self.widget_model).count() == 20
+
+    def test_return_pks(self):
+        p = self.post('widget', 200, params={
+            '__bulk': [{'name': u'one'}, {'name': u'two'}],
+            '__return_pks': True, 'description': u'shared'})
+        ids = [r['id'] for r in p['results']]
+        objs = self.session.query(self.widget_model).order_by('id').all()
+        assert ids == [o.id for o in objs]
+        assert [o.description for o in objs] == [u'shared', u'shared']
+
+    def test_item_errors(self):
+        p = self.post('widget', 200, success=False, params=[
+            {'name': u'one'}, {'nme': u'two'}, {'name': u'three'}])
+        assert p['created'] == 2
+        assert not p['results'][1]['success']
+        assert p['results'][1]['code'] == 400
+        assert 'nme' in p['results'][1]['message']
+
+    def test_permission(self):
+        class DeniedAPI(self.widget_api):
+            def can_cls(self, action):
+                return self.params.get('name') != u'denied'
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        p = self.post('denied', 200, success=False, params=[
+            {'name': u'one'}, {'name': u'denied'}])
+        assert p['results'][1]['code'] == 403
+        assert self.session.query(self.widget_model).count() == 1
+
+    def test_hooks(self):
+        class HookedAPI(self.widget_api):
+            @postprocess(method='post')
+            def add_description(self, obj):
+                obj.description = u'hooked'
+                return obj
+        self.app.add_url_rule('/hooked',
+                              view_func=HookedAPI.as_view('hooked'))
+        p = self.post('hooked', 200, params={
+            '__bulk': [{'name': u'one'}, {'name': u'two'}],
+            '__return_pks': True})
+        assert all(r['id'] for r in p['results'])
+        objs = self.session.query(self.widget_model).all()
+        assert [o.description for o in objs] == [u'hooked', u'hooked']
+
+    def test_pre_hooks(self):
+        class ForcedAPI(self.widget_api):
+            @preprocess(method='post')
+            def force_description(self):
+                self.params['description'] = u'forced'
+        self.app.add_url_rule('/forced',
+                              view_func=ForcedAPI.as_view('forced'))
+        self.post('forced', 200, params=[
+            {'name': u'one', 'description': u'mine'}, {'name': u'two'}])
+        objs = self.session.query(self.widget_model).all()
+        assert [o.description for o in objs] == [u'forced', u'forced']
+
+    def test_related_pre_hook(self):
+        self.provision_posts(count=1)
+        author = self.session.query(self.author_model).first()
+
+        class AuthoredAPI(self.post_api):
+            @preprocess(method='post')
+            def set_author(self):
+                self.params['author'] = author
+        self.app.add_url_rule('/authored',
+                              view_func=AuthoredAPI.as_view('authored'))
+        p = self.post('authored', 200, params={
+            '__bulk': [{'title': u'one'}, {'title': u'two'}],
+            '__return_pks': True})
+        assert p['created'] == 2
+        posts = self.session.query(self.post_model).filter(
+            self.post_model.id.in_([r['id'] for r in p['results']])).all()
+        assert [o.author_id for o in posts] == [author.id, author.id]
+
+    def test_insert_events(self):
+        inserted = []
+
+        def before_insert(mapper, connection, target):
+            inserted.append(target.name)
+        event.listen(self.widget_model, 'before_insert', before_insert)
+        self.post('widget', 200, params=[{'name': u'one'}, {'name': u'two'}])
+        assert inserted == [u'one', u'two']
+
+    def test_duplicate(self):
+        self.post('widget', 409, params=[{'name': u'one'},
+                                         {'name': u'one'}])
+        self.session.rollback()
+        assert self.session.query(self.widget_model).count() == 0
+
+    def test_too_many(self):
+        self.widget_api.max_bulk_size = 1
+        self.post('widget', 400, params=[{'name': u'one'}, {'name': u'two'}])
+
+
+class TestBulkWrite(FlaskTestBase):
+    """ Tests puts and deletes by search and set based writes """
+    def setUp(self):
+        super(TestBulkWrite, self).setUp()
+        self.objs = self.provision_many_asset()
+
+    def descriptions(self):
+        return sorted(o.description for o in
+                      self.session.query(self.widget_model)
+                      if o.description)
+
+    def test_put_filter(self):
+        p = self.put('widget', 200, params={
+            '__filter': [{'name': 'name', 'op': 'like', 'val': '%l%'}],
+            'description': u'new'})
+        assert p['count'] == 3
+        assert self.descriptions() == [u'new'] * 3
+
+    def test_delete_filter_by(self):
+        p = self.delete('widget', 200,
+                        params={'__filter_by': {'name': 'sdflgk'}})
+        assert p['count'] == 1
+        assert self.session.query(self.widget_model).count() == 3
+
+    def test_per_object_denied(self):
+        class DeniedAPI(self.widget_api):
+            def can(self, obj, action):
+                return obj.name != u'lcxvmnl'
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        self.put('denied', 403, params={
+            '__filter': [{'name': 'name', 'op': 'like', 'val': '%l%'}],
+            'description': u'new'})
+        self.session.rollback()
+        assert self.descriptions() == []
+
+    def test_too_many(self):
+        self.widget_api.max_bulk_size = 2
+        self.delete('widget', 400, params={
+            '__filter': [{'name': 'id', 'op': '>', 'val': 0}]})
+
+    def test_set_based(self):
+        self.widget_api.bulk_writes = True
+        queries = self.record_queries()
+        p = self.put('widget', 200, params={
+            '__filter': [{'name': 'name', 'op': 'in',
+                          'val': ['sdflgk', 'owuertoi']}],
+            'description': u'new'})
+        assert p['count'] == 2
+        assert len(queries) == 1
+        assert queries[0].startswith('UPDATE')
+        assert self.descriptions() == [u'new'] * 2
+
+    def test_set_based_pkey(self):
+        self.widget_api.bulk_writes = True
+        obj_id = self.objs[0].id
+        queries = self.record_queries()
+        self.put('widget', 200, params={'id': obj_id, 'description': u'new'})
+        assert len(queries) == 1
+        assert self.session.query(self.widget_model).get(obj_id).\
+            description == u'new'
+        self.delete('widget', 404, params={'id': 1000})
+
+    def test_empty_search(self):
+        self.delete('widget', 400, params={'__filter': []})
+        self.delete('widget', 400, params={'__filter_by': {}})
+        self.widget_api.bulk_writes = True
+        self.put('widget', 400, params={'__filter': [],
+                                        'description': u'new'})
+        assert self.session.query(self.widget_model).count() == 4
+
+    def test_set_based_denied(self):
+        class DeniedAPI(self.widget_api):
+            bulk_writes = True
+
+            def can_cls(self, action):
+                return action != 'delete'
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        self.delete('denied', 403, params={'__filter_by': {'name': 'sdflgk'}})
+        self.put('denied', 400, params={'__filter_by': {'name': 'sdflgk'},
+                                        'nme': u'new'})
+        self.put('denied', 200, params={'__filter_by': {'name': 'sdflgk'},
+                                        'description': u'new'})
+
+
 class TestSearch(FlaskTestBase):
     """ Run a bunch of positive and negative tests on our searching system """
     def test_filter_by(self):
@@ -284,6 +532,20 @@ class TestSearch(FlaskTestBase):
         ret = self.get('widget', 400, params={'__filter_by': {'sdflgj': True}})
         assert 'invalid field' in ret['message']
 
+    def test_malformed(self):
+        self.provision_single_asset()
+        for params in [{'__order_by': [{'a': 1}]},
+                       {'__order_by': {'a': 1}},
+                       {'__filter': [{'name': ['name'], 'op': 'eq',
+                                      'val': 1}]},
+                       {'__filter': [{'name': 'name', 'op': ['eq'],
+                                      'val': 1}]},
+                       {'__filter': [{'name': 'name', 'op': 'eq',
+                                      'field': {}}]},
+                       {'__filter': {'name': 'name'}},
+                       {'__filter_by': [['name', 1]]}]:
+            self.get('widget', 400, params=params)
+
     def test_query_filter(self):
         obj = self.provision_single_asset()
         ret = self.get('widget', 200,
@@ -346,6 +608,41 @@ class TestSearch(FlaskTestBase):
         ret = self.get('widget', 400, params={'__order_by': ['dflgjksdfgl']})
         assert 'Order_by operator' in ret['message']
 
+    def test_search_plan_cached(self):
+        self.provision_many_asset()
+        for name in ['sdflgk', 'owuertoi']:
+            ret = self.get('widget', 200, params={'__filter': [
+                {'val': name, 'name': 'name', 'op': 'eq'}]})
+            assert [o['name'] for o in ret['objects']] == [name]
+        plans = _search_plans[self.widget_api]
+        assert len(plans) == 1
+        self.get('widget', 200, params={'__order_by': ['-id']})
+        assert len(plans) == 2
+
+    def test_search_cache_size(self):
+        self.provision_many_asset()
+        self.widget_api.search_cache_size = 1
+        self.get('widget', 200, params={'__order_by': ['-id']})
+        self.get('widget', 200, params={'__order_by': ['id']})
+        assert list(_search_plans[self.widget_api]) == [
+            ((), ('id', ), ())]
+
+    def test_query_filter_in(self):
+        self.provision_many_asset()
+        for names in [['sdflgk', 'lcxvmnl'], ['owuertoi']]:
+            ret = self.get('widget', 200, params={'__filter': [
+                {'val': names, 'name': 'name', 'op': 'in'}]})
+            assert sorted(o['name'] for o in ret['objects']) == sorted(names)
+
+    def test_filter_none(self):
+        self.provision_many_asset()
+        ret = self.get('widget', 200, params={'__filter': [
+            {'val': None, 'name': 'description', 'op': 'eq'}]})
+        assert len(ret['objects']) == 4
+        ret = self.get('widget', 200,
+                       params={'__filter_by': {'description': None}})
+        assert len(ret['objects']) == 4
+
 
 class TestLogin(TestUserACL):
     """ Tests abilities of the User ACL mixin class """
@@ -401,3 +698,1275 @@ class TestLogin(TestUserACL):
         self.post('user', 200, params=p)
         p = {'__user_id': people[2].id, 'name': 'testing'}
         self.post('widget', 200, params=p)
+
+
+class TestJoin(FlaskTestBase):
+    """ Tests serialization through compiled join profiles """
+    def test_plan_cached(self):
+        self.relation_api()
+        plan = compile_join(self.post_model, 'standard_join')
+        assert plan is compile_join(self.post_model, 'standard_join')
+        assert plan is not compile_join(self.post_model, 'brief_join')
+        assert 'body' not in plan.columns
+        assert 'title' in plan.columns
+
+    def test_list_profile_cached(self):
+        self.relation_api()
+        prof = ['__dont_mongo', 'id', {'obj': 'author'}]
+        plan = compile_join(self.post_model, prof)
+        assert plan is compile_join(self.post_model, list(prof))
+        assert plan.columns == []
+        assert plan.keys == ['id']
+
+    def test_nested(self):
+        posts = self.provision_posts(count=2)
+        d = get_joined(posts)
+        assert len(d) == 2
+        assert 'body' not in d[0]
+        assert d[0]['title'] == 'Post 0'
+        assert d[0]['author']['username'] == 'author0'
+        assert d[0]['comments'][1]['author']['username'] == 'author1'
+        assert d[0]['comments'][0]['_cls'] == 'Comment'
+        assert set(d[0]['comments'][0]) == set(['id', 'body', 'author',
+                                                 '_cls'])
+
+    def test_nested_precompiled(self):
+        posts = self.provision_posts(count=2)
+        plan = compile_join(self.post_model)
+        comments = dict((key, sub) for key, prof, sub in plan.subs)['comments']
+        assert comments is compile_join(self.comment_model)
+        compiled = []
+        orig = base_module.compile_join
+
+        def counting(*args, **kwargs):
+            compiled.append(args)
+            return orig(*args, **kwargs)
+        base_module.compile_join = counting
+        try:
+            get_joined(posts)
+        finally:
+            base_module.compile_join = orig
+        # only the top level list looks its plan up
+        assert len(compiled) == 1
+
+    def test_cyclic_profiles(self):
+        self.relation_api()
+        self.comment_model.post = relationship(self.post_model)
+        self.comment_model.cycle_join = [
+            'id', {'obj': 'post', 'join_prof': 'cycle_join'}]
+        self.post_model.cycle_join = [
+            'id', {'obj': 'comments', 'join_prof': 'cycle_join'}]
+        plan = compile_join(self.post_model, 'cycle_join')
+        comment_plan = plan.subs[0][2]
+        assert comment_plan.subs[0][2] is plan
+
+    def test_dont_mongo(self):
+        posts = self.provision_posts(count=1)
+        d = get_joined(posts[0], 'brief_join')
+        assert d == {'id': posts[0].id, 'title': 'Post 0', '_cls': 'Post'}
+
+    def test_get_nested(self):
+        self.provision_posts()
+        d = self.get('post', 200)
+        assert len(d['objects']) == 4
+        assert len(d['objects'][0]['comments']) == 2
+
+
+class TestConverters(unittest.TestCase):
+    """ Tests the conversion of values by jsonize """
+    def tearDown(self):
+        _converters.pop(decimal.Decimal, None)
+        _resolved.clear()
+
+    def test_builtin(self):
+        class Obj(object):
+            when = datetime.datetime(2015, 3, 4, 5, 6, 7, 800)
+            day = datetime.date(2015, 3, 4)
+            tags = set(['a'])
+            count = 3
+            ratio = 0.5
+            flag = True
+
+            def method(self):
+                return datetime.datetime(1969, 12, 31, 23, 59, 59, 500000)
+        d = jsonize(Obj(), ['when', 'day', 'tags', 'count', 'ratio', 'flag',
+                            'method'], raw=True)
+        assert d == {'when': calendar.timegm(Obj.when.utctimetuple()),
+                     'day': '2015-03-04', 'tags': {'a': True}, 'count': 3,
+                     'ratio': 0.5, 'flag': True, 'method': -1}
+
+    def test_timezone(self):
+        class UTC1(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=1)
+        when = datetime.datetime(2015, 3, 4, 5, tzinfo=UTC1())
+        d = jsonize(type('Obj', (object, ), {'when': when})(), ['when'],
+                    raw=True)
+        assert d['when'] == calendar.timegm(when.utctimetuple())
+
+    def test_register(self):
+        class Money(decimal.Decimal):
+            pass
+        obj = type('Obj', (object, ), {'cost': Money('1.5')})()
+        assert jsonize(obj, ['cost'], raw=True) == {'cost': '1.5'}
+        register_converter(decimal.Decimal, float)
+        assert jsonize(obj, ['cost'], raw=True) == {'cost': 1.5}
+
+
+class TestColumnConverters(FlaskTestBase):
+    """ Tests converters resolved from column types by join plans """
+    def test_resolved(self):
+        self.basic_api()
+        plan = compile_join(self.widget_model,
+                            ['__dont_mongo', 'id', 'created_at', 'id_str'])
+        convs = dict((key, conv) for key, getter, conv in plan.getters)
+        assert convs['created_at'] is not None
+        assert convs['id_str'] is None
+        when = datetime.datetime(2015, 3, 4)
+        obj = self.widget_model(id=1, created_at=when)
+        self.widget_model.id_str = property(lambda self: str(self.id))
+        assert plan(obj) == {'id': 1, 'created_at': 1425427200,
+                             'id_str': '1', '_cls': 'Widget'}
+        obj.created_at = None
+        assert plan(obj)['created_at'] is None
+
+    def test_register_recompiles(self):
+        self.basic_api()
+        plan = compile_join(self.widget_model, 'standard_join')
+        register_converter(int, str)
+        try:
+            assert compile_join(self.widget_model, 'standard_join') \
+                is not plan
+            obj = self.widget_model(id=1)
+            assert get_joined(obj)['id'] == '1'
+        finally:
+            register_converter(int, _identity)
+
+
+class TestEagerLoad(FlaskTestBase):
+    """ Ensures nested join profiles are loaded with a fixed number of
+    queries """
+    def count_queries(self, func):
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            func()
+        finally:
+            event.remove(self.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return len(queries)
+
+    def test_fixed_queries(self):
+        self.provision_posts(count=8)
+        self.session.remove()
+        small = self.count_queries(
+            lambda: self.get('post', 200, params={'pg_size': 2}))
+        self.session.remove()
+        large = self.count_queries(
+            lambda: self.get('post', 200, params={'pg_size': 8}))
+        assert small == large
+
+    def test_loader_options(self):
+        self.relation_api()
+        plan = compile_join(self.post_model)
+        assert len(plan.loader_options()) == 3
+        assert len(plan.column_options()) == 1
+        assert plan.column_options() is plan.column_options()
+        brief = compile_join(self.post_model, 'brief_join')
+        assert len(brief.loader_options()) == 1
+
+    def test_dynamic(self):
+        self.provision_posts(count=2)
+        self.author_model.posts = relationship(self.post_model,
+                                               lazy='dynamic')
+        prof = ['username', {'obj': 'posts', 'join_prof': 'brief_join'}]
+        plan = compile_join(self.author_model, prof)
+        assert len(plan.loader_options()) == 0
+        author = self.session.query(self.author_model).\
+            options(*plan.loader_options()).first()
+        assert get_joined(author, prof)['posts'][0]['title'] == 'Post 0'
+
+    def test_disabled(self):
+        posts = self.provision_posts(count=4)
+        self.post_api.eager_load = False
+        self.session.remove()
+        lazy = self.count_queries(lambda: self.get('post', 200))
+        assert lazy > 4
+
+
+class TestColumnProjection(FlaskTestBase):
+    """ Ensures columns a join profile never emits aren't loaded """
+    def test_removed_deferred(self):
+        posts = self.provision_posts(count=2)
+        self.session.remove()
+        query = self.post_api().base_query('standard_join')
+        post = query.first()
+        assert 'body' in inspect(post).unloaded
+        assert 'title' not in inspect(post).unloaded
+        comment = post.comments[0]
+        assert 'body' not in inspect(comment).unloaded
+        assert 'post_id' not in inspect(comment).unloaded
+
+    def test_dont_mongo_load_only(self):
+        self.provision_posts(count=2)
+        self.session.remove()
+        post = self.post_api().base_query('brief_join').first()
+        unloaded = inspect(post).unloaded
+        assert 'body' in unloaded
+        assert 'author_id' in unloaded
+        assert 'title' not in unloaded
+
+    def test_output_unchanged(self):
+        self.provision_posts(count=2)
+        d = self.get('post', 200, params={'join_prof': 'brief_join'})
+        assert set(d['objects'][0]) == set(['id', 'title', '_cls'])
+        d = self.get('post', 200)
+        assert 'body' not in d['objects'][0]
+        assert d['objects'][0]['comments'][0]['body'] == 'comment 0'
+
+
+class TestStream(FlaskTestBase):
+    """ Tests streaming list responses """
+    def test_stream_param(self):
+        self.provision_posts()
+        streamed = self.get('post', 200, params={'__stream': True})
+        self.session.remove()
+        plain = self.get('post', 200)
+        assert streamed == plain
+
+    def test_stream_attribute(self):
+        self.provision_many_asset()
+        self.widget_api.stream = True
+        self.widget_api.stream_chunk_size = 1
+        response = self.client.get('widget')
+        assert response.is_streamed
+        d = json.loads(response.data.decode('utf8'))
+        assert d['success']
+        assert len(d['objects']) == 4
+
+    def test_stream_empty(self):
+        self.basic_api()
+        self.base.metadata.create_all(self.engine)
+        d = self.get('widget', 200, params={'__stream': True})
+        assert d['objects'] == []
+
+    def test_stream_denied(self):
+        self.provision_many_asset()
+
+        class DenyAPI(self.widget_api):
+            stream_chunk_size = 1
+
+            def can(self, obj, action):
+                return obj.name != u'lcxvmnl'
+        self.app.add_url_rule('/deny', view_func=DenyAPI.as_view('deny'))
+        d = self.get('deny', 200, params={'__stream': True}, success=False)
+        assert len(d['objects']) == 2
+        assert 'permission' in d['message']
+
+
+class TestKeyset(FlaskTestBase):
+    """ Tests cursor based pagination """
+    def walk(self, params):
+        names = []
+        params = dict(params, __after='', pg_size=3)
+        while True:
+            d = self.get('widget', 200, params=dict(params))
+            names.extend(o['name'] for o in d['objects'])
+            if d['next_cursor'] is None:
+                return names
+            params['__after'] = d['next_cursor']
+
+    def test_walk_pkey(self):
+        objs = self.provision_many_asset()
+        names = self.walk({})
+        assert names == [o.name for o in sorted(objs, key=lambda o: o.id)]
+
+    def test_walk_order_by(self):
+        objs = self.provision_many_asset()
+        names = self.walk({'__order_by': ['-name']})
+        assert names == sorted([o.name for o in objs], reverse=True)
+
+    def test_walk_datetime(self):
+        objs = self.provision_many_asset()
+        names = self.walk({'__order_by': ['created_at']})
+        assert sorted(names) == sorted(o.name for o in objs)
+
+    def test_stable_under_insert(self):
+        self.provision_many_asset()
+        d = self.get('widget', 200, params={'__after': '', 'pg_size': 2,
+                                            '__order_by': ['id']})
+        first = [o['id'] for o in d['objects']]
+        self.session.add(self.widget_model(name=u'aaaaa'))
+        self.session.commit()
+        d = self.get('widget', 200, params={'__after': d['next_cursor'],
+                                            'pg_size': 2,
+                                            '__order_by': ['id']})
+        assert all(o['id'] > max(first) for o in d['objects'])
+
+    def test_cursor_attribute(self):
+        self.provision_many_asset()
+        self.widget_api.cursor_pagination = True
+        d = self.get('widget', 200, params={'pg_size': 3})
+        assert d['next_cursor']
+        d = self.get('widget', 200, params={'pg_size': 3,
+                                            '__after': d['next_cursor'],
+                                            '__stream': True})
+        assert len(d['objects']) == 1
+        assert d['next_cursor'] is None
+
+    def test_walk_numeric(self):
+        class Item(self.base):
+            __tablename__ = 'item'
+            id = Column(Integer, primary_key=True)
+            name = Column(Unicode)
+            price = Column(Numeric(10, 2))
+            opens = Column(Time)
+            extra = Column(PickleType)
+
+            standard_join = ['__dont_mongo', 'id', 'name', 'price']
+
+        class ItemAPI(API):
+            model = Item
+            session = self.session
+            cursor_pagination = True
+        self.app.add_url_rule('/item', view_func=ItemAPI.as_view('item'))
+        self.base.metadata.create_all(self.engine)
+        self.session.add_all([
+            Item(name=u'i%d' % i, price=decimal.Decimal('1.50') * (i % 3),
+                 opens=datetime.time(8, i)) for i in range(7)])
+        self.session.commit()
+        for order in ('price', '-opens'):
+            names = []
+            params = {'__order_by': [order], 'pg_size': 2}
+            while True:
+                d = self.get('item', 200, params=dict(params))
+                names.extend(o['name'] for o in d['objects'])
+                if d['next_cursor'] is None:
+                    break
+                params['__after'] = d['next_cursor']
+            assert sorted(names) == ['i%d' % i for i in range(7)]
+        self.get('item', 400, params={'__order_by': ['extra']})
+
+    def test_cursor_types(self):
+        values = [decimal.Decimal('1.50'), uuid.uuid4(),
+                  datetime.time(8, 30, 1), datetime.date(2020, 1, 2)]
+        assert decode_cursor(encode_cursor(values)) == values
+
+    def test_bad_cursor(self):
+        self.provision_many_asset()
+        ret = self.get('widget', 400, params={'__after': 'garbage'})
+        assert 'Invalid cursor' in ret['message']
+        cursor = encode_cursor([1, 2])
+        ret = self.get('widget', 400, params={'__after': cursor})
+        assert 'ordering' in ret['message']
+
+
+class TestCount(FlaskTestBase):
+    """ Tests totals returned with __with_count """
+    def test_window_count(self):
+        self.provision_many_asset()
+        d = self.get('widget', 200, params={'__with_count': True,
+                                            'pg_size': 3})
+        assert len(d['objects']) == 3
+        assert d['count'] == 4
+
+    def test_count_filtered(self):
+        self.provision_many_asset()
+        d = self.get('widget', 200, params={
+            '__with_count': True, 'pg_size': 1,
+            '__filter': [{'name': 'name', 'op': 'like', 'val': 'l%'}]})
+        assert d['count'] == 1
+
+    def test_count_past_end(self):
+        self.provision_many_asset()
+        d = self.get('widget', 200, params={'__with_count': True,
+                                            'pg_size': 3, 'pg': 5})
+        assert d['objects'] == []
+        assert d['count'] == 4
+
+    def test_count_keyset_stream(self):
+        self.provision_many_asset()
+        d = self.get('widget', 200, params={'__with_count': True,
+                                            '__after': '', 'pg_size': 3})
+        assert d['count'] == 4
+        d = self.get('widget', 200, params={'__with_count': True,
+                                            '__stream': True, 'pg_size': 3})
+        assert d['count'] == 4
+
+    def test_count_cached(self):
+        self.provision_many_asset()
+        self.widget_api.count_ttl = 60
+        d = self.get('widget', 200, params={'__with_count': True})
+        assert d['count'] == 4
+        self.session.add(self.widget_model(name=u'another'))
+        self.session.commit()
+        d = self.get('widget', 200, params={'__with_count': True})
+        assert d['count'] == 4
+        d = self.get('widget', 200, params={'__with_count': True,
+                                            '__filter_by': {'name': 'another'}})
+        assert d['count'] == 1
+
+    def test_estimate(self):
+        self.provision_many_asset()
+
+        class EstimateAPI(self.widget_api):
+            def estimate_count(self, query):
+                return 1000
+        self.app.add_url_rule('/estimate',
+                              view_func=EstimateAPI.as_view('estimate'))
+        d = self.get('estimate', 200, params={'__with_count': True})
+        assert d['count'] == 1000
+        assert d['count_estimated']
+
+
+class TestACLCache(TestUserACL):
+    """ Ensures ACL decisions are memoized for the length of a request """
+    def count_calls(self, cls, name):
+        calls = []
+        orig = getattr(cls, name)
+
+        def wrapper(*args, **kwargs):
+            calls.append(1)
+            return orig(*args, **kwargs)
+        setattr(cls, name, wrapper)
+        return calls
+
+    def test_global_roles_once(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        self.provision_users()
+        calls = self.count_calls(self.lm.anonymous_user, 'global_roles')
+        d = self.get('user', 200)
+        assert len(d['objects']) == 5
+        assert len(calls) == 1
+        self.get('user', 200)
+        assert len(calls) == 2
+
+    def test_user_acl_memoized(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        people = self.provision_users()
+        calls = self.count_calls(self.user_model, 'roles')
+        with self.app.test_request_context():
+            assert people[0].can('view_standard_join')
+            assert not people[0].can('delete')
+            assert len(calls) == 1
+        with self.app.test_request_context():
+            people[0].can('delete')
+            assert len(calls) == 2
+
+    def test_user_acl_override(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        people = self.provision_users()
+        self.user_model.user_acl = lambda self, user=None: set()
+        with self.app.test_request_context():
+            assert not people[0].can('view_standard_join')
+
+    def test_can_cls_memoized(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        calls = self.count_calls(self.user_model, 'p_roles')
+        with self.app.test_request_context():
+            assert self.user_model.can_cls('class_create')
+            assert not self.user_model.can_cls('delete')
+            assert len(calls) == 1
+            self.user_model.can_cls('class_create', parent=1)
+            assert len(calls) == 2
+
+    def test_roles_many(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        self.provision_users()
+        batches = []
+
+        def roles_many(cls, objs, user=None):
+            batches.append(len(objs))
+            return [['owner'] for obj in objs]
+        self.user_model.roles_many = classmethod(roles_many)
+        calls = self.count_calls(self.user_model, 'roles')
+        d = self.get('user', 200)
+        assert len(d['objects']) == 5
+        assert batches == [5]
+        assert calls == []
+        self.get('user', 200, params={'__stream': True})
+        assert batches == [5, 5]
+
+    def test_roles_many_fallback(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        self.provision_users()
+        calls = self.count_calls(self.user_model, 'roles')
+        self.get('user', 200)
+        assert len(calls) == 5
+
+    def test_bitmask_acl(self):
+        self.user_api()
+        self.user_model.acl = build_acl({'user': {
+            'user': {'view': 'standard_join'},
+            'anonymous': {'view': 'standard_join', 'action': 'login',
+                          'class': 'create'},
+            'owner': {'view': 'standard_join', 'edit': 'description'},
+            'admin': ['delete']}}, bitmask=True)['user']
+        self.base.metadata.create_all(self.engine)
+        people = self.provision_users()
+        d = self.get('user', 200)
+        assert len(d['objects']) == 5
+        self.delete('user', 403, params={'id': people[2].id})
+        with self.app.test_request_context():
+            assert self.user_model.can_cls('class_create')
+            assert not self.user_model.can_cls('delete')
+            assert people[0].user_acl() == set(['view_standard_join',
+                                                'action_login',
+                                                'class_create'])
+
+    def test_plain_model(self):
+        class Note(declarative_base()):
+            __tablename__ = 'note'
+            id = Column(Integer, primary_key=True)
+            standard_join = ['id']
+
+            def can(self, action):
+                return True
+
+            @classmethod
+            def can_cls(cls, action, **parents):
+                return True
+
+        class NoteAPI(ModelBasedACL, API):
+            model = Note
+            session = self.session
+        self.app.add_url_rule('/note', view_func=NoteAPI.as_view('note'))
+        Note.metadata.create_all(self.engine)
+        self.session.add(Note())
+        self.session.commit()
+        d = self.get('note', 200)
+        assert len(d['objects']) == 1
+
+    def test_acl_columns(self):
+        self.user_api()
+
+        class Document(self.base):
+            __tablename__ = 'document'
+            id = Column(Integer, primary_key=True)
+            title = Column(Unicode)
+            body = Column(Unicode)
+            owner_id = Column(Integer)
+
+            standard_join = ['id', 'title', 'owner_id']
+            brief_join = ['__dont_mongo', 'id', 'title']
+            acl = {'owner': set(['view_brief_join'])}
+
+            def roles(self, user=current_user):
+                if self.owner_id == user.id:
+                    return ['owner']
+                return []
+
+        class DocumentAPI(ModelBasedACL, API):
+            model = Document
+            session = self.session
+        self.app.add_url_rule('/document',
+                              view_func=DocumentAPI.as_view('document'))
+        self.base.metadata.create_all(self.engine)
+        self.session.add_all([Document(title=u'doc', body=u'body',
+                                       owner_id=-100) for i in range(20)])
+        self.session.commit()
+        self.session.remove()
+        queries = self.record_queries()
+        d = self.get('document', 200, params={'join_prof': 'brief_join'})
+        assert len(d['objects']) == 20
+        assert len(queries) == 1
+        del queries[:]
+        d = self.get('document', 200, params={'join_prof': 'brief_join',
+                                              '__fields': 'id'})
+        assert len(queries) == 1
+
+        Document.acl_columns = ['owner_id']
+        self.session.remove()
+        del queries[:]
+        self.get('document', 200, params={'join_prof': 'brief_join'})
+        assert len(queries) == 1
+        assert 'body' not in queries[0]
+        assert 'owner_id' in queries[0]
+
+    def test_export_released(self):
+        self.user_api()
+        self.base.metadata.create_all(self.engine)
+        self.session.add_all([self.user_model(username=u'user%d' % i)
+                              for i in range(50)])
+        self.session.commit()
+        sizes = []
+
+        class ExportAPI(self.user_api):
+            allow_export = True
+            stream_chunk_size = 5
+
+            def check_view(self, objs, join):
+                super(ExportAPI, self).check_view(objs, join)
+                sizes.append(len(acl_cache()))
+        self.app.add_url_rule('/export',
+                              view_func=ExportAPI.as_view('export'))
+        response = self.client.get('export', query_string={
+            '__export': 'ndjson'})
+        assert len(response.data.splitlines()) == 50
+        assert len(sizes) == 10
+        assert max(sizes) < 10
+
+    def test_acl_filter(self):
+        self.user_api()
+        calls = self.count_calls(self.user_model, 'roles')
+
+        def acl_filter(cls, action, user=None):
+            return cls.admin == False
+        self.user_model.acl_filter = classmethod(acl_filter)
+        self.base.metadata.create_all(self.engine)
+        people = self.provision_users()
+        d = self.get('user', 200, params={'pg_size': 2, 'pg': 2,
+                                          '__with_count': True})
+        assert len(d['objects']) == 2
+        assert d['count'] == 4
+        assert calls == []
+        self.get('user', 404, params={'id': self.admin.id})
+        d = self.get('user', 200, params={'id': people[0].id})
+        assert d['objects'][0]['username'] == 'mary'
+
+
+class TestETag(FlaskTestBase):
+    """ Tests ETags and conditional gets """
+    def setUp(self):
+        super(TestETag, self).setUp()
+        self.objs = self.provision_many_asset()
+        self.widget_api.etag_attr = 'description'
+
+    def test_disabled(self):
+        self.widget_api.etag_attr = None
+        response = self.client.get('widget')
+        assert response.headers.get('ETag') is None
+
+    def test_single(self):
+        obj_id = self.objs[0].id
+        response = self.client.get('widget', query_string={'id': obj_id})
+        etag = response.headers['ETag']
+        response = self.client.get('widget', query_string={'id': obj_id},
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        self.put('widget', 200, params={'id': obj_id, 'description': 'new'})
+        response = self.client.get('widget', query_string={'id': obj_id},
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_single_missing(self):
+        response = self.client.get('widget', query_string={'id': 1000},
+                                   headers={'If-None-Match': '"abc"'})
+        assert response.status_code == 404
+
+    def test_list(self):
+        response = self.client.get('widget', query_string={'pg_size': 2})
+        etag = response.headers['ETag']
+        response = self.client.get('widget', query_string={'pg_size': 2},
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        response = self.client.get('widget', query_string={'pg_size': 3},
+                                   headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        response = self.client.get('widget', query_string={
+            'pg_size': 2, 'pg': 2}, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+
+    def test_denied(self):
+        obj_id = self.objs[0].id
+        response = self.client.get('widget', query_string={'id': obj_id})
+        single = response.headers['ETag']
+        response = self.client.get('widget', query_string={'pg_size': 2})
+        page = response.headers['ETag']
+        self.widget_api.can = lambda self, obj, action: False
+        response = self.client.get('widget', query_string={'id': obj_id},
+                                   headers={'If-None-Match': single})
+        assert response.status_code == 403
+        response = self.client.get('widget', query_string={'pg_size': 2},
+                                   headers={'If-None-Match': page})
+        assert response.status_code == 403
+
+    def test_head(self):
+        class FilteredAPI(self.widget_api):
+            def view_filter(self, join):
+                return self.model.name != u'lcxvmnl'
+        self.app.add_url_rule('/filtered',
+                              view_func=FilteredAPI.as_view('filtered'))
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        response = self.client.head('filtered')
+        event.remove(self.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        assert response.status_code == 200
+        assert len(queries) == 1
+        assert response.headers['ETag'] == \
+            self.client.get('filtered').headers['ETag']
+        response = self.client.head('widget')
+        assert response.status_code == 200
+        assert response.headers['ETag']
+
+
+class TestResultCache(FlaskTestBase):
+    """ Tests caching of get responses and their invalidation """
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.provision_many_asset()
+        self.widget_api.result_cache = MemoryCache()
+
+    def test_cached_until_write(self):
+        d = self.get('widget', 200)
+        assert len(d['objects']) == 4
+        # writes that bypass the API aren't seen
+        self.session.add(self.widget_model(name=u'another'))
+        self.session.commit()
+        assert len(self.get('widget', 200)['objects']) == 4
+        assert len(self.get('widget', 200, params={'pg_size': 10})
+                   ['objects']) == 5
+        obj_id = self.get('widget', 200)['objects'][0]['id']
+        self.delete('widget', 200, params={'id': obj_id})
+        assert len(self.get('widget', 200)['objects']) == 4
+
+    def test_keyed_on_search(self):
+        d = self.get('widget', 200, params={'__filter_by': {'name': 'sdflgk'}})
+        assert len(d['objects']) == 1
+        d = self.get('widget', 200, params={'__filter_by': {'name': 'none'}})
+        assert len(d['objects']) == 0
+
+    def test_etag(self):
+        self.widget_api.etag_attr = 'description'
+        response = self.client.get('widget')
+        etag = response.headers['ETag']
+        response = self.client.get('widget')
+        assert response.headers['ETag'] == etag
+        response = self.client.get('widget', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    def test_related_tables(self):
+        self.provision_posts()
+        self.post_api.result_cache = MemoryCache()
+
+        # a write through any API invalidates the table
+        class AuthorAPI(API):
+            model = self.author_model
+            session = self.session
+        self.app.add_url_rule('/author',
+                              view_func=AuthorAPI.as_view('author'))
+        d = self.get('post', 200)
+        author_id = d['objects'][0]['author']['id']
+        author = self.session.query(self.author_model).get(author_id)
+        author.username = u'renamed'
+        self.session.commit()
+        assert self.get('post', 200) == d
+        self.put('author', 200, params={'id': author_id, 'username': 'new'})
+        d = self.get('post', 200)
+        assert d['objects'][0]['author']['username'] == 'new'
+
+    def test_custom_acl(self):
+        class PrivateAPI(self.widget_api):
+            def can(self, obj, action):
+                return request.headers.get('X-User') == 'owner'
+
+        # opting in to sharing responses between users
+        class SharedAPI(PrivateAPI):
+            def cache_fingerprint(self):
+                return None
+        self.app.add_url_rule('/private',
+                              view_func=PrivateAPI.as_view('private'))
+        self.app.add_url_rule('/shared',
+                              view_func=SharedAPI.as_view('shared'))
+        self.get('private', 200, headers={'X-User': 'owner'})
+        self.get('private', 403, headers={'X-User': 'other'})
+        self.get('shared', 200, headers={'X-User': 'owner'})
+        self.get('shared', 200, headers={'X-User': 'other'})
+
+    def test_memory_budget(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', b'123456')
+        cache.set('b', b'123456')
+        assert cache.get('a') is None
+        assert cache.get('b') == b'123456'
+        cache.set('c', b'12345678901')
+        assert cache.get('c') is None
+        assert cache.size == 6
+
+    def test_file_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            one = FileCache(path, max_entries=2, prune_interval=1)
+            two = FileCache(path)
+            key = one.make_key(['params'], ['widget'])
+            one.set(key, b'value')
+            assert two.get(key) == b'value'
+            two.invalidate('widget')
+            assert one.make_key(['params'], ['widget']) != key
+            one.set('b', b'')
+            one.set('c', b'')
+            assert len(os.listdir(os.path.join(path, 'entries'))) == 2
+        finally:
+            shutil.rmtree(path)
+
+
+class TestBatch(FlaskTestBase):
+    """ Tests running many requests through a batch endpoint """
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.objs = self.provision_many_asset()
+
+        class Batch(BatchAPI):
+            apis = {'widget': self.widget_api}
+            session = self.session
+        Batch.register(self.app, '/batch')
+
+    def test_batch(self):
+        obj_id = self.objs[0].id
+        d = self.post('batch', 200, params=[
+            {'api': 'widget', 'params': {'id': obj_id}},
+            {'api': 'widget', 'method': 'put',
+             'params': {'id': obj_id, 'description': 'new'}},
+            {'api': 'widget', 'method': 'get',
+             'params': {'__filter_by': {'description': 'new'}}},
+            {'api': 'widget', 'method': 'post', 'params': {'name': 'made'}},
+            {'api': 'widget', 'params': {'__stream': True}}])
+        statuses = [r['status'] for r in d['results']]
+        assert statuses == [200, 200, 200, 200, 400]
+        assert d['results'][0]['body']['objects'][0]['id'] == obj_id
+        assert d['results'][2]['body']['objects'][0]['id'] == obj_id
+        assert d['results'][3]['body']['objects'][0]['name'] == 'made'
+
+    def test_errors(self):
+        d = self.post('batch', 200, params=[
+            {'api': 'widget', 'params': {'__one': True}},
+            {'api': 'widget', 'method': 'delete', 'params': {'id': 1000}},
+            {'api': 'widget', 'method': 'post', 'params': {'name': 'sdflgk'}},
+            {'api': 'nothing'},
+            {'api': 'widget', 'params': {'pg_size': 1}}])
+        statuses = [r['status'] for r in d['results']]
+        assert statuses == [400, 404, 409, 404, 200]
+        assert 'MultipleResultsFound' in d['results'][0]['body']['message']
+        assert not d['results'][2]['body']['success']
+
+    def test_atomic(self):
+        d = self.post('batch', 200, success=False, params={
+            'atomic': True, 'requests': [
+                {'api': 'widget', 'method': 'post', 'params': {'name': 'a'}},
+                {'api': 'widget', 'method': 'post', 'params': {'name': 'a'}},
+                {'api': 'widget', 'method': 'post', 'params': {'name': 'b'}}]})
+        statuses = [r['status'] for r in d['results']]
+        assert statuses == [200, 409, 424]
+        assert self.session.query(self.widget_model).count() == 4
+        d = self.post('batch', 200, params={
+            'atomic': True, 'requests': [
+                {'api': 'widget', 'method': 'post', 'params': {'name': 'a'}},
+                {'api': 'widget', 'method': 'post', 'params': {'name': 'b'}}]})
+        self.session.rollback()
+        assert self.session.query(self.widget_model).count() == 6
+
+    def test_too_many(self):
+        self.post('batch', 400, params=[{'api': 'widget'}] * 51)
+
+    def test_decorated(self):
+        def require_token(func):
+            def wrapper(*args, **kwargs):
+                if request.headers.get('X-Token') != 'secret':
+                    return 'Unauthorized', 401
+                return func(*args, **kwargs)
+            return wrapper
+
+        class GuardedAPI(self.widget_api):
+            decorators = [require_token]
+            dispatched = []
+
+            def dispatch_request(self, *args, **kwargs):
+                self.dispatched.append(self.batch_method)
+                return super(GuardedAPI, self).dispatch_request(*args,
+                                                                **kwargs)
+
+        class GuardedBatch(BatchAPI):
+            apis = {'widget': GuardedAPI}
+            session = self.session
+        GuardedBatch.register(self.app, '/guarded_batch')
+
+        reqs = [{'api': 'widget', 'method': 'post', 'params': {'name': 'x'}}]
+        d = self.post('guarded_batch', 200, params=reqs)
+        assert d['results'][0] == {'status': 401, 'body': 'Unauthorized'}
+        assert self.session.query(self.widget_model).count() == 4
+        d = self.post('guarded_batch', 200, params=reqs,
+                      headers={'X-Token': 'secret'})
+        assert d['results'][0]['status'] == 200
+        assert GuardedAPI.dispatched == ['POST']
+
+    def test_export(self):
+        self.widget_api.allow_export = True
+        d = self.post('batch', 200, params=[
+            {'api': 'widget', 'params': {'__export': 'csv'}}])
+        assert d['results'][0]['status'] == 400
+
+
+class TestBatchACL(TestUserACL):
+    """ Tests that ACL decisions aren't shared between batched requests """
+    def test_acl_cache_cleared(self):
+        self.user_api()
+
+        class Document(self.base):
+            __tablename__ = 'document'
+            id = Column(Integer, primary_key=True)
+            title = Column(Unicode)
+            owner_id = Column(Integer)
+
+            standard_join = ['id', 'title', 'owner_id']
+            acl = {'anonymous': set(['view_standard_join']),
+                   'owner': set(['edit_title', 'edit_owner_id'])}
+
+            def roles(self, user=current_user):
+                if self.owner_id == user.id:
+                    return ['owner']
+                return []
+
+        class DocumentAPI(ModelBasedACL, API):
+            model = Document
+            session = self.session
+
+        class DocumentBatch(BatchAPI):
+            apis = {'document': DocumentAPI}
+        self.app.add_url_rule('/document',
+                              view_func=DocumentAPI.as_view('document'))
+        DocumentBatch.register(self.app, '/batch')
+        self.base.metadata.create_all(self.engine)
+        self.session.add(Document(title=u'mine', owner_id=-100))
+        self.session.commit()
+        d = self.post('batch', 200, params=[
+            {'api': 'document', 'method': 'put',
+             'params': {'id': 1, 'owner_id': 2}},
+            {'api': 'document', 'method': 'put',
+             'params': {'id': 1, 'title': 'hijacked'}}])
+        statuses = [r['status'] for r in d['results']]
+        assert statuses == [200, 403]
+        self.session.expire_all()
+        assert self.session.query(Document).one().title == u'mine'
+
+
+class TestEncoders(FlaskTestBase):
+    """ Tests the encoders responses are written with """
+    def responses(self):
+        self.app.config['LEVER_ENCODER'] = 'json'
+        stdlib = self.client.get('widget').data
+        self.app.config['LEVER_ENCODER'] = 'orjson'
+        fast = self.client.get('widget').data
+        return stdlib, fast
+
+    def test_same_output(self):
+        self.provision_many_asset()
+        self.widget_api.stream = True
+        stdlib, fast = self.responses()
+        assert json.loads(stdlib) == json.loads(fast)
+        self.widget_api.stream = False
+        stdlib, fast = self.responses()
+        assert b'\n' not in stdlib
+        assert json.loads(stdlib) == json.loads(fast)
+
+    def test_http_dates(self):
+        self.provision_many_asset()
+        # base columns aren't converted by jsonize
+        self.widget_model.base_join = ['id']
+        for name in ('json', 'orjson'):
+            self.app.config['LEVER_ENCODER'] = name
+            d = self.get('widget', 200, params={'join_prof': 'base_join'})
+            assert d['objects'][0]['created_at'].endswith('GMT')
+
+    def test_api_encoder(self):
+        self.provision_many_asset()
+
+        class Upper(encoders.StdlibEncoder):
+            def dumps(self, obj):
+                return encoders.StdlibEncoder.dumps(self, obj).upper()
+        self.widget_api.encoder = Upper()
+        assert b'SDFLGK' in self.client.get('widget').data
+
+    def test_unknown(self):
+        self.app.config['LEVER_ENCODER'] = 'nothing'
+        with self.app.app_context():
+            self.assertRaises(LookupError, encoders.get_encoder)
+
+
+class TestExport(FlaskTestBase):
+    """ Tests streaming every matching object with __export """
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.provision_posts()
+        self.post_api.allow_export = True
+        self.post_api.stream_chunk_size = 3
+        self.session.expunge_all()
+
+    def export(self, status=200, **params):
+        response = self.client.get('post', query_string=params)
+        assert response.status_code == status
+        return response
+
+    def test_ndjson(self):
+        response = self.export(__export='ndjson')
+        assert response.mimetype == 'application/x-ndjson'
+        rows = [json.loads(line) for line in
+                response.data.decode('utf8').splitlines()]
+        assert [r['id'] for r in rows] == [1, 2, 3, 4]
+        assert len(rows[0]['comments']) == 2
+        # exported rows don't stay in the session
+        assert len(self.session.identity_map) == 0
+
+    def test_csv(self):
+        response = self.export(__export='csv', __filter_by=json.dumps(
+            {'author_id': 1}))
+        assert 'post.csv' in response.headers['Content-Disposition']
+        rows = list(csv.reader(response.data.decode('utf8').splitlines()))
+        header = rows[0]
+        assert header == sorted(header)
+        assert len(rows) == 3
+        row = dict(zip(header, rows[1]))
+        assert row['title'] == 'Post 0'
+        assert json.loads(row['author'])['username'] == 'author0'
+
+    def test_max_rows(self):
+        self.post_api.export_max_rows = 2
+        response = self.export(__export='ndjson')
+        assert len(response.data.splitlines()) == 2
+
+    def test_not_allowed(self):
+        self.post_api.allow_export = False
+        self.export(403, __export='ndjson')
+        self.post_api.allow_export = True
+        self.export(400, __export='xml')
+
+    def test_denied_part_way(self):
+        class DeniedAPI(self.post_api):
+            def can(self, obj, action):
+                return obj.id < 4
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        response = self.client.get('denied', query_string={
+            '__export': 'ndjson'})
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        assert len(rows) == 4
+        assert rows[-1]['success'] is False
+        # CSV has no way to report the error, so the response is aborted
+        response = self.client.get('denied', query_string={
+            '__export': 'csv'}, buffered=False)
+        self.assertRaises(AssertionError, b''.join, response.response)
+
+
+class TestParallelExport(FlaskTestBase):
+    """ Tests exports split between worker processes with __export_workers,
+    which need a database file the workers can open """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.database_url = 'sqlite:///' + os.path.join(self.tmpdir, 'db')
+        super(TestParallelExport, self).setUp()
+        self.provision_posts(count=10)
+        self.post_api.allow_export = True
+        self.post_api.export_workers = 2
+        self.session.remove()
+
+    def tearDown(self):
+        self.session.remove()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, status=200, **params):
+        params.setdefault('__export_workers', 2)
+        response = self.client.get('post', query_string=params)
+        assert response.status_code == status
+        return response
+
+    def test_ndjson(self):
+        response = self.export(__export='ndjson')
+        rows = [json.loads(line) for line in response.data.splitlines()]
+        assert [r['id'] for r in rows] == list(range(1, 11))
+        assert len(rows[0]['comments']) == 2
+
+    def test_csv(self):
+        response = self.export(__export='csv', __filter_by=json.dumps(
+            {'author_id': 1}))
+        rows = list(csv.reader(response.data.decode('utf8').splitlines()))
+        header = rows[0]
+        assert len(rows) == 6
+        assert [dict(zip(header, row))['title'] for row in rows[1:]] == \
+            ['Post %d' % i for i in range(0, 10, 2)]
+
+    def test_max_rows(self):
+        self.post_api.export_max_rows = 3
+        response = self.export(__export='ndjson', __filter=json.dumps(
+            [{'name': 'id', 'op': 'gt', 'val': 4}]))
+        assert [json.loads(line)['id'] for line in
+                response.data.splitlines()] == [5, 6, 7]
+
+    def test_partitions(self):
+        # more partitions than the two per worker queued at once
+        self.post_api.export_partition_size = 2
+        response = self.export(__export='csv')
+        rows = list(csv.reader(response.data.decode('utf8').splitlines()))
+        header = rows[0]
+        assert [int(dict(zip(header, row))['id']) for row in rows[1:]] == \
+            list(range(1, 11))
+
+    def test_error(self):
+        self.post_model.broken_join = ['broken']
+        self.post_model.broken = property(lambda obj: 1 / 0)
+        # the body is written after the request's context is gone
+        self._ctx.pop()
+        try:
+            response = self.export(__export='ndjson', join_prof='broken_join')
+            rows = [json.loads(line) for line in response.data.splitlines()]
+        finally:
+            self._ctx.push()
+        assert rows == [{'success': False,
+                         'message': 'An error occurred while exporting'}]
+        # the error can't be written in CSV, so the response is aborted
+        self.assertRaises(Exception, self.client.get, 'post', query_string={
+            '__export': 'csv', '__export_workers': 2,
+            'join_prof': 'broken_join'})
+
+    def test_empty(self):
+        response = self.export(__export='csv', __filter_by=json.dumps(
+            {'author_id': 5}))
+        assert response.data == b''
+
+    def test_invalid(self):
+        self.export(400, __export='ndjson', __order_by=json.dumps(['-id']))
+        self.export(400, __export='ndjson', __export_workers='many')
+        self.post_api.export_workers = None
+        self.export(400, __export='ndjson')
+
+    def test_denied(self):
+        class DeniedAPI(self.post_api):
+            def can_cls(self, action):
+                return action != 'export'
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        response = self.client.get('denied', query_string={
+            '__export': 'ndjson', '__export_workers': 2})
+        assert response.status_code == 403
+
+
+class TestAggregate(FlaskTestBase):
+    """ Tests aggregates computed by the database with __aggregate and
+    __group_by """
+    def setUp(self):
+        super(TestAggregate, self).setUp()
+        self.provision_posts(count=5)
+
+    def aggregate(self, status=200, **params):
+        for key, val in params.items():
+            params[key] = json.dumps(val)
+        response = self.client.get('post', query_string=params)
+        assert response.status_code == status
+        return json.loads(response.data.decode('utf8'))
+
+    def test_totals(self):
+        data = self.aggregate(__aggregate=[
+            {'op': 'count'}, {'op': 'sum', 'name': 'id'},
+            {'op': 'max', 'name': 'id', 'key': 'last'}],
+            __filter=[{'name': 'id', 'op': 'gt', 'val': 1}])
+        assert data['aggregates'] == {'count': 4, 'sum_id': 14, 'last': 5}
+
+    def test_group_by(self):
+        data = self.aggregate(__group_by=['author_id'],
+                              __aggregate=[{'op': 'count'},
+                                           {'op': 'min', 'name': 'id'}])
+        assert data['groups'] == [
+            {'author_id': 1, 'count': 3, 'min_id': 1},
+            {'author_id': 2, 'count': 2, 'min_id': 2}]
+        assert data['truncated'] is False
+
+    def test_facets(self):
+        self.post_api.max_groups = 3
+        data = self.aggregate(__group_by=[['author_id'], ['title']],
+                              __order_by=['-count', 'author_id'])
+        authors, titles = data['facets']
+        assert authors['group_by'] == ['author_id']
+        assert [g['count'] for g in authors['groups']] == [3, 2]
+        assert len(titles['groups']) == 3
+        assert titles['truncated'] is True
+
+    def test_decimal(self):
+        row = collections.namedtuple('Row', ['sum', 'avg'])(
+            decimal.Decimal('12.000'), decimal.Decimal('2.5'))
+        assert self.post_api().aggregate_row(row) == {'sum': 12, 'avg': 2.5}
+        assert isinstance(self.post_api().aggregate_row(row)['sum'], int)
+
+    def test_invalid(self):
+        self.aggregate(400, __aggregate=[{'op': 'median', 'name': 'id'}])
+        self.aggregate(400, __aggregate=[{'op': 'sum'}])
+        self.aggregate(400, __aggregate=[{'op': 'sum', 'name': 'author'}])
+        self.aggregate(400, __group_by=['comments'])
+        self.aggregate(400, __group_by=['count'])
+        self.aggregate(400, __group_by=['author_id'], __order_by=['title'])
+
+    def test_denied(self):
+        class DeniedAPI(self.post_api):
+            def can_cls(self, action):
+                return action != 'aggregate'
+        self.app.add_url_rule('/denied',
+                              view_func=DeniedAPI.as_view('denied'))
+        response = self.client.get('denied', query_string={
+            '__group_by': json.dumps(['author_id'])})
+        assert response.status_code == 403
+
+
+class TestSparseFields(FlaskTestBase):
+    """ Tests selecting part of a join profile with __fields """
+    def setUp(self):
+        super(TestSparseFields, self).setUp()
+        self.provision_posts()
+        self.session.expunge_all()
+
+    def fields(self, fields, status=200, **params):
+        params['__fields'] = fields
+        response = self.client.get('post', query_string=params)
+        assert response.status_code == status
+        return json.loads(response.data.decode('utf8'))
+
+    def test_columns(self):
+        queries = self.record_queries()
+        data = self.fields('id,title', id=1)
+        assert data['objects'] == [{'id': 1, 'title': u'Post 0',
+                                    '_cls': 'Post'}]
+        # unselected columns and relationships aren't loaded
+        assert len(queries) == 1
+        assert 'post.body' not in queries[0]
+        assert 'comment' not in queries[0]
+
+    def test_nested(self):
+        queries = self.record_queries()
+        data = self.fields(json.dumps(['title', 'comments.author.username',
+                                       'author']))
+        post = data['objects'][0]
+        assert sorted(post) == ['_cls', 'author', 'comments', 'title']
+        assert post['author'] == {'id': 1, 'username': u'author0',
+                                  '_cls': 'Author'}
+        assert post['comments'][0] == {'author': {'username': u'author0',
+                                                  '_cls': 'Author'},
+                                       '_cls': 'Comment'}
+        assert 'comment.body' not in ' '.join(queries)
+
+    def test_invalid(self):
+        # body is removed by standard_join and brief_join doesn't nest
+        self.fields('body', 400)
+        self.fields('comments.title', 400)
+        self.fields('title.length', 400)
+        self.fields('comments', 400, join_prof='brief_join')
+        self.fields('[]', 400)
+
+    def test_restrict_join(self):
+        prof = restrict_join(self.post_model, 'standard_join',
+                             [['comments'], ['comments', 'body'], ['id']])
+        assert prof == ['__dont_mongo', 'id', {
+            'obj': 'comments', 'join_prof': 'standard_join'}]
@@ -12,6 +12,7 @@ setup(name='lever',
       author='Isaac Cook',
       author_email='isaac@crowdlink.io',
       install_requires=requires,
+      extras_require={'fast': ['orjson']},
       url='http://www.python.org/sigs/distutils-sig/',
       packages=find_packages()
       )